@@ -4,7 +4,7 @@
 """The tuning configuration for Bert.
 Example usage (assuming you are under 'benchmark'):
 python3 -m slapo.autotune.tune --config ../examples/bert/tune_cfg.py \
-    --db bert-gpu8-slapo-megatron.json --error-stop symbol \
+    --db bert-gpu8-slapo-megatron.json --error-stop symbol [--top-k 5] \
     bench_single_node.py slapo-megatron --model bert-large-uncased --gpus 8 --seq-len 512 \
         --batch-size batch_size --gradient-checkpoint ckpt_ratio
 """
@@ -25,3 +25,54 @@ def get_bs_range(args):
     max_bs = min_bs * 2 if n_gpu <= 4 else 128
     step = 4 if n_gpu <= 4 else 8
     return (min_bs, max_bs, step)
+
+
+def get_cost_model(args):
+    """The cost model of BERT in half precision, which is used to rank the
+    candidates with --top-k. The tensor parallel size of megatron is the
+    number of GPUs, and each layer all-reduces the outputs of attention and
+    MLP in forward. Otherwise, the global batch is split by data parallelism.
+    """
+    # pylint: disable=import-outside-toplevel
+    import torch
+    from transformers import AutoConfig
+
+    from slapo.analysis import comm_volume
+    from slapo.autotune.cost_model import CostModel, LayerProfile
+
+    config = AutoConfig.from_pretrained(args["model"])
+    hidden, ffn = config.hidden_size, config.intermediate_size
+    seq, heads = int(args["seq-len"]), config.num_attention_heads
+    n_gpu = int(args["gpus"])
+    tp_size = n_gpu if "slapo-megatron" in args or "megatron" in args else 1
+    dp_size = n_gpu // tp_size
+    dtype_bytes = 2
+
+    # QKV, output projection and MLP GEMMs, and attention scores and context.
+    flops = 2 * seq * (4 * hidden * hidden + 2 * hidden * ffn)
+    flops += 2 * 2 * seq * seq * hidden
+    comm_bytes = 2 * comm_volume("all_reduce", seq * hidden * dtype_bytes, tp_size)
+    # The activations saved for backward in half precision, where the
+    # intermediate ones of attention and MLP are sharded.
+    act_bytes = seq * hidden * (10 + 24 / tp_size) + 5 * heads * seq * seq / tp_size
+    # The costs of a device per sample of the global batch.
+    profile = LayerProfile(
+        flops=flops / tp_size / dp_size,
+        comm_bytes=comm_bytes / dp_size,
+        act_bytes=act_bytes / dp_size,
+        ckpt_act_bytes=seq * hidden * dtype_bytes / dp_size,
+    )
+    num_params = (
+        config.num_hidden_layers * (4 * hidden * hidden + 2 * hidden * ffn) / tp_size
+        + (config.vocab_size + config.max_position_embeddings) * hidden
+    )
+    memory_limit = None
+    if torch.cuda.is_available():
+        memory_limit = torch.cuda.get_device_properties(0).total_memory
+    return CostModel(
+        profile,
+        num_layers=config.num_hidden_layers,
+        # The weights, gradients and Adam states of mixed precision training.
+        static_bytes=num_params * 16,
+        memory_limit=memory_limit,
+    )
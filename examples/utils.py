@@ -2,15 +2,12 @@
 # SPDX-License-Identifier: Apache-2.0
 """Utilities for the examples."""
 import torch
-import torch.distributed as dist
-from deepspeed.runtime.pipe.topology import PipeModelDataParallelTopology
 
 from slapo.logger import get_logger
+from slapo.mesh import DeviceMesh
 
 logger = get_logger("Utils")
 
-_groups = []
-
 
 def get_ds_config(
     batch_size,
@@ -55,23 +52,8 @@ def get_ds_config(
 
 
 def create_dist_group_for_pipeline(num_pp, num_mp):
-    world_size = dist.get_world_size()
-    num_dp = world_size // (num_pp * num_mp)
-    topology = PipeModelDataParallelTopology(
-        num_pp=num_pp, num_mp=num_mp, num_dp=num_dp
-    )
-    model_groups = topology.get_axis_comm_lists("model")
-
-    global_rank = dist.get_rank()
-    group = None
-
-    for g in model_groups:
-        proc_group = dist.new_group(ranks=g)
-        _groups.append(proc_group)
-        if global_rank in g:
-            group = proc_group
-
-    return topology, group
+    mesh = DeviceMesh(tp_size=num_mp, pp_size=num_pp)
+    return mesh.to_topology(), mesh.tp_group
 
 
 def generate_pipeline_cuts(num_layers, num_pp, is_encoder_decoder=False):
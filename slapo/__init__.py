@@ -5,6 +5,7 @@ from .autotune.tune import Database, Space, Symbol
 from .env import *
 from .initialization import init_empty_weights
 from .logger import get_logger
+from .mesh import DeviceMesh, get_process_group
 from .primitives import register_primitive
 from .build import *
 from .schedule import *
@@ -14,3 +15,7 @@ from .version import __version__
 from .random import set_random_seed, get_cuda_rng_tracker, is_random_seed_set
 from .checkpoint import checkpoint
 from .verify import Verify
+from .recorder import ScheduleLog, record
+from .template import apply_template
+from .weights import load_pretrained, open_checkpoint
+from . import analysis
@@ -0,0 +1,6 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Static analysis of schedules."""
+
+from .cost import CostReport, ModuleCost, comm_volume, count_cost
+from .memory import MemoryEstimate, StageMemory, estimate_memory
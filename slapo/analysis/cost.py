@@ -0,0 +1,276 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Count the FLOPs and communication volume of a schedule per module, so
+that the model FLOPs utilization (MFU) of any scheduled model can be
+computed, and the most expensive modules can be found.
+"""
+from __future__ import annotations
+
+import collections
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from ..logger import get_logger
+from .meta import MetaListener, MetaRunner, is_checkpoint_wrapper
+
+logger = get_logger()
+
+
+def comm_volume(op: str, nbytes: int, world_size: int) -> float:
+    """The bytes sent by each device for a collective operation with the
+    ring algorithm. The collectives issued by the resharding schemes in
+    `slapo.sharding.reshard_ops` are counted in the same way.
+
+    Parameters
+    ----------
+    op : str
+        The collective operation, including "all_reduce", "all_gather",
+        "reduce_scatter", "all_to_all" and "broadcast".
+    nbytes : int
+        The bytes of the complete tensor, i.e., the output of all-gather,
+        the input of reduce-scatter, or the tensor of all-reduce.
+    world_size : int
+        The number of devices.
+
+    Returns
+    -------
+    float
+        The bytes sent by each device.
+    """
+    if world_size <= 1:
+        return 0.0
+    ratio = (world_size - 1) / world_size
+    if op == "all_reduce":
+        # reduce-scatter + all-gather.
+        return 2 * ratio * nbytes
+    if op == "broadcast":
+        return float(nbytes)
+    return ratio * nbytes
+
+
+@dataclass
+class ModuleCost:
+    """The cost of a module, excluding its submodules."""
+
+    # The forward FLOPs by operator, such as "aten.mm".
+    flops: dict[str, int] = field(default_factory=lambda: collections.defaultdict(int))
+    # The bytes sent by each device by collective operations.
+    comm_bytes: float = 0.0
+    num_comms: int = 0
+
+    @property
+    def total_flops(self) -> int:
+        return sum(self.flops.values())
+
+
+@dataclass
+class CostReport:
+    """The FLOPs and communication volume of a schedule for a micro-batch
+    on each device. The backward costs are only counted in total since the
+    modules are not tracked in backward.
+    """
+
+    # The costs of the modules by path, excluding their submodules.
+    modules: dict[str, ModuleCost] = field(default_factory=dict)
+    forward_flops: int = 0
+    backward_flops: int = 0
+    # The forward FLOPs of the checkpointed modules, which are recomputed
+    # in backward.
+    recompute_flops: int = 0
+    forward_comm_bytes: float = 0.0
+    backward_comm_bytes: float = 0.0
+
+    @property
+    def model_flops(self) -> int:
+        """The FLOPs of forward and backward, excluding recomputation."""
+        return self.forward_flops + self.backward_flops
+
+    @property
+    def hardware_flops(self) -> int:
+        """The FLOPs executed by the hardware, including recomputation."""
+        return self.model_flops + self.recompute_flops
+
+    def mfu(self, step_time: float, peak_tflops: float) -> float:
+        """The model FLOPs utilization of a device.
+
+        Parameters
+        ----------
+        step_time : float
+            The time in seconds to process the micro-batch.
+        peak_tflops : float
+            The peak TFLOPS of the device.
+
+        Returns
+        -------
+        float
+            The ratio of the achieved to the peak FLOPS.
+        """
+        return self.model_flops / step_time / (peak_tflops * 1e12)
+
+    def aggregate(self, depth: Optional[int] = None) -> dict[str, ModuleCost]:
+        """Aggregate the costs of submodules to their ancestors.
+
+        Parameters
+        ----------
+        depth : Optional[int]
+            The depth of the modules to aggregate to, e.g., 2 for "layers.0".
+            If None, each module includes all its submodules.
+
+        Returns
+        -------
+        dict[str, ModuleCost]
+            The aggregated costs by module path.
+        """
+        results = collections.defaultdict(ModuleCost)
+        for path, cost in self.modules.items():
+            parts = path.split(".") if path else []
+            if depth is None:
+                ancestors = {".".join(parts[:idx]) for idx in range(len(parts) + 1)}
+            else:
+                ancestors = {".".join(parts[:depth])}
+            for ancestor in ancestors:
+                target = results[ancestor]
+                for op, flops in cost.flops.items():
+                    target.flops[op] += flops
+                target.comm_bytes += cost.comm_bytes
+                target.num_comms += cost.num_comms
+        return dict(results)
+
+    def table(self, depth: Optional[int] = None, top_k: Optional[int] = None) -> str:
+        """Format the costs of the modules sorted by FLOPs as a table.
+
+        Parameters
+        ----------
+        depth : Optional[int]
+            The depth of the modules. If None, show the costs of each module
+            excluding its submodules.
+        top_k : Optional[int]
+            Only show the top-k modules.
+
+        Returns
+        -------
+        str
+            The table.
+        """
+        costs = self.modules if depth is None else self.aggregate(depth)
+        items = sorted(costs.items(), key=lambda item: -item[1].total_flops)
+        if top_k is not None:
+            items = items[:top_k]
+        lines = ["module\tGFLOPs\tcomm (MB)\t#comm"]
+        for path, cost in items:
+            lines.append(
+                f"{path or '<top>'}\t{cost.total_flops / 1e9:.4f}\t"
+                f"{cost.comm_bytes / 1024**2:.4f}\t{cost.num_comms}"
+            )
+        lines.append(
+            f"total\tforward {self.forward_flops / 1e9:.4f}, "
+            f"backward {self.backward_flops / 1e9:.4f}, "
+            f"recompute {self.recompute_flops / 1e9:.4f} GFLOPs; "
+            f"forward {self.forward_comm_bytes / 1024**2:.4f}, "
+            f"backward {self.backward_comm_bytes / 1024**2:.4f} MB sent"
+        )
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.table()
+
+
+class _CostListener(MetaListener):
+    def __init__(self, report):
+        self.report = report
+        self.ckpt_depth = 0
+
+    def enter(self, runner, mod, inputs):
+        self.report.modules.setdefault(runner.path, ModuleCost())
+        if is_checkpoint_wrapper(mod):
+            self.ckpt_depth += 1
+
+    def exit(self, runner, mod, output):
+        if is_checkpoint_wrapper(mod):
+            self.ckpt_depth -= 1
+
+    def add_flops(self, runner, op, flops):
+        if runner.phase == "backward":
+            self.report.backward_flops += flops
+            return
+        self.report.modules.setdefault(runner.path, ModuleCost()).flops[op] += flops
+        self.report.forward_flops += flops
+        if self.ckpt_depth > 0:
+            self.report.recompute_flops += flops
+
+    def collective(self, runner, op, nbytes, world_size):
+        volume = comm_volume(op, nbytes, world_size)
+        if runner.phase == "backward":
+            self.report.backward_comm_bytes += volume
+            return
+        cost = self.report.modules.setdefault(runner.path, ModuleCost())
+        cost.comm_bytes += volume
+        cost.num_comms += 1
+        self.report.forward_comm_bytes += volume
+
+
+class _FlopCountMode(TorchDispatchMode):
+    """Count the FLOPs of the operators with the formulas in PyTorch."""
+
+    def __init__(self, runner, listener):
+        super().__init__()
+        # pylint: disable=import-outside-toplevel
+        from torch.utils.flop_counter import flop_registry
+
+        self.flop_registry = flop_registry
+        self.runner = runner
+        self.listener = listener
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        packet = func._overloadpacket
+        if packet in self.flop_registry:
+            flops = self.flop_registry[packet](*args, **kwargs, out_val=out)
+            self.listener.add_flops(self.runner, str(packet), flops)
+        return out
+
+
+def count_cost(
+    sch, example_inputs, training: bool = True, tp_size: Optional[int] = None
+) -> CostReport:
+    """Count the FLOPs and communication volume of a schedule for a
+    micro-batch on each device. The model is executed with meta tensors, so
+    it can be on the meta device (see `slapo.init_empty_weights`). The FLOPs
+    are counted by the formulas of PyTorch operators (e.g., matmul,
+    convolution and attention), and the communication volume includes the
+    collective operations in the sync hooks and resharding. For example:
+
+    .. code-block:: python
+
+        report = slapo.analysis.count_cost(sch, example_inputs)
+        print(report.table(depth=3, top_k=10))
+        mfu = report.mfu(step_time, peak_tflops=312)
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule of the model.
+    example_inputs : Union[torch.Tensor, list, tuple, dict]
+        The inputs of a micro-batch on any device. See `estimate_memory`.
+    training : bool
+        Whether to count the backward costs.
+    tp_size : Optional[int]
+        The tensor parallel size to simulate. See `estimate_memory`.
+
+    Returns
+    -------
+    CostReport
+        The costs of the modules and the totals.
+    """
+    report = CostReport()
+    listener = _CostListener(report)
+    runner = MetaRunner(sch, listener, tp_size=tp_size)
+    with torch.set_grad_enabled(training), _FlopCountMode(runner, listener):
+        runner.run(example_inputs, backward=training)
+    if not training:
+        report.recompute_flops = 0
+    return report
@@ -0,0 +1,252 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Estimate the per-device memory footprint of a schedule without running
+it on devices, so that infeasible configurations (e.g., batch size,
+checkpoint ratio and parallelism) can be rejected before launching them.
+"""
+from __future__ import annotations
+
+import collections
+import itertools
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from torch import nn
+
+from ..logger import get_logger
+from .meta import MetaListener, MetaRunner, is_checkpoint_wrapper, tensor_bytes
+
+logger = get_logger()
+
+# The bytes of the optimizer states per parameter element.
+OPTIMIZER_STATE_BYTES = {
+    None: 0,
+    "sgd": 0,
+    "momentum": 4,
+    "adagrad": 4,
+    "adam": 8,
+    "adamw": 8,
+}
+
+
+@dataclass
+class StageMemory:
+    """The estimated memory of a device in a pipeline stage in bytes."""
+
+    # The parameters and buffers.
+    params: int = 0
+    grads: int = 0
+    optimizer_states: int = 0
+    # The activations saved for backward of all in-flight micro-batches.
+    activations: int = 0
+    # The activations recomputed by the largest checkpointed module.
+    recompute: int = 0
+    # The largest output of a module, which approximates the temporary
+    # buffers in forward and backward.
+    transient: int = 0
+
+    @property
+    def peak(self) -> int:
+        return (
+            self.params
+            + self.grads
+            + self.optimizer_states
+            + self.activations
+            + self.recompute
+            + self.transient
+        )
+
+
+@dataclass
+class MemoryEstimate:
+    """The estimated memory of each pipeline stage. Since every device in
+    the same stage holds the same amount of (sharded) tensors, the peak of
+    a device is the peak of its stage.
+    """
+
+    stages: list[StageMemory] = field(default_factory=list)
+
+    @property
+    def peak(self) -> int:
+        """The peak memory in bytes of the devices among all stages."""
+        return max((stage.peak for stage in self.stages), default=0)
+
+    def __str__(self):
+        def to_mb(nbytes):
+            return f"{nbytes / 1024**2:.2f}"
+
+        fields = [
+            "params",
+            "grads",
+            "optimizer_states",
+            "activations",
+            "recompute",
+            "transient",
+            "peak",
+        ]
+        lines = ["stage\t" + "\t".join(fields) + " (MB)"]
+        for idx, stage in enumerate(self.stages):
+            lines.append(
+                f"{idx}\t" + "\t".join(to_mb(getattr(stage, key)) for key in fields)
+            )
+        return "\n".join(lines)
+
+
+class _MemoryListener(MetaListener):
+    def __init__(self, sch):
+        # The parameters and buffers with the modules that own them.
+        prefix = f"{sch.path}." if sch.path else ""
+        self.tensor_owners = {}
+        for name, mod in sch.mod.named_modules():
+            path = prefix + name if name else sch.path
+            for tensor in itertools.chain(
+                mod.parameters(recurse=False), mod.buffers(recurse=False)
+            ):
+                self.tensor_owners.setdefault(id(tensor), (tensor, []))[1].append(path)
+        self.path_stages = {}
+        self.saved_bytes = collections.defaultdict(int)
+        self.transient = collections.defaultdict(int)
+        self.recompute = collections.defaultdict(int)
+        # The saved tensors, which are kept to avoid reusing their IDs.
+        self.saved_tensors = {}
+        # The saved bytes of the checkpointed modules being executed.
+        self.ckpt_stack = []
+
+    def enter(self, runner, mod, inputs):
+        self.path_stages.setdefault(runner.path, runner.stage)
+        if is_checkpoint_wrapper(mod):
+            if not self.ckpt_stack:
+                # Only the inputs of the outermost checkpointed module are
+                # saved, and the rest are recomputed in backward.
+                for inp in inputs:
+                    if isinstance(inp, torch.Tensor):
+                        self.saved(runner, inp)
+            self.ckpt_stack.append(0)
+
+    def exit(self, runner, mod, output):
+        stage = runner.stage
+        if isinstance(output, torch.Tensor):
+            self.transient[stage] = max(self.transient[stage], tensor_bytes(output))
+        if is_checkpoint_wrapper(mod):
+            recompute = self.ckpt_stack.pop()
+            if self.ckpt_stack:
+                self.ckpt_stack[-1] += recompute
+            else:
+                self.recompute[stage] = max(self.recompute[stage], recompute)
+
+    def saved(self, runner, tensor):
+        if runner.is_state(tensor):
+            return
+        base = tensor._base if tensor._base is not None else tensor
+        if id(base) in self.saved_tensors:
+            return
+        self.saved_tensors[id(base)] = base
+        if self.ckpt_stack:
+            self.ckpt_stack[-1] += tensor_bytes(base)
+        else:
+            self.saved_bytes[runner.stage] += tensor_bytes(base)
+
+
+def estimate_memory(
+    sch,
+    example_inputs,
+    optimizer: Optional[str] = "adam",
+    master_weights: Optional[bool] = None,
+    num_microbatches: int = 1,
+    training: bool = True,
+    tp_size: Optional[int] = None,
+) -> MemoryEstimate:
+    """Estimate the peak memory of each device for a schedule. The model is
+    executed with meta tensors, so it can be on the meta device (see
+    `slapo.init_empty_weights`), and the estimation takes milliseconds to
+    seconds. The following are considered:
+
+    - The parameters after sharding, and their gradients and optimizer
+      states if training.
+    - The activations saved for backward, where the checkpointed modules
+      only save their inputs, and recompute the rest in backward.
+    - The pipeline stages cut by `cut_pipeline_stage`, where the first
+      stage holds the activations of the most in-flight micro-batches
+      under the 1F1B schedule.
+
+    The memory used by the runtime (e.g., CUDA context and the memory
+    fragmentation) is not included.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule of the model.
+    example_inputs : Union[torch.Tensor, list, tuple, dict]
+        The inputs of a micro-batch on any device, including the meta
+        device. A list or tuple is passed as positional arguments, and a
+        dict as keyword arguments.
+    optimizer : Optional[str]
+        The optimizer, which determines the bytes of optimizer states per
+        parameter element. See `OPTIMIZER_STATE_BYTES`.
+    master_weights : Optional[bool]
+        Whether the optimizer keeps FP32 master weights of the parameters.
+        If None, it is True when the parameters are FP16 or BF16.
+    num_microbatches : int
+        The number of micro-batches in a pipeline iteration.
+    training : bool
+        Whether to estimate the memory of training or inference.
+    tp_size : Optional[int]
+        The tensor parallel size to simulate, so that a configuration can be
+        estimated in a single process without the process groups. The
+        tensors annotated by the shard primitive are sharded by it. If None,
+        use the world size of the schedule. See `MetaRunner`.
+
+    Returns
+    -------
+    MemoryEstimate
+        The estimated memory of each pipeline stage.
+    """
+    if optimizer not in OPTIMIZER_STATE_BYTES:
+        raise ValueError(
+            f"Unknown optimizer {optimizer}. "
+            f"Supported: {list(OPTIMIZER_STATE_BYTES.keys())}"
+        )
+    listener = _MemoryListener(sch)
+    runner = MetaRunner(sch, listener, tp_size=tp_size)
+    with torch.set_grad_enabled(training):
+        runner.run(example_inputs)
+
+    stages = [StageMemory() for _ in range(runner.num_stages)]
+    for tensor, owners in listener.tensor_owners.values():
+        # A tensor belongs to the stage that uses it first. The unused
+        # tensors are in the first stage.
+        stage = stages[
+            min(
+                (
+                    listener.path_stages[path]
+                    for path in owners
+                    if path in listener.path_stages
+                ),
+                default=0,
+            )
+        ]
+        # The meta tensor is sharded by the simulated tensor parallel size.
+        tensor = runner.meta_tensors.get(id(tensor), tensor)
+        nbytes = tensor_bytes(tensor)
+        stage.params += nbytes
+        if not training or not isinstance(tensor, nn.Parameter):
+            continue
+        if tensor.requires_grad:
+            stage.grads += nbytes
+            state_bytes = OPTIMIZER_STATE_BYTES[optimizer]
+            use_master = master_weights
+            if use_master is None:
+                use_master = tensor.dtype in (torch.float16, torch.bfloat16)
+            if use_master and optimizer is not None:
+                state_bytes += 4
+            stage.optimizer_states += tensor.numel() * state_bytes
+
+    for idx, stage in enumerate(stages):
+        stage.transient = listener.transient[idx]
+        if training:
+            # Under 1F1B, stage i holds at most (num_stages - i) micro-batches.
+            inflight = min(runner.num_stages - idx, num_microbatches)
+            stage.activations = listener.saved_bytes[idx] * inflight
+            stage.recompute = listener.recompute[idx]
+    return MemoryEstimate(stages)
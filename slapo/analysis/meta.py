@@ -0,0 +1,350 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Execute a scheduled model with meta tensors for static analysis.
+
+The parameters, buffers and inputs are replaced with meta tensors, so the
+execution only propagates shapes and dtypes without allocating memory or
+computing anything. Collective operations (e.g., in the sync hooks) are
+simulated locally, and the activation checkpointing wrappers directly run
+their modules, so that the analysis can run on any device without
+launching the distributed processes.
+"""
+from __future__ import annotations
+
+import contextlib
+import itertools
+from typing import Optional
+
+import torch
+from torch import distributed as dist
+from torch import nn
+from torch.func import functional_call
+
+from ..logger import get_logger
+
+logger = get_logger()
+
+
+class MetaListener:
+    """The base class of the listeners of the events during the meta
+    execution. Each event is given the runner, whose `path`, `stage` and
+    `phase` are the path of the current module, its pipeline stage, and
+    whether it is in forward or backward.
+    """
+
+    def enter(self, runner, mod, inputs):
+        """Called before a module is executed."""
+
+    def exit(self, runner, mod, output):
+        """Called after a module is executed."""
+
+    def saved(self, runner, tensor):
+        """Called when a tensor is saved for backward."""
+
+    def collective(self, runner, op, nbytes, world_size):
+        """Called when a collective operation is executed.
+
+        Parameters
+        ----------
+        runner : MetaRunner
+            The runner.
+        op : str
+            The name of the collective operation, such as "all_reduce".
+        nbytes : int
+            The bytes of the complete tensor being communicated.
+        world_size : int
+            The number of devices in the process group.
+        """
+
+
+def tensor_bytes(tensor: torch.Tensor) -> int:
+    """The bytes of a tensor."""
+    return tensor.numel() * tensor.element_size()
+
+
+def is_checkpoint_wrapper(mod: nn.Module) -> bool:
+    """Whether the module is wrapped by the checkpoint primitive."""
+    return type(mod).__name__ == "CheckPointWrapper"
+
+
+def _to_meta(obj):
+    if isinstance(obj, torch.Tensor):
+        return torch.empty_like(obj, device="meta")
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_meta(item) for item in obj)
+    if isinstance(obj, dict):
+        return {key: _to_meta(item) for key, item in obj.items()}
+    return obj
+
+
+def _sharded_axes(sch):
+    """The axes of the tensors annotated by the shard primitive with the world
+    size of their schedules, keyed by the tensor IDs.
+    """
+    axes = {}
+    tensors = dict(sch.mod.named_parameters())
+    tensors.update(sch.mod.named_buffers())
+    for name, axis in sch.metadata.primitives.get("shard", {}).items():
+        # Skip the other entries of the shard metadata, such as the inferred
+        # output type of the module.
+        if name in tensors:
+            axes[id(tensors[name])] = (axis, sch.world_size)
+    for child in sch.child.values():
+        axes.update(_sharded_axes(child))
+    return axes
+
+
+class _Work:
+    """The handle of a simulated asynchronous collective operation."""
+
+    def wait(self):
+        return True
+
+    def is_completed(self):
+        return True
+
+
+class MetaRunner:
+    """Run a scheduled model with meta tensors and notify the listener.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule of the model.
+    listener : Optional[MetaListener]
+        The listener of the events. It can also be set later.
+    tp_size : Optional[int]
+        The simulated tensor parallel size. If given, the tensors annotated
+        by the shard primitive are sharded by it, and it is the world size
+        of the simulated collectives, so that a schedule created in a single
+        process can be analyzed as if it were sharded. Note that the module
+        attributes adjusted by the schedule by its world size (e.g., the
+        number of attention heads) are not changed. If None, use the world
+        size of the process groups.
+    """
+
+    def __init__(
+        self,
+        sch,
+        listener: Optional[MetaListener] = None,
+        tp_size: Optional[int] = None,
+    ):
+        self.sch = sch
+        self.listener = listener
+        self.tp_size = tp_size
+        self.path = ""
+        self.stage = 0
+        # Either "forward" or "backward".
+        self.phase = "forward"
+        self.num_stages = 1
+        self.path_stack = []
+        # The modules after which a new pipeline stage starts.
+        self.cut_modules = set()
+        top_sch = sch.get_top_schedule()
+        for parent_path in top_sch.metadata.primitives.get("cut_pipeline_stage", {}):
+            parent = top_sch[parent_path] if parent_path else top_sch
+            for node in parent.mod.graph.nodes:
+                if node.op == "call_module" and node.meta.get("partition", False):
+                    self.cut_modules.add(id(parent.mod.get_submodule(node.target)))
+        self.num_stages = len(self.cut_modules) + 1
+        # The IDs of the meta parameters and buffers.
+        self.state_ids = set()
+        # The meta parameters and buffers keyed by the IDs of the original ones.
+        self.meta_tensors = {}
+
+    def group_size(self, group=None) -> int:
+        """The (simulated) world size of a process group."""
+        if self.tp_size is not None:
+            return self.tp_size
+        if dist.is_initialized():
+            return dist.get_world_size(group)
+        return 1
+
+    def _meta_shape(self, tensor, sharded_axes):
+        shape = list(tensor.shape)
+        if self.tp_size is not None and id(tensor) in sharded_axes:
+            axis, world_size = sharded_axes[id(tensor)]
+            full_size = shape[axis] * world_size
+            if full_size % self.tp_size != 0:
+                raise ValueError(
+                    f"Cannot shard axis {axis} of size {full_size} "
+                    f"by {self.tp_size}"
+                )
+            shape[axis] = full_size // self.tp_size
+        return shape
+
+    def _make_state(self):
+        state, meta_tensors = {}, {}
+        sharded_axes = _sharded_axes(self.sch) if self.tp_size is not None else {}
+        for name, tensor in itertools.chain(
+            self.sch.mod.named_parameters(remove_duplicate=False),
+            self.sch.mod.named_buffers(remove_duplicate=False),
+        ):
+            if id(tensor) not in meta_tensors:
+                meta = torch.empty(
+                    self._meta_shape(tensor, sharded_axes),
+                    dtype=tensor.dtype,
+                    device="meta",
+                )
+                if isinstance(tensor, nn.Parameter):
+                    meta = nn.Parameter(meta, requires_grad=tensor.requires_grad)
+                meta_tensors[id(tensor)] = meta
+            state[name] = meta_tensors[id(tensor)]
+        self.state_ids = {id(tensor) for tensor in meta_tensors.values()}
+        self.meta_tensors = meta_tensors
+        return state
+
+    def is_state(self, tensor):
+        """Whether the tensor is (a view of) a parameter or buffer."""
+        return id(tensor) in self.state_ids or (
+            tensor._base is not None and id(tensor._base) in self.state_ids
+        )
+
+    @contextlib.contextmanager
+    def _module_hooks(self):
+        handles = []
+        patched = []
+        prefix = f"{self.sch.path}." if self.sch.path else ""
+
+        for name, mod in self.sch.mod.named_modules():
+            path = prefix + name if name else self.sch.path
+
+            # pylint: disable=cell-var-from-loop
+            def pre_hook(mod, inputs, path=path):
+                self.path_stack.append(self.path)
+                self.path = path
+                self.listener.enter(self, mod, inputs)
+
+            def post_hook(mod, _inputs, output):
+                self.listener.exit(self, mod, output)
+                self.path = self.path_stack.pop()
+                if id(mod) in self.cut_modules:
+                    self.stage += 1
+
+            # The pre hook is prepended and the post hook is appended, so that
+            # the sync hooks are considered as a part of the module.
+            handles.append(mod.register_forward_pre_hook(pre_hook, prepend=True))
+            handles.append(mod.register_forward_hook(post_hook))
+            if is_checkpoint_wrapper(mod):
+                # Run the checkpointed module directly, so that the listener
+                # can see it. The recomputation is left to the listener.
+                mod.forward = mod.mod.__call__
+                patched.append(mod)
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+            for mod in patched:
+                del mod.forward
+
+    @contextlib.contextmanager
+    def _simulate_collectives(self):
+        listener = self.listener
+        runner = self
+
+        def make_op(op, nbytes_fn):
+            def simulated(*args, group=None, async_op=False, **kwargs):
+                listener.collective(
+                    runner, op, nbytes_fn(*args), runner.group_size(group)
+                )
+                return _Work() if async_op else None
+
+            return simulated
+
+        def list_bytes(tensors):
+            return sum(tensor_bytes(tensor) for tensor in tensors)
+
+        simulated_ops = {
+            "all_reduce": make_op("all_reduce", tensor_bytes),
+            "broadcast": make_op("broadcast", tensor_bytes),
+            "all_gather_into_tensor": make_op(
+                "all_gather", lambda out, *_: tensor_bytes(out)
+            ),
+            "all_gather": make_op("all_gather", lambda outs, *_: list_bytes(outs)),
+            "reduce_scatter_tensor": make_op(
+                "reduce_scatter", lambda _, inp, *__: tensor_bytes(inp)
+            ),
+            "all_to_all": make_op("all_to_all", lambda outs, *_: list_bytes(outs)),
+            "all_to_all_single": make_op(
+                "all_to_all", lambda out, *_: tensor_bytes(out)
+            ),
+        }
+        if self.tp_size is not None or not dist.is_initialized():
+            # The simulated tensor parallel group, or a single device without
+            # the default process group.
+            simulated_ops["get_world_size"] = runner.group_size
+            simulated_ops["get_rank"] = lambda group=None: 0
+        originals = {name: getattr(dist, name) for name in simulated_ops}
+        for name, func in simulated_ops.items():
+            setattr(dist, name, func)
+        try:
+            yield
+        finally:
+            for name, func in originals.items():
+                setattr(dist, name, func)
+
+    def run(self, example_inputs, backward: bool = False):
+        """Run the model with the meta tensors of the example inputs.
+
+        Parameters
+        ----------
+        example_inputs : Union[torch.Tensor, list, tuple, dict]
+            The example inputs of a micro-batch. A list or tuple is passed
+            as positional arguments, and a dict as keyword arguments. Only
+            their shapes and dtypes are used.
+        backward : bool
+            Whether to also run the backward pass.
+
+        Returns
+        -------
+        Any
+            The meta outputs.
+        """
+        if isinstance(example_inputs, dict):
+            args, kwargs = (), _to_meta(example_inputs)
+        elif isinstance(example_inputs, (list, tuple)):
+            args, kwargs = _to_meta(tuple(example_inputs)), {}
+        else:
+            args, kwargs = (_to_meta(example_inputs),), {}
+
+        self.path, self.stage, self.path_stack = self.sch.path, 0, []
+        self.phase = "forward"
+        state = self._make_state()
+
+        def pack(tensor):
+            self.listener.saved(self, tensor)
+            return tensor
+
+        with self._module_hooks(), self._simulate_collectives():
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+                outputs = functional_call(
+                    self.sch.mod, state, args, kwargs, strict=False
+                )
+            if backward:
+                # The modules are not tracked in backward, so the events are
+                # attributed to the top module.
+                self.phase = "backward"
+                tensors = [
+                    out
+                    for out in _flatten(outputs)
+                    if isinstance(out, torch.Tensor) and out.requires_grad
+                ]
+                if tensors:
+                    torch.autograd.backward(
+                        tensors, [torch.ones_like(out) for out in tensors]
+                    )
+        return outputs
+
+
+def _flatten(obj):
+    if isinstance(obj, torch.Tensor):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [item for sub in obj for item in _flatten(sub)]
+    if isinstance(obj, dict):
+        return [item for sub in obj.values() for item in _flatten(sub)]
+    if hasattr(obj, "to_tuple"):
+        # HuggingFace ModelOutput.
+        return _flatten(obj.to_tuple())
+    return []
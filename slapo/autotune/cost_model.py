@@ -0,0 +1,251 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""An analytical cost model of tuning configurations, which predicts the
+relative step time and peak memory of a candidate from its batch size and
+checkpoint ratio, so that only the most promising candidates are run.
+
+The step time is modeled as the FLOPs of forward, backward and the
+recomputation implied by the checkpoint ratio, plus the tensor parallel
+communication, which is also repeated in backward and recomputation. The
+model is then calibrated by the measured throughputs and out-of-memory
+errors of the existing tuning records.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Optional
+
+from slapo.logger import get_logger
+
+logger = get_logger()
+
+
+@dataclass
+class LayerProfile:
+    """The costs of a layer per sample."""
+
+    # The forward FLOPs of a device.
+    flops: float = 1.0
+    # The forward bytes sent by a device for tensor parallelism.
+    comm_bytes: float = 0.0
+    # The activations saved for backward without checkpointing.
+    act_bytes: float = 1.0
+    # The activations saved for backward with checkpointing, i.e., the inputs.
+    ckpt_act_bytes: float = 0.0
+
+    @classmethod
+    def from_schedule(cls, sch, example_inputs, batch_size: int):
+        """Profile a scheduled layer with `slapo.analysis`.
+
+        Parameters
+        ----------
+        sch : Schedule
+            The schedule of a layer, which could be sharded.
+        example_inputs : Union[torch.Tensor, list, tuple, dict]
+            The inputs of the layer.
+        batch_size : int
+            The batch size of the example inputs.
+
+        Returns
+        -------
+        LayerProfile
+            The profile of the layer.
+        """
+        # pylint: disable=import-outside-toplevel
+        from slapo.analysis import count_cost, estimate_memory
+        from slapo.analysis.meta import _flatten, tensor_bytes
+
+        cost = count_cost(sch, example_inputs, training=False)
+        memory = estimate_memory(sch, example_inputs, optimizer=None)
+        inputs = example_inputs
+        if isinstance(inputs, dict):
+            inputs = list(inputs.values())
+        input_bytes = sum(tensor_bytes(tensor) for tensor in _flatten(inputs))
+        return cls(
+            flops=cost.forward_flops / batch_size,
+            comm_bytes=cost.forward_comm_bytes / batch_size,
+            act_bytes=memory.stages[0].activations / batch_size,
+            ckpt_act_bytes=input_bytes / batch_size,
+        )
+
+
+def get_ckpt_ratio(cfg: dict) -> float:
+    """Get the checkpoint ratio of a configuration, where "full" means
+    checkpointing all layers.
+    """
+    ratio = cfg.get("ckpt_ratio", 0.0)
+    if ratio == "full":
+        return 1.0
+    if ratio in (None, "", "none"):
+        return 0.0
+    return float(ratio)
+
+
+class CostModel:
+    """The cost model of tuning configurations. Without calibration, the
+    predictions are only meaningful relative to each other.
+
+    .. code-block:: python
+
+        model = CostModel(profile, num_layers=24, peak_tflops=312)
+        model.calibrate(db.get_results())
+        candidates = model.rank(candidates, top_k=5)
+
+    Parameters
+    ----------
+    profile : Optional[LayerProfile]
+        The costs of a layer per sample. If None, a layer of unit FLOPs and
+        activations without communication is assumed.
+    num_layers : int
+        The number of layers on a device.
+    static_bytes : float
+        The memory independent of the batch size, such as the parameters
+        and optimizer states.
+    peak_tflops : float
+        The achievable TFLOPS of a device.
+    bandwidth : float
+        The achievable bandwidth in GB/s of the tensor parallel group.
+    step_overhead : float
+        The time in seconds of a step independent of the batch size, such
+        as the optimizer and the kernel launches. It is refined in
+        calibration.
+    memory_limit : Optional[float]
+        The memory capacity in bytes of a device, where the configurations
+        that reach it run out of memory. It is refined by the failures in
+        calibration.
+    """
+
+    def __init__(
+        self,
+        profile: Optional[LayerProfile] = None,
+        num_layers: int = 1,
+        static_bytes: float = 0.0,
+        peak_tflops: float = 100.0,
+        bandwidth: float = 100.0,
+        step_overhead: float = 0.01,
+        memory_limit: Optional[float] = None,
+    ):
+        self.profile = profile or LayerProfile()
+        self.num_layers = num_layers
+        self.static_bytes = static_bytes
+        self.peak_flops = peak_tflops * 1e12
+        self.bandwidth = bandwidth * 1e9
+        self.memory_limit = memory_limit
+        # The step time is scale * predicted time + overhead after calibration.
+        self.scale = 1.0
+        self.overhead = step_overhead
+
+    def _raw_time(self, cfg):
+        batch_size = cfg["batch_size"]
+        ratio = get_ckpt_ratio(cfg)
+        profile = self.profile
+        # Backward takes twice the FLOPs of forward, and the checkpointed
+        # layers run forward again in backward.
+        flops = batch_size * self.num_layers * profile.flops * (3 + ratio)
+        # The communication of forward is mirrored in backward.
+        comm = batch_size * self.num_layers * profile.comm_bytes * (2 + ratio)
+        return flops / self.peak_flops + comm / self.bandwidth
+
+    def predict_time(self, cfg: dict) -> float:
+        """Predict the step time in seconds of a configuration."""
+        return self.scale * self._raw_time(cfg) + self.overhead
+
+    def predict_memory(self, cfg: dict) -> float:
+        """Predict the peak memory in bytes of a configuration."""
+        batch_size = cfg["batch_size"]
+        ratio = get_ckpt_ratio(cfg)
+        profile = self.profile
+        saved = ratio * profile.ckpt_act_bytes + (1 - ratio) * profile.act_bytes
+        acts = batch_size * self.num_layers * saved
+        if ratio > 0:
+            # The activations of a layer being recomputed.
+            acts += batch_size * profile.act_bytes
+        return self.static_bytes + acts
+
+    def predict_thrpt(self, cfg: dict) -> float:
+        """Predict the throughput in samples per second of a configuration,
+        or 0 if it is predicted to run out of memory.
+        """
+        if (
+            self.memory_limit is not None
+            and self.predict_memory(cfg) >= self.memory_limit
+        ):
+            return 0.0
+        return cfg["batch_size"] / max(self.predict_time(cfg), 1e-12)
+
+    def calibrate(self, records: list[tuple[dict, float, Optional[int]]]):
+        """Calibrate the model by the measured results. The step time is
+        fitted by linear regression on the predicted time, and the memory
+        limit is set between the largest predicted memory of the successful
+        runs and the smallest one of the runs out of memory. The other
+        failures (e.g., crashes and timeouts) are ignored.
+
+        Parameters
+        ----------
+        records : list[tuple[dict, float, Optional[int]]]
+            The configurations, their measured throughputs, where 0 means
+            failure, and their error codes, where 1 means out of memory
+            (see `Database.get_results`).
+        """
+        points = []
+        max_ok, min_oom = 0.0, None
+        for cfg, thrpt, error_code in records:
+            if "batch_size" not in cfg:
+                continue
+            memory = self.predict_memory(cfg)
+            if thrpt > 0 and error_code in (0, None):
+                points.append((self._raw_time(cfg), cfg["batch_size"] / thrpt))
+                max_ok = max(max_ok, memory)
+            elif error_code == 1 and (min_oom is None or memory < min_oom):
+                min_oom = memory
+        if min_oom is not None and min_oom > max_ok:
+            self.memory_limit = (max_ok + min_oom) / 2 if max_ok else min_oom
+        if len(points) == 1:
+            ((pred, measured),) = points
+            # Keep the overhead, which cannot be fitted by one point.
+            if measured <= self.overhead:
+                self.overhead = 0.0
+            self.scale = (measured - self.overhead) / pred
+        elif len(points) > 1:
+            mean_x = sum(x for x, _ in points) / len(points)
+            mean_y = sum(y for _, y in points) / len(points)
+            var = sum((x - mean_x) ** 2 for x, _ in points)
+            cov = sum((x - mean_x) * (y - mean_y) for x, y in points)
+            if var > 0 and cov > 0:
+                self.scale = cov / var
+                self.overhead = max(mean_y - self.scale * mean_x, 0.0)
+            else:
+                self.scale, self.overhead = mean_y / mean_x, 0.0
+        logger.info(
+            "Calibrated cost model with %d records: scale %.3g, overhead %.3gs, "
+            "memory limit %s",
+            len(records),
+            self.scale,
+            self.overhead,
+            self.memory_limit,
+        )
+
+    def rank(self, candidates: list[dict], top_k: Optional[int] = None) -> list[dict]:
+        """Order the candidates by their predicted throughputs, and prune the
+        ones predicted to run out of memory.
+
+        Parameters
+        ----------
+        candidates : list[dict]
+            The configurations.
+        top_k : Optional[int]
+            Only keep the top-k candidates.
+
+        Returns
+        -------
+        list[dict]
+            The ordered candidates.
+        """
+        scored = [(self.predict_thrpt(cfg), cfg) for cfg in candidates]
+        ordered = [cfg for thrpt, cfg in sorted(scored, key=lambda x: -x[0]) if thrpt]
+        if len(ordered) < len(candidates):
+            logger.info(
+                "Pruned %d candidates predicted to be out of memory",
+                len(candidates) - len(ordered),
+            )
+        return ordered[:top_k] if top_k is not None else ordered
@@ -0,0 +1,316 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""An append-only database of tuning records backed by SQLite.
+
+Each trial appends a record, which is committed in its own transaction, so
+the I/O of a trial does not grow with the history and a crash cannot
+corrupt the committed records. The records are indexed on the config key
+and on the model and hardware fingerprints, and the training logs are
+compressed in a separate table, so that a restarted tuning can skip the
+evaluated configs and queries do not load the logs.
+"""
+from __future__ import annotations
+
+import json
+import os
+import platform
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional
+
+from slapo.logger import get_logger
+
+logger = get_logger()
+
+# The fields of a record stored as compressed logs.
+LOG_FIELDS = ("log", "memo")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    model TEXT,
+    hardware TEXT,
+    workload TEXT,
+    batch_size INTEGER,
+    thrpt REAL,
+    error_code INTEGER,
+    config TEXT,
+    data TEXT,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS records_key ON records (workload, hardware, key);
+CREATE INDEX IF NOT EXISTS records_model
+    ON records (model, hardware, batch_size, thrpt);
+CREATE TABLE IF NOT EXISTS logs (
+    record_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    content BLOB,
+    PRIMARY KEY (record_id, name)
+);
+"""
+
+_COLUMNS = "id, key, model, hardware, batch_size, thrpt, error_code, config, data"
+
+
+def get_hardware_fingerprint() -> str:
+    """The fingerprint of the devices on this node, e.g., "8xNVIDIA A100"."""
+    # pylint: disable=import-outside-toplevel
+    import torch
+
+    if torch.cuda.is_available():
+        return f"{torch.cuda.device_count()}x{torch.cuda.get_device_name(0)}"
+    return f"{os.cpu_count()}x{platform.processor() or platform.machine()}"
+
+
+class Database:
+    """The append-only database of tuning records. A later record of the same
+    config overrides the earlier ones in lookups.
+
+    .. code-block:: python
+
+        db = Database("tune.db", model="gpt2", hardware=get_hardware_fingerprint())
+        if db.lookup(key) is None:
+            db.commit(key, {"config": cfg, "thrpt": thrpt, "log": log})
+        best = db.best(model="gpt2", min_batch_size=16)
+
+    Parameters
+    ----------
+    db_file_name : Optional[str]
+        The SQLite file of the database. If None, the records are in memory.
+    model : Optional[str]
+        The name of the tuned model, which is stored with the records.
+    hardware : Optional[str]
+        The fingerprint of the hardware, which is stored with the records.
+    workload : Optional[str]
+        The fingerprint of the workload (e.g., the training script and its
+        arguments), which is stored with the records. The lookups and results
+        are limited to the records of the same workload and hardware.
+    """
+
+    def __init__(
+        self,
+        db_file_name: Optional[str] = None,
+        model: Optional[str] = None,
+        hardware: Optional[str] = None,
+        workload: Optional[str] = None,
+    ):
+        self.db_file_name = db_file_name
+        self.model = model
+        self.hardware = hardware
+        self.workload = workload
+        if db_file_name and os.path.exists(db_file_name):
+            with open(db_file_name, "rb") as filep:
+                header = filep.read(16)
+            if header and not header.startswith(b"SQLite format 3"):
+                raise ValueError(
+                    f"{db_file_name} is not a SQLite tuning database. "
+                    "Use Database.import_json to convert a JSON database."
+                )
+        # The trials may be committed from multiple threads.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file_name or ":memory:", check_same_thread=False)
+        if db_file_name:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+        if self.db_file_name:
+            logger.info("Tuning records will be saved to %s", self.db_file_name)
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def load(self):
+        """Report the existing records. The records are queried lazily, so
+        there is nothing to load.
+        """
+        if self.db_file_name:
+            logger.info("Found %d tuning records in %s", len(self), self.db_file_name)
+
+    def commit(self, key: str, data: dict):
+        """Append a record to the database.
+
+        Parameters
+        ----------
+        key : str
+            The key of the config.
+        data : dict
+            The record, including "config", "thrpt", "error_code" and the
+            logs in `LOG_FIELDS`, which are compressed and stored separately.
+        """
+        # pylint: disable=import-outside-toplevel
+        from .tune import Space
+
+        data = dict(data)
+        logs = {name: data.pop(name) for name in LOG_FIELDS if name in data}
+        cfg = data.pop("config", None) or Space.cfg_str_to_dict(key)
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO records (key, model, hardware, workload, batch_size, "
+                "thrpt, error_code, config, data, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    self.model,
+                    self.hardware,
+                    self.workload,
+                    cfg.get("batch_size", None),
+                    data.get("thrpt", None),
+                    data.get("error_code", None),
+                    json.dumps(cfg),
+                    json.dumps(data),
+                    time.time(),
+                ),
+            )
+            self.conn.executemany(
+                "INSERT INTO logs (record_id, name, content) VALUES (?, ?, ?)",
+                [
+                    (cursor.lastrowid, name, zlib.compress(str(log).encode("utf-8")))
+                    for name, log in logs.items()
+                ],
+            )
+
+    def _scope(self):
+        conds, params = [], []
+        for column in ("workload", "hardware"):
+            if getattr(self, column) is not None:
+                conds.append(f"{column} = ?")
+                params.append(getattr(self, column))
+        return conds, params
+
+    @staticmethod
+    def _to_record(row):
+        record_id, key, model, hardware, batch_size, thrpt, error_code, cfg, data = row
+        record = json.loads(data)
+        record.update(
+            id=record_id,
+            key=key,
+            model=model,
+            hardware=hardware,
+            batch_size=batch_size,
+            thrpt=thrpt,
+            error_code=error_code,
+            config=json.loads(cfg),
+        )
+        return record
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """Get the latest record of a config of the same workload and
+        hardware without the logs, or None if not evaluated.
+        """
+        conds, params = self._scope()
+        conds.append("key = ?")
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {_COLUMNS} FROM records WHERE {' AND '.join(conds)} "
+                "ORDER BY id DESC LIMIT 1",
+                params + [key],
+            ).fetchone()
+        return self._to_record(row) if row is not None else None
+
+    def get_log(self, record_id: int, name: str = "log") -> Optional[str]:
+        """Get a log of a record."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content FROM logs WHERE record_id = ? AND name = ?",
+                (record_id, name),
+            ).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8") if row is not None else None
+
+    def query(
+        self,
+        model: Optional[str] = None,
+        hardware: Optional[str] = None,
+        min_batch_size: Optional[int] = None,
+        max_batch_size: Optional[int] = None,
+        succeeded: Optional[bool] = None,
+        order_by_thrpt: bool = False,
+        limit: Optional[int] = None,
+    ) -> list[dict]:
+        """Query the records without the logs.
+
+        Parameters
+        ----------
+        model : Optional[str]
+            The model name.
+        hardware : Optional[str]
+            The hardware fingerprint.
+        min_batch_size : Optional[int]
+            The minimum batch size.
+        max_batch_size : Optional[int]
+            The maximum batch size.
+        succeeded : Optional[bool]
+            Whether the trials succeeded (i.e., the error code is 0).
+        order_by_thrpt : bool
+            Whether to order by the throughput descendingly, or by the order
+            of the records otherwise.
+        limit : Optional[int]
+            The maximum number of records.
+
+        Returns
+        -------
+        list[dict]
+            The records.
+        """
+        conds, params = [], []
+        for column, value in (("model", model), ("hardware", hardware)):
+            if value is not None:
+                conds.append(f"{column} = ?")
+                params.append(value)
+        if min_batch_size is not None:
+            conds.append("batch_size >= ?")
+            params.append(min_batch_size)
+        if max_batch_size is not None:
+            conds.append("batch_size <= ?")
+            params.append(max_batch_size)
+        if succeeded is not None:
+            conds.append("error_code = 0" if succeeded else "error_code != 0")
+        sql = f"SELECT {_COLUMNS} FROM records"
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += " ORDER BY thrpt DESC" if order_by_thrpt else " ORDER BY id"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def best(self, **kwargs) -> Optional[dict]:
+        """Get the successful record of the highest throughput. See `query`
+        for the filters.
+        """
+        records = self.query(succeeded=True, order_by_thrpt=True, limit=1, **kwargs)
+        return records[0] if records else None
+
+    def get_results(self) -> list[tuple[dict, float, Optional[int]]]:
+        """Get the configs of the same workload and hardware with their latest
+        throughputs, where 0 means failure, and error codes, where 1 means
+        out of memory (see `parse_log`).
+        """
+        conds, params = self._scope()
+        sql = "SELECT config, thrpt, error_code FROM records"
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        with self.lock:
+            rows = self.conn.execute(sql + " ORDER BY id", params).fetchall()
+        results = {}
+        for cfg, thrpt, error_code in rows:
+            thrpt = (thrpt or 0) if error_code in (0, None) else 0
+            results[cfg] = (json.loads(cfg), thrpt, error_code)
+        return list(results.values())
+
+    def import_json(self, json_file: str):
+        """Import the records of a JSON database of the previous versions."""
+        with open(json_file, "r", encoding="utf-8") as filep:
+            records = json.load(filep)
+        for key, data in records.items():
+            self.commit(key, data)
+        logger.info("Imported %d tuning records from %s", len(records), json_file)
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            self.conn.close()
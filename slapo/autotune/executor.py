@@ -0,0 +1,264 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Run tuning trials concurrently on a pool of resource slots.
+
+Each slot is a set of devices (or CPU cores) exposed to the trial by an
+environment variable, such as `CUDA_VISIBLE_DEVICES`, so that multiple
+small trials can share a node. Every trial runs in its own working
+directory with its own log file and a wall-clock timeout, and the processes
+left by a trial (e.g., the workers spawned by a launcher) are killed when it
+finishes.
+"""
+from __future__ import annotations
+
+import json
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Optional, Union
+
+from slapo.logger import get_logger
+
+logger = get_logger()
+
+
+@dataclass
+class TrialResult:
+    """The result of a trial."""
+
+    cfg: dict
+    workdir: str
+    # The stdout and stderr of the trial.
+    log_file: str
+    # None if the trial was stopped.
+    returncode: Optional[int]
+    elapsed: float
+    # The reason to stop the trial, which is "timeout" or given by the monitor.
+    stop_reason: Optional[str] = None
+
+    @property
+    def timed_out(self) -> bool:
+        return self.stop_reason == "timeout"
+
+
+def parse_slots(slots: str) -> list[str]:
+    """Parse the slots separated by semicolons, e.g., "0,1;2,3" for two slots
+    of two devices each.
+    """
+    return [slot.strip() for slot in slots.split(";") if slot.strip()]
+
+
+def split_devices(devices: list[int], per_trial: int) -> list[str]:
+    """Split the devices into slots of the given number of devices."""
+    if per_trial <= 0 or len(devices) % per_trial != 0:
+        raise ValueError(f"Cannot split {len(devices)} devices by {per_trial}")
+    return [
+        ",".join(str(dev) for dev in devices[idx : idx + per_trial])
+        for idx in range(0, len(devices), per_trial)
+    ]
+
+
+def _kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class TrialExecutor:
+    """Run trials concurrently on a pool of resource slots.
+
+    .. code-block:: python
+
+        with TrialExecutor(split_devices(list(range(8)), 2), timeout=600) as ex:
+            futures = [ex.submit(make_cmd(cfg), cfg) for cfg in cfgs]
+            results = [future.result() for future in futures]
+
+    Parameters
+    ----------
+    slots : Optional[list[str]]
+        The resource slots, e.g., ["0,1", "2,3"]. A trial holds a slot while
+        running. If None, there is one slot without setting the environment
+        variable, so the trials run one at a time.
+    timeout : Optional[float]
+        The wall-clock timeout in seconds of a trial.
+    workdir : str
+        The directory of the working directories of the trials.
+    slot_env : str
+        The environment variable to expose a slot to a trial.
+    poll_interval : float
+        The interval in seconds to poll the logs of the trials with monitors.
+    """
+
+    def __init__(
+        self,
+        slots: Optional[list[str]] = None,
+        timeout: Optional[float] = None,
+        workdir: str = "tune_trials",
+        slot_env: str = "CUDA_VISIBLE_DEVICES",
+        poll_interval: float = 1.0,
+    ):
+        self.slots = slots or [None]
+        self.timeout = timeout
+        self.workdir = os.path.abspath(workdir)
+        self.slot_env = slot_env
+        self.poll_interval = poll_interval
+        self.free_slots = queue.Queue()
+        for slot in self.slots:
+            self.free_slots.put(slot)
+        self.executor = ThreadPoolExecutor(
+            max_workers=len(self.slots), thread_name_prefix="slapo-trial"
+        )
+        self.lock = threading.Lock()
+        self.num_trials = 0
+
+    @property
+    def num_slots(self) -> int:
+        return len(self.slots)
+
+    def _make_workdir(self, cfg):
+        with self.lock:
+            trial_idx = self.num_trials
+            self.num_trials += 1
+        workdir = os.path.join(self.workdir, f"trial_{trial_idx:05d}")
+        os.makedirs(workdir, exist_ok=True)
+        with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+            json.dump(cfg, f)
+        return workdir
+
+    @staticmethod
+    def _poll(workdir, monitor, monitor_files, offsets):
+        """Feed the new contents of the logs to the monitor."""
+        for name in monitor_files:
+            path = os.path.join(workdir, name)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as filep:
+                filep.seek(offsets.get(name, 0))
+                data = filep.read()
+            if not data:
+                continue
+            offsets[name] = offsets.get(name, 0) + len(data)
+            reason = monitor(name, data.decode("utf-8", errors="replace"))
+            if reason is not None:
+                return reason
+        return None
+
+    def _wait(self, proc, workdir, monitor, monitor_files):
+        """Wait for the trial, and return its return code and the reason if
+        it should be stopped.
+        """
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        offsets = {}
+        while True:
+            wait_time = None if deadline is None else max(deadline - time.time(), 0)
+            if monitor is not None:
+                wait_time = min(wait_time or self.poll_interval, self.poll_interval)
+            try:
+                return proc.wait(timeout=wait_time), None
+            except subprocess.TimeoutExpired:
+                pass
+            if deadline is not None and time.time() >= deadline:
+                logger.warning(
+                    "Trial in %s timed out after %s seconds", workdir, self.timeout
+                )
+                return None, "timeout"
+            if monitor is not None:
+                reason = self._poll(workdir, monitor, monitor_files, offsets)
+                if reason is not None:
+                    logger.info("\tStopped the trial in %s: %s", workdir, reason)
+                    return None, reason
+
+    def run(
+        self,
+        cmd: Union[str, list[str]],
+        cfg: dict,
+        env: Optional[dict] = None,
+        monitor: Optional[Callable[[str, str], Optional[str]]] = None,
+        monitor_files: Optional[list[str]] = None,
+    ) -> TrialResult:
+        """Run a trial and wait for a free slot if none.
+
+        Parameters
+        ----------
+        cmd : Union[str, list[str]]
+            The command, which is run by the shell if it is a string.
+        cfg : dict
+            The config of the trial.
+        env : Optional[dict]
+            The additional environment variables.
+        monitor : Optional[Callable[[str, str], Optional[str]]]
+            The function that takes the name of a log file and its new
+            contents while the trial is running, and returns the reason to
+            stop the trial early, or None to continue.
+        monitor_files : Optional[list[str]]
+            The log files in the working directory to be monitored. If None,
+            monitor the stdout and stderr of the trial.
+
+        Returns
+        -------
+        TrialResult
+            The result of the trial.
+        """
+        workdir = self._make_workdir(cfg)
+        log_file = os.path.join(workdir, "run_script.log")
+        slot = self.free_slots.get()
+        try:
+            trial_env = dict(os.environ, **(env or {}))
+            if slot is not None:
+                trial_env[self.slot_env] = slot
+            logger.info("\tRunning trial in %s (slot %s): %s", workdir, slot, cmd)
+            start = time.time()
+            with open(log_file, "w", encoding="utf-8") as log:
+                # Start a new session, so that the trial and all its child
+                # processes can be killed together.
+                proc = subprocess.Popen(
+                    cmd,
+                    shell=isinstance(cmd, str),
+                    cwd=workdir,
+                    env=trial_env,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                )
+                try:
+                    returncode, reason = self._wait(
+                        proc,
+                        workdir,
+                        monitor,
+                        monitor_files or [os.path.basename(log_file)],
+                    )
+                finally:
+                    # Kill the orphan processes, if any.
+                    _kill_group(proc.pid)
+                    proc.wait()
+            return TrialResult(
+                cfg, workdir, log_file, returncode, time.time() - start, reason
+            )
+        finally:
+            self.free_slots.put(slot)
+
+    def submit(self, cmd: Union[str, list[str]], cfg: dict, **kwargs) -> Future:
+        """Run a trial in the background. See `run` for the arguments.
+
+        Returns
+        -------
+        Future
+            The future of the `TrialResult`.
+        """
+        return self.executor.submit(self.run, cmd, cfg, **kwargs)
+
+    def close(self):
+        """Wait for the running trials and stop the executor."""
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
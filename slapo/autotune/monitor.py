@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Monitor the logs of running trials to stop them early.
+
+A trial is stopped as soon as its log shows an out-of-memory error or a
+crash, or when its throughput is stable but cannot beat the current best
+by a margin, so that the remaining steps are not wasted.
+"""
+from __future__ import annotations
+
+from typing import Callable, Optional
+
+from slapo.logger import get_logger
+
+logger = get_logger()
+
+
+class TrialMonitor:
+    """Monitor the logs of a trial with the incremental log parsers of a
+    framework dialect (see `slapo.framework_dialect.log_stream`). An instance
+    is used as the `monitor` of `TrialExecutor.run`.
+
+    Parameters
+    ----------
+    create_stream : Callable
+        The function to create an incremental log parser, e.g.,
+        `MegatronLogParser.create_stream`.
+    get_best_thrpt : Optional[Callable[[], float]]
+        The function that returns the current best throughput. If None, the
+        trials are only stopped by errors.
+    margin : float
+        The trial is stopped if its throughput times (1 + margin) is still
+        lower than the current best.
+    min_windows : int
+        The number of stable logging windows before comparing the throughput.
+    tolerance : float
+        The relative range of the throughputs to be considered stable.
+    """
+
+    def __init__(
+        self,
+        create_stream: Callable,
+        get_best_thrpt: Optional[Callable[[], float]] = None,
+        margin: float = 0.1,
+        min_windows: int = 3,
+        tolerance: float = 0.05,
+    ):
+        self.create_stream = create_stream
+        self.get_best_thrpt = get_best_thrpt
+        self.margin = margin
+        self.min_windows = min_windows
+        self.tolerance = tolerance
+        # The log parsers of each log file.
+        self.streams = {}
+        self.reason = None
+
+    def __call__(self, name: str, text: str) -> Optional[str]:
+        """Feed the new contents of a log file.
+
+        Parameters
+        ----------
+        name : str
+            The name of the log file.
+        text : str
+            The new contents.
+
+        Returns
+        -------
+        Optional[str]
+            The reason to stop the trial, or None to continue.
+        """
+        if name not in self.streams:
+            self.streams[name] = self.create_stream()
+        stream = self.streams[name]
+        stream.feed(text)
+        if stream.error_code == 1:
+            self.reason = "oom"
+        elif stream.error_code == 2:
+            self.reason = "crash"
+        elif self.get_best_thrpt is not None:
+            thrpt = stream.steady_thrpt(self.min_windows, self.tolerance)
+            best = self.get_best_thrpt()
+            if thrpt is not None and best > 0 and thrpt * (1 + self.margin) < best:
+                self.reason = f"slow ({thrpt:.2f} vs. best {best:.2f})"
+        return self.reason
+
+    def result(self) -> tuple[int, float]:
+        """The error code and the estimated throughput of the stopped trial,
+        where the error code is consistent with `parse_log`.
+        """
+        if self.reason == "oom":
+            return 1, 0.0
+        if self.reason == "crash":
+            return 2, 0.0
+        thrpt = max((stream.estimate() for stream in self.streams.values()), default=0)
+        return 0, thrpt
@@ -0,0 +1,384 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""The search strategies of the tuning space.
+
+A strategy explores a `Space`, whose symbols are created and constrained by
+the `update_space_fn` of the tuning config, and evaluates the configs with
+an `EvalCache`, which is shared by the strategies so that a config is never
+evaluated twice. New strategies can be registered by
+`register_search_strategy`.
+"""
+from __future__ import annotations
+
+import itertools
+import json
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from slapo.logger import get_logger
+
+logger = get_logger()
+
+SEARCH_STRATEGIES = {}
+
+
+def register_search_strategy(name):
+    """Register a search strategy."""
+
+    def decorator(strategy_cls):
+        if name in SEARCH_STRATEGIES:
+            raise ValueError(f"Search strategy {name} already registered")
+        SEARCH_STRATEGIES[name] = strategy_cls
+        return strategy_cls
+
+    return decorator
+
+
+def get_search_strategy(name, **kwargs):
+    """Create a registered search strategy with the given arguments."""
+    if name not in SEARCH_STRATEGIES:
+        raise ValueError(
+            f"Unknown search strategy {name}. Supported: {list(SEARCH_STRATEGIES)}"
+        )
+    return SEARCH_STRATEGIES[name](**kwargs)
+
+
+class EvalCache:
+    """Evaluate configs concurrently and cache their throughputs.
+
+    Parameters
+    ----------
+    eval_fn : Callable
+        The function that evaluates a config and returns its throughput,
+        where 0 means failure.
+    num_parallel : int
+        The number of configs to evaluate concurrently.
+    """
+
+    def __init__(self, eval_fn: Callable, num_parallel: int = 1):
+        self.eval_fn = eval_fn
+        self.num_parallel = num_parallel
+        self.results = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(cfg: dict) -> str:
+        return json.dumps(cfg, sort_keys=True, default=str)
+
+    def __contains__(self, cfg):
+        return self.get_key(cfg) in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def _eval(self, cfg):
+        logger.info("- Evaluating %s", str(cfg))
+        thrpt = self.eval_fn(cfg)
+        logger.info("\tThroughput of %s: %.2f", str(cfg), thrpt)
+        return thrpt
+
+    def __call__(self, cfgs: list[dict]) -> list[float]:
+        """Evaluate the configs that are not in the cache.
+
+        Parameters
+        ----------
+        cfgs : list[dict]
+            The configs.
+
+        Returns
+        -------
+        list[float]
+            The throughputs of the configs.
+        """
+        keys = [self.get_key(cfg) for cfg in cfgs]
+        pending = {}
+        for key, cfg in zip(keys, cfgs):
+            if key not in self.results:
+                pending.setdefault(key, cfg)
+        if self.num_parallel > 1 and len(pending) > 1:
+            with ThreadPoolExecutor(max_workers=self.num_parallel) as pool:
+                thrpts = list(pool.map(self._eval, pending.values()))
+        else:
+            thrpts = [self._eval(cfg) for cfg in pending.values()]
+        with self.lock:
+            self.results.update(zip(pending.keys(), thrpts))
+        return [self.results[key] for key in keys]
+
+
+class SearchStrategy:
+    """The base class of search strategies.
+
+    Parameters
+    ----------
+    seed : Optional[int]
+        The random seed.
+    """
+
+    def __init__(self, seed: Optional[int] = None):
+        self.rng = random.Random(seed)
+
+    def search(self, space, args, update_space_fn, evaluate: EvalCache):
+        """Search the space.
+
+        Parameters
+        ----------
+        space : Space
+            The tuning space with the initial symbols.
+        args : dict
+            The arguments of the training script.
+        update_space_fn : Callable
+            The function that updates the space after a symbol is fixed.
+        evaluate : EvalCache
+            The function to evaluate configs.
+
+        Returns
+        -------
+        tuple[dict, float]
+            The best config and its throughput.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def get_best(cfgs, thrpts, curr_best=({}, 0.0)):
+        """Get the config of the highest throughput."""
+        for cfg, thrpt in zip(cfgs, thrpts):
+            if thrpt > curr_best[1]:
+                curr_best = (cfg, thrpt)
+        return curr_best
+
+    def sample_unique(
+        self, space, args, update_space_fn, num, seen, parents=None, keep_prob=0.0
+    ):
+        """Sample configs not in `seen`, which is updated in place. If
+        parents are given, the configs are mutated from random parents.
+        See `Space.sample` for `keep_prob`.
+        """
+        cfgs = []
+        for _ in range(num * 10):
+            if len(cfgs) == num:
+                break
+            parent = self.rng.choice(parents) if parents else None
+            cfg = space.sample(
+                args,
+                update_space_fn,
+                self.rng,
+                parent=parent,
+                keep_prob=keep_prob,
+            )
+            if cfg is None or EvalCache.get_key(cfg) in seen:
+                continue
+            seen.add(EvalCache.get_key(cfg))
+            cfgs.append(cfg)
+        return cfgs
+
+
+@register_search_strategy("grid")
+class GridSearch(SearchStrategy):
+    """Evaluate all configs in the space."""
+
+    def search(self, space, args, update_space_fn, evaluate):
+        curr_best = ({}, 0.0)
+        configs = space.configs(args, update_space_fn)
+        while True:
+            cfgs = list(itertools.islice(configs, evaluate.num_parallel))
+            if not cfgs:
+                return curr_best
+            curr_best = self.get_best(cfgs, evaluate(cfgs), curr_best)
+
+
+@register_search_strategy("random")
+class RandomSearch(SearchStrategy):
+    """Evaluate the configs sampled uniformly at each symbol.
+
+    Parameters
+    ----------
+    num_trials : int
+        The number of configs to evaluate.
+    seed : Optional[int]
+        The random seed.
+    """
+
+    def __init__(self, num_trials: int = 16, seed: Optional[int] = None):
+        super().__init__(seed)
+        self.num_trials = num_trials
+
+    def search(self, space, args, update_space_fn, evaluate):
+        curr_best = ({}, 0.0)
+        seen = set()
+        remaining = self.num_trials
+        while remaining > 0:
+            num = min(remaining, evaluate.num_parallel)
+            cfgs = self.sample_unique(space, args, update_space_fn, num, seen)
+            if not cfgs:
+                # The space is exhausted.
+                break
+            curr_best = self.get_best(cfgs, evaluate(cfgs), curr_best)
+            remaining -= len(cfgs)
+        return curr_best
+
+
+@register_search_strategy("successive_halving")
+class SuccessiveHalving(SearchStrategy):
+    """Successive halving, which evaluates random configs with a small
+    resource (e.g., the number of training steps), and only promotes the
+    best 1/eta of them to the next rung with eta times the resource.
+
+    The resource is added to the configs as a tunable value, so the training
+    script can take it from the arguments or the environment variable like
+    the other symbols.
+
+    Parameters
+    ----------
+    num_configs : int
+        The number of configs in the first rung.
+    min_resource : int
+        The resource of the first rung.
+    max_resource : int
+        The resource of the last rung.
+    eta : int
+        The reduction factor.
+    resource : str
+        The name of the resource in the configs.
+    seed : Optional[int]
+        The random seed.
+    """
+
+    def __init__(
+        self,
+        num_configs: int = 27,
+        min_resource: int = 1,
+        max_resource: int = 27,
+        eta: int = 3,
+        resource: str = "steps",
+        seed: Optional[int] = None,
+    ):
+        super().__init__(seed)
+        if eta < 2 or min_resource > max_resource:
+            raise ValueError(
+                f"Invalid eta {eta} or resources [{min_resource}, {max_resource}]"
+            )
+        self.num_configs = num_configs
+        self.min_resource = min_resource
+        self.max_resource = max_resource
+        self.eta = eta
+        self.resource = resource
+
+    def run_rungs(self, cfgs, min_resource, evaluate):
+        """Run successive halving on the configs from the given resource.
+
+        Returns
+        -------
+        tuple[dict, float]
+            The best config at the maximum resource and its throughput.
+        """
+        resource = min_resource
+        while True:
+            trials = [dict(cfg, **{self.resource: resource}) for cfg in cfgs]
+            thrpts = evaluate(trials)
+            if resource >= self.max_resource:
+                return self.get_best(trials, thrpts)
+            ranked = sorted(zip(thrpts, range(len(cfgs))), key=lambda x: -x[0])
+            num_keep = max(len(cfgs) // self.eta, 1)
+            cfgs = [cfgs[idx] for thrpt, idx in ranked[:num_keep] if thrpt > 0]
+            if not cfgs:
+                return ({}, 0.0)
+            logger.info(
+                "Promoted %d configs from resource %s", len(cfgs), str(resource)
+            )
+            resource = min(resource * self.eta, self.max_resource)
+
+    def search(self, space, args, update_space_fn, evaluate):
+        cfgs = self.sample_unique(space, args, update_space_fn, self.num_configs, set())
+        return self.run_rungs(cfgs, self.min_resource, evaluate)
+
+
+@register_search_strategy("hyperband")
+class Hyperband(SuccessiveHalving):
+    """Hyperband, which runs successive halving in brackets of different
+    trade-offs between the number of configs and their minimum resources.
+    See `SuccessiveHalving` for the parameters, where `num_configs` is not
+    used.
+    """
+
+    def search(self, space, args, update_space_fn, evaluate):
+        curr_best = ({}, 0.0)
+        ratio = self.max_resource / self.min_resource
+        s_max = int(math.log(ratio, self.eta) + 1e-9)
+        seen = set()
+        for bracket in reversed(range(s_max + 1)):
+            num = math.ceil((s_max + 1) / (bracket + 1) * self.eta**bracket)
+            resource = max(self.max_resource // self.eta**bracket, self.min_resource)
+            logger.info(
+                "Hyperband bracket %d: %d configs from resource %d",
+                bracket,
+                num,
+                resource,
+            )
+            cfgs = self.sample_unique(space, args, update_space_fn, num, seen)
+            if not cfgs:
+                break
+            best = self.run_rungs(cfgs, resource, evaluate)
+            curr_best = self.get_best([best[0]], [best[1]], curr_best)
+        return curr_best
+
+
+@register_search_strategy("evolution")
+class EvolutionarySearch(SearchStrategy):
+    """An evolutionary search, which mutates the better half of the
+    population in each generation.
+
+    Parameters
+    ----------
+    population : int
+        The number of configs in a generation.
+    generations : int
+        The number of generations.
+    keep_prob : float
+        The probability that a symbol of a child keeps the parent value.
+    seed : Optional[int]
+        The random seed.
+    """
+
+    def __init__(
+        self,
+        population: int = 8,
+        generations: int = 4,
+        keep_prob: float = 0.7,
+        seed: Optional[int] = None,
+    ):
+        super().__init__(seed)
+        self.population = population
+        self.generations = generations
+        self.keep_prob = keep_prob
+
+    def search(self, space, args, update_space_fn, evaluate):
+        seen = set()
+        cfgs = self.sample_unique(space, args, update_space_fn, self.population, seen)
+        members = list(zip(evaluate(cfgs), range(len(cfgs)), cfgs))
+        curr_best = self.get_best(cfgs, [thrpt for thrpt, _, _ in members])
+        for gen in range(1, self.generations):
+            members.sort(key=lambda x: -x[0])
+            parents = [cfg for thrpt, _, cfg in members[: max(len(members) // 2, 1)]]
+            children = self.sample_unique(
+                space,
+                args,
+                update_space_fn,
+                self.population,
+                seen,
+                parents,
+                self.keep_prob,
+            )
+            if not children:
+                break
+            thrpts = evaluate(children)
+            curr_best = self.get_best(children, thrpts, curr_best)
+            offset = len(members)
+            members += list(
+                zip(thrpts, range(offset, offset + len(children)), children)
+            )
+            members = sorted(members, key=lambda x: -x[0])[: self.population]
+            logger.info("Generation %d: best throughput %.2f", gen, curr_best[1])
+        return curr_best
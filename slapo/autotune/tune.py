@@ -4,16 +4,24 @@
 """The module to tune schedules."""
 import argparse
 import copy
+import hashlib
 import importlib
 import json
 import os
 import pathlib
 import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from slapo.logger import get_logger
 from slapo.framework_dialect import get_dialect_cls
+from slapo.autotune.database import Database, get_hardware_fingerprint
+from slapo.autotune.executor import TrialExecutor, parse_slots
+from slapo.autotune.monitor import TrialMonitor
+from slapo.autotune.search import SEARCH_STRATEGIES, EvalCache, get_search_strategy
+from slapo.autotune.worker import InProcessEvaluator
 
 
 logger = get_logger()
@@ -143,23 +151,164 @@ class Space:
             ret += f"{k}: {v}{last_ch}"
         return ret
 
-    def log_space(self, training_script_args, update_space_fn):
-        """Print the tuning space for logging."""
+    @staticmethod
+    def cfg_str_to_dict(cfg_str):
+        """Convert a config string generated by `cfg_dict_to_str` back to a dict."""
+        cfg = {}
+        for item in cfg_str.strip("()").split(", "):
+            if ": " not in item:
+                continue
+            key, val = item.split(": ", 1)
+            try:
+                cfg[key] = int(val)
+            except ValueError:
+                try:
+                    cfg[key] = float(val)
+                except ValueError:
+                    cfg[key] = val
+        return cfg
+
+    def _walk(self, training_script_args, update_space_fn, prune_fn=None):
+        """Walk the configs in the space by depth-first search. Instead of
+        cloning the space at every branch, the symbols are fixed in place and
+        the space is restored from a shallow snapshot when backtracking.
+        Note that `update_space_fn` should not mutate the existing symbols
+        other than via `create_symbol`.
+
+        Yields
+        ------
+        Space
+            The space with all symbols fixed, which is only valid before
+            resuming the iteration.
+        """
+        space = Space()
+        space.space = {name: copy.copy(sym) for name, sym in self.space.items()}
+        space.idx_to_name = list(self.idx_to_name)
+        space.fixed_idx = self.fixed_idx
 
-        def _run(space, count=0):
+        def _run():
             symbol = space.next()
-            if symbol is not None:
-                for idx in range(len(symbol.vals)):
-                    symbol.fix_at(idx)
-                    space = update_space_fn(training_script_args, space)
-                    count = _run(space.clone(), count)
-                return count
+            if symbol is None:
+                yield space
+                return
+            snapshot = (dict(space.space), list(space.idx_to_name), space.fixed_idx)
+            for idx in range(len(symbol.vals)):
+                space.space = dict(snapshot[0])
+                space.idx_to_name = list(snapshot[1])
+                space.fixed_idx = snapshot[2]
+                symbol.fix_at(idx)
+                updated = update_space_fn(training_script_args, space)
+                if updated is not None and updated is not space:
+                    space.space = updated.space
+                    space.idx_to_name = updated.idx_to_name
+                    space.fixed_idx = updated.fixed_idx
+                if prune_fn is not None and not prune_fn(
+                    {
+                        sym.name: sym.value
+                        for sym in space.space.values()
+                        if sym.is_fixed()
+                    }
+                ):
+                    continue
+                yield from _run()
+            symbol.fixed_idx = -1
 
-            logger.info("\t%s", self.cfg_dict_to_str(space.to_dict()))
-            return count + 1
+        yield from _run()
+
+    def configs(
+        self,
+        training_script_args,
+        update_space_fn,
+        prune_fn=None,
+        num_shards=1,
+        shard_idx=0,
+    ):
+        """Lazily enumerate the configs in the space. The constraints in
+        `update_space_fn` are applied whenever a symbol is fixed, and a
+        symbol without any valid value prunes its subspace.
+
+        Parameters
+        ----------
+        training_script_args : dict
+            The arguments of the training script.
+        update_space_fn : Callable
+            The function that updates the space after a symbol is fixed.
+        prune_fn : Optional[Callable]
+            The function that takes the values of the fixed symbols and
+            returns False to prune the subspace.
+        num_shards : int
+            The number of shards to split the configs, e.g., for workers.
+        shard_idx : int
+            The shard to enumerate, whose configs are every `num_shards`-th
+            config starting from `shard_idx`.
+
+        Yields
+        ------
+        dict
+            A config with all symbols fixed.
+        """
+        if not 0 <= shard_idx < num_shards:
+            raise ValueError(f"Invalid shard {shard_idx} of {num_shards} shards")
+        for idx, space in enumerate(
+            self._walk(training_script_args, update_space_fn, prune_fn)
+        ):
+            if idx % num_shards == shard_idx:
+                yield space.to_dict()
+
+    def count(self, training_script_args, update_space_fn, prune_fn=None):
+        """Count the configs in the space without materializing them. See
+        `configs` for the arguments.
+        """
+        return sum(
+            1 for _ in self._walk(training_script_args, update_space_fn, prune_fn)
+        )
+
+    def sample(
+        self, training_script_args, update_space_fn, rng, parent=None, keep_prob=0.0
+    ):
+        """Sample a config in the space by fixing the symbols one by one
+        at random values.
+
+        Parameters
+        ----------
+        training_script_args : dict
+            The arguments of the training script.
+        update_space_fn : Callable
+            The function that updates the space after a symbol is fixed.
+        rng : random.Random
+            The random number generator.
+        parent : Optional[dict]
+            The config to mutate. Each symbol keeps its value in the parent
+            with the probability `keep_prob` if the value is still valid.
+        keep_prob : float
+            The probability to keep the value of the parent.
+
+        Returns
+        -------
+        Optional[dict]
+            The config, or None if a symbol has no valid value.
+        """
+        space = self.clone()
+        while True:
+            symbol = space.next()
+            if symbol is None:
+                return space.to_dict()
+            if not symbol.vals:
+                return None
+            val = (parent or {}).get(symbol.name, None)
+            if val in symbol.vals and rng.random() < keep_prob:
+                symbol.fix_at(symbol.vals.index(val))
+            else:
+                symbol.fix_at(rng.randrange(len(symbol.vals)))
+            space = update_space_fn(training_script_args, space)
 
+    def log_space(self, training_script_args, update_space_fn):
+        """Print the tuning space for logging."""
         logger.info("Enumerating the search space:")
-        count = _run(self.clone())
+        count = 0
+        for cfg in self.configs(training_script_args, update_space_fn):
+            logger.info("\t%s", self.cfg_dict_to_str(cfg))
+            count += 1
         logger.info("Space size: %d", count)
 
     def __repr__(self):
@@ -172,32 +321,6 @@ class Space:
         return ret
 
 
-class Database:
-    """A simple database to store the results of tuning in Dict."""
-
-    def __init__(self, db_file_name=None):
-        self.db_file_name = db_file_name
-        self.db = {}
-        if self.db_file_name:
-            logger.info("Tuning records will be saved to %s", self.db_file_name)
-
-    def load(self):
-        """Load the database from the file."""
-        if self.db_file_name and os.path.exists(self.db_file_name):
-            with open(self.db_file_name, "r", encoding="utf-8") as filep:
-                self.db = json.load(filep)
-            logger.info(
-                "Loaded %d tuning records from %s", len(self.db), self.db_file_name
-            )
-
-    def commit(self, key, data):
-        """Commit the data to the database and update the DB file."""
-        self.db[key] = data
-        if self.db_file_name:
-            with open(self.db_file_name, "w", encoding="utf-8") as filep:
-                json.dump(self.db, filep, indent=2)
-
-
 def parse_args():
     parser = argparse.ArgumentParser("Auto-Tuning for Model Schedule")
     parser.add_argument(
@@ -209,7 +332,8 @@ def parse_args():
     parser.add_argument(
         "--db",
         type=str,
-        help="The file path to store tuning records in JSON format",
+        help="The SQLite file to store tuning records. The configs already "
+        "evaluated on the same hardware and workload are skipped",
     )
     parser.add_argument(
         "--error-stop",
@@ -218,6 +342,91 @@ def parse_args():
         choices=["none", "symbol", "all"],
         help="When error occurs, either stop tuning the current symbol or all symbols",
     )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        help="Only evaluate the top-k candidates predicted by the cost model, "
+        "which is created by 'get_cost_model(args)' in the config file and "
+        "calibrated by the existing records in the database. If the config "
+        "file does not define it, the binary search is used",
+    )
+    parser.add_argument(
+        "--search",
+        type=str,
+        default="binary",
+        choices=["binary"] + list(SEARCH_STRATEGIES),
+        help="The search strategy. 'binary' searches the batch size and checkpoint "
+        "ratio by 'get_bs_range' in the config file, and the others search the "
+        "space created by 'update_space(args, space)' in the config file",
+    )
+    parser.add_argument(
+        "--search-args",
+        type=str,
+        default="{}",
+        help="The arguments of the search strategy in JSON, e.g., "
+        '\'{"num_trials": 32, "seed": 0}\'',
+    )
+    parser.add_argument(
+        "--early-stop",
+        action="store_true",
+        help="Monitor the logs of the running trials, and stop a trial as soon as "
+        "it runs out of memory or crashes, or its throughput is stable but "
+        "cannot beat the current best by --early-stop-margin",
+    )
+    parser.add_argument(
+        "--early-stop-margin",
+        type=float,
+        default=0.1,
+        help="The trial is stopped if its throughput times (1 + margin) is "
+        "lower than the current best",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Evaluate the trials in long-lived worker processes by "
+        "'get_eval_fn(args)' in the config file, which is called once per worker "
+        "and returns 'eval_fn(cfg)' that returns a training step and its batch "
+        "size. The training script is not launched, and a worker is recycled "
+        "after out-of-memory errors",
+    )
+    parser.add_argument(
+        "--warmup-steps",
+        type=int,
+        default=3,
+        help="The number of warmup steps of a trial with --in-process",
+    )
+    parser.add_argument(
+        "--timed-steps",
+        type=int,
+        default=10,
+        help="The number of timed steps of a trial with --in-process",
+    )
+    parser.add_argument(
+        "--slots",
+        type=str,
+        help="The resource slots separated by semicolons to run trials "
+        "concurrently, e.g., '0,1;2,3;4,5;6,7' for 4 trials of 2 GPUs each. "
+        "Each slot is exposed to its trial by --slot-env",
+    )
+    parser.add_argument(
+        "--slot-env",
+        type=str,
+        default="CUDA_VISIBLE_DEVICES",
+        help="The environment variable to expose a slot to a trial",
+    )
+    parser.add_argument(
+        "--trial-timeout",
+        type=float,
+        help="The wall-clock timeout in seconds of a trial",
+    )
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        default="tune_trials",
+        help="The directory of the working directories of the trials. Note that "
+        "the relative paths in the training script arguments are resolved "
+        "in the working directory of each trial",
+    )
     parser.add_argument(
         "training_script",
         type=str,
@@ -272,8 +481,8 @@ def convert_nargs_to_dict(nargs):
     return ret
 
 
-def run_training_script(args, tuneable_cfg):
-    """Run the training script with the given config."""
+def make_training_command(args, tuneable_cfg):
+    """Make the command to run the training script with the given config."""
     train_script_args = " ".join(args.training_script_args)
 
     # Replace tunable values in training script arguments.
@@ -283,19 +492,47 @@ def run_training_script(args, tuneable_cfg):
     # Set all tunable parameters as environment variables.
     env = " ".join(f"{k}={v}" for k, v in tuneable_cfg.items())
 
-    cmd = f"{env} python3 {args.training_script} {train_script_args}"
-    cmd += " > run_script.log 2>&1"
-    logger.info("\tRunning command: %s", cmd)
-    os.system(cmd)
-    return "run_script.log"
-
-
-def tune(args, get_bs_range, eval_fn):
-    """Tune the given space with an evaluation function."""
+    # The script may run in another working directory.
+    training_script = os.path.abspath(args.training_script)
+    return f"{env} python3 {training_script} {train_script_args}"
+
+
+def tune(args, get_bs_range, eval_fn, cost_model=None, top_k=None, num_parallel=1):
+    """Tune the given space with an evaluation function.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+    get_bs_range : Callable
+        The function that returns the minimum and maximum batch sizes and
+        the step given the training script arguments.
+    eval_fn : Callable
+        The function that evaluates a config and returns its throughput.
+    cost_model : Optional[CostModel]
+        The cost model to order and prune the candidates. If given, only
+        the top-k candidates predicted by the model are evaluated instead
+        of the binary search.
+    top_k : Optional[int]
+        The number of candidates to evaluate with the cost model.
+    num_parallel : int
+        The number of configs to evaluate concurrently, where `eval_fn` is
+        called from multiple threads. The binary search becomes a k-ary
+        search that evaluates `num_parallel` points in each round.
+
+    Returns
+    -------
+    dict
+        The best config.
+    """
     training_script_args = convert_nargs_to_dict(args.training_script_args)
     min_bs, max_bs, step = get_bs_range(training_script_args)
     bs_range = list(range(min_bs, max_bs + 1, step))
     ckpt_ratio_range = [1.0, 0.92, 0.84, 0.67, 0.5, 0.34, 0.25]
+    is_slapo = (
+        "slapo-megatron" in training_script_args
+        or "slapo-deepspeed" in training_script_args
+    )
     early_stopping_patience = 0
 
     def is_valid(config):
@@ -305,49 +542,71 @@ def tune(args, get_bs_range, eval_fn):
             return config["batch_size"] % int(training_script_args["gpus"]) == 0
         return True
 
+    def evaluate(cfgs):
+        """Evaluate the configs concurrently and return their throughputs."""
+
+        def _eval(cfg):
+            logger.info("- Evaluating %s", str(cfg))
+            # early pruning
+            if is_valid(cfg):
+                return eval_fn(cfg)
+            logger.info(
+                "Invalid configuration point %s, n_gpu=%s",
+                str(cfg),
+                training_script_args["gpus"],
+            )
+            return 0.0
+
+        if num_parallel > 1 and len(cfgs) > 1:
+            with ThreadPoolExecutor(max_workers=num_parallel) as pool:
+                return list(pool.map(_eval, cfgs))
+        return [_eval(cfg) for cfg in cfgs]
+
     def binary_search(data, cfg_dict, key, curr_best, lt=0, rt=None):
         nonlocal early_stopping_patience
         logger.info("Binary searching %s without OOM", key)
         if rt is None:
             rt = len(data) - 1
+        thrpt = 0.0
         while lt <= rt:
-            mid = (lt + rt) // 2
-            cfg_dict[key] = data[mid]
-            logger.info("- Evaluating %s", str(cfg_dict))
-            # early pruning
-            if is_valid(cfg_dict):
-                thrpt = eval_fn(cfg_dict)
-            else:
-                thrpt = 0.0
-                logger.info(
-                    "Invalid configuration point %s, n_gpu=%s",
-                    str(cfg_dict),
-                    training_script_args["gpus"],
-                )
+            # Evaluate evenly spaced points in [lt, rt] concurrently, which is
+            # the midpoint of the binary search with one point.
+            num_points = min(num_parallel, rt - lt + 1)
+            mids = sorted(
+                {
+                    lt + (rt - lt) * (idx + 1) // (num_points + 1)
+                    for idx in range(num_points)
+                }
+            )
+            cfgs = [dict(cfg_dict, **{key: data[mid]}) for mid in mids]
+            cfg_dict[key] = data[mids[-1]]
+            thrpts = evaluate(cfgs)
             time.sleep(0.5)
-            logger.info("\tThroughput: %.2f", thrpt)
-            # TODO: threshold should be a larger value used for pruning
-            # maybe provide an interface for the users
-            if thrpt < 0.01:
-                rt = mid - 1
-            else:
-                lt = mid + 1
-            if thrpt > curr_best[1]:
-                curr_best = (cfg_dict.copy(), thrpt)
-                early_stopping_patience = 0
-            else:
-                early_stopping_patience += 1
-            # set step 5 as the patience
-            if early_stopping_patience >= 5:
-                return mid, None, curr_best
+            next_lt, next_rt = lt, rt
+            for mid, cfg, thrpt in zip(mids, cfgs, thrpts):
+                logger.info("\tThroughput of %s: %.2f", str(cfg), thrpt)
+                # TODO: threshold should be a larger value used for pruning
+                # maybe provide an interface for the users
+                if thrpt < 0.01:
+                    next_rt = min(next_rt, mid - 1)
+                else:
+                    next_lt = max(next_lt, mid + 1)
+                if thrpt > curr_best[1]:
+                    curr_best = (cfg.copy(), thrpt)
+                    early_stopping_patience = 0
+                else:
+                    early_stopping_patience += 1
+                # set step 5 as the patience
+                if early_stopping_patience >= 5:
+                    return mid, None, curr_best
+            lt, rt = next_lt, next_rt
             logger.info(
                 "\tCurrent best config: %s, thrpt: %.2f",
                 str(curr_best[0]),
                 curr_best[1],
             )
-        if thrpt < 0.01:
-            mid = mid - 1
-        return mid, thrpt, curr_best
+        # The largest index without OOM.
+        return rt, thrpt, curr_best
 
     def _run(min_bs, max_bs, step):
         if "megatron" in training_script_args:
@@ -369,10 +628,7 @@ def tune(args, get_bs_range, eval_fn):
         else:
             mid = 0
         logger.info("Maximum batch size without OOM: %d", max_bs)
-        if (
-            "slapo-megatron" in training_script_args
-            or "slapo-deepspeed" in training_script_args
-        ):
+        if is_slapo:
             for bs in reversed(list(range(min_bs, max_bs + 1, step))):
                 cfg_dict["batch_size"] = bs
                 mid, thrpt, curr_best = binary_search(
@@ -382,12 +638,92 @@ def tune(args, get_bs_range, eval_fn):
                     break
         return curr_best
 
+    def _run_with_cost_model():
+        if is_slapo:
+            ckpt_ratios = ckpt_ratio_range
+        else:
+            ckpt_ratios = ["full" if "megatron" in training_script_args else 1.0]
+        candidates = [
+            {"batch_size": bs, "ckpt_ratio": ckpt_ratio}
+            for bs in bs_range
+            for ckpt_ratio in ckpt_ratios
+        ]
+        candidates = [cfg for cfg in candidates if is_valid(cfg)]
+        selected = cost_model.rank(candidates, top_k)
+        logger.info(
+            "Evaluating %d of %d candidates ranked by the cost model",
+            len(selected),
+            len(candidates),
+        )
+        curr_best = ({}, 0.0)
+        for cfg_dict, thrpt in zip(selected, evaluate(selected)):
+            logger.info(
+                "\tThroughput of %s: %.2f (predicted: %.2f)",
+                str(cfg_dict),
+                thrpt,
+                cost_model.predict_thrpt(cfg_dict),
+            )
+            if thrpt > curr_best[1]:
+                curr_best = (cfg_dict.copy(), thrpt)
+        return curr_best
+
     logger.info("Start tuning...")
-    curr_best = _run(min_bs, max_bs, step)
+    if cost_model is not None:
+        curr_best = _run_with_cost_model()
+    else:
+        curr_best = _run(min_bs, max_bs, step)
     logger.info("Tuning done!")
     return curr_best[0]
 
 
+def tune_space(args, update_space_fn, eval_fn, strategy, num_parallel=1, cache=None):
+    """Tune the space defined by `update_space_fn` with a search strategy.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+    update_space_fn : Callable
+        The function that takes the training script arguments and the space,
+        and creates or updates the symbols according to the fixed ones. It
+        is called with an empty space first to create the initial symbols.
+    eval_fn : Callable
+        The function that evaluates a config and returns its throughput.
+    strategy : SearchStrategy
+        The search strategy, e.g., `get_search_strategy("hyperband")`.
+    num_parallel : int
+        The number of configs to evaluate concurrently.
+    cache : Optional[EvalCache]
+        The evaluation cache shared with other searches. If None, a new
+        cache is created.
+
+    Returns
+    -------
+    dict
+        The best config.
+    """
+    training_script_args = convert_nargs_to_dict(args.training_script_args)
+    space = update_space_fn(training_script_args, Space())
+    if cache is None:
+        cache = EvalCache(eval_fn, num_parallel)
+    logger.info("Start tuning with %s...", type(strategy).__name__)
+    curr_best = strategy.search(space, training_script_args, update_space_fn, cache)
+    logger.info(
+        "Tuning done with %d evaluations! Best throughput: %.2f",
+        len(cache),
+        curr_best[1],
+    )
+    return curr_best[0]
+
+
+def get_workload_fingerprint(args):
+    """The fingerprint of the training script and its arguments."""
+    workload = " ".join(
+        [os.path.basename(args.training_script)] + args.training_script_args
+    )
+    return hashlib.sha1(workload.encode("utf-8")).hexdigest()
+
+
 def load_config(config_file):
     """Load required functions from the tuning config."""
     path = pathlib.Path(config_file).absolute()
@@ -398,48 +734,182 @@ def load_config(config_file):
     return module.get_bs_range
 
 
+def load_update_space(config_file):
+    """Load the function that updates the tuning space from the tuning config."""
+    path = pathlib.Path(config_file).absolute()
+    sys.path.append(str(path.parent))
+    module = importlib.import_module(path.stem)
+    if not hasattr(module, "update_space"):
+        raise ValueError("Missing 'update_space' function in config file")
+    return module.update_space
+
+
+def load_cost_model(config_file, training_script_args):
+    """Load the cost model from the tuning config, which defines
+    `get_cost_model(args)` that returns a `CostModel` of the model, e.g.,
+    with the layer profile from `LayerProfile.from_schedule`. Return None if
+    it is not defined, since a cost model without the costs of the model
+    cannot rank the candidates.
+    """
+    path = pathlib.Path(config_file).absolute()
+    sys.path.append(str(path.parent))
+    module = importlib.import_module(path.stem)
+    if not hasattr(module, "get_cost_model"):
+        logger.warning(
+            "Missing 'get_cost_model' function in config file. "
+            "Fall back to the binary search without the cost model"
+        )
+        return None
+    return module.get_cost_model(training_script_args)
+
+
+def get_log_parser(args):
+    """Get the log parser of the framework in the training script arguments."""
+    if "slapo-megatron" in args or "megatron" in args:
+        return get_dialect_cls("log_parser", "megatron")
+    if "slapo-deepspeed" in args or "deepspeed" in args:
+        return get_dialect_cls("log_parser", "deepspeed")
+    raise RuntimeError("Please provide correct `impl`")
+
+
 def parse_log(args, log_file):
     with open(log_file, "r", encoding="utf-8") as f:
         text = f.read()
 
-    if "slapo-megatron" in args or "megatron" in args:
-        parser = get_dialect_cls("log_parser", "megatron")
-        _, samples_per_sec, _, error_code = parser.parse_log(log_file)
-    elif "slapo-deepspeed" in args or "deepspeed" in args:
-        parser = get_dialect_cls("log_parser", "deepspeed")
-        _, samples_per_sec, _, error_code = parser.parse_log(log_file)
-    else:
-        raise RuntimeError("Please provide correct `impl`")
+    parser = get_log_parser(args)
+    _, samples_per_sec, _, error_code = parser.parse_log(log_file)
     return (error_code, samples_per_sec, text)
 
 
 def main():
     """Entry point."""
     args = parse_args()
-    get_bs_range = load_config(args.config)
-    db = Database(args.db)
+    training_script_args = convert_nargs_to_dict(args.training_script_args)
+    db = Database(
+        args.db,
+        model=str(
+            training_script_args.get("model", os.path.basename(args.training_script))
+        ),
+        hardware=get_hardware_fingerprint(),
+        workload=get_workload_fingerprint(args),
+    )
+    db.load()
+    cost_model = None
+    if args.top_k is not None:
+        cost_model = load_cost_model(
+            args.config, convert_nargs_to_dict(args.training_script_args)
+        )
+        if cost_model is not None:
+            cost_model.calibrate(db.get_results())
+
+    slots = parse_slots(args.slots) if args.slots else None
+    if args.in_process:
+        executor = InProcessEvaluator(
+            args.config,
+            training_script_args,
+            slots,
+            num_warmup=args.warmup_steps,
+            num_steps=args.timed_steps,
+            timeout=args.trial_timeout,
+            slot_env=args.slot_env,
+        )
+    else:
+        executor = TrialExecutor(
+            slots,
+            timeout=args.trial_timeout,
+            workdir=args.workdir,
+            slot_env=args.slot_env,
+        )
+
+    best_thrpt = 0.0
+    best_lock = threading.Lock()
 
     def eval_fn(cfg):
-        log_file = run_training_script(args, cfg)
-        error_code, thrpt, memo = parse_log(
-            convert_nargs_to_dict(args.training_script_args), "log.txt"
-        )
-        with open(log_file, "r", encoding="utf-8") as filep:
-            log_file_ctx = filep.read()
+        nonlocal best_thrpt
+        record = db.lookup(Space.cfg_dict_to_str(cfg))
+        if record is not None:
+            logger.info("\tSkipped the evaluated config: %s", record["config"])
+            if record["error_code"] != 0:
+                return 0
+            with best_lock:
+                best_thrpt = max(best_thrpt, record["thrpt"])
+            return record["thrpt"]
+        if args.in_process:
+            error_code, thrpt, log_file_ctx = executor(cfg)
+            memo = "Timeout" if error_code == 3 else ""
+        else:
+            error_code, thrpt, log_file_ctx, memo = run_trial(cfg)
         db.commit(
             Space.cfg_dict_to_str(cfg),
             {
+                "config": cfg,
                 "error_code": error_code,
                 "thrpt": thrpt,
                 "log": log_file_ctx,
                 "memo": memo,
             },
         )
+        if error_code == 0:
+            with best_lock:
+                best_thrpt = max(best_thrpt, thrpt)
         if args.error_stop == "all" and error_code != 0:
             raise ValueError("Stop tuning due to error. Check log for details")
         return thrpt if error_code == 0 else 0
 
-    curr_best = tune(args, get_bs_range, eval_fn)
+    def run_trial(cfg):
+        """Run the training script and return the error code, throughput,
+        log and memo.
+        """
+        monitor = None
+        if args.early_stop:
+            monitor = TrialMonitor(
+                get_log_parser(training_script_args).create_stream,
+                lambda: best_thrpt,
+                margin=args.early_stop_margin,
+            )
+        result = executor.run(
+            make_training_command(args, cfg),
+            cfg,
+            monitor=monitor,
+            # The training script may write its own log in the working directory.
+            monitor_files=["run_script.log", "log.txt"],
+        )
+        with open(result.log_file, "r", encoding="utf-8") as filep:
+            log_file_ctx = filep.read()
+        if result.timed_out:
+            error_code, thrpt, memo = 3, 0, "Timeout"
+        elif result.stop_reason is not None:
+            error_code, thrpt = monitor.result()
+            memo = f"Stopped early: {result.stop_reason}"
+        else:
+            # The training script may write its own log in the working directory.
+            log_file = os.path.join(result.workdir, "log.txt")
+            if not os.path.exists(log_file):
+                log_file = result.log_file
+            error_code, thrpt, memo = parse_log(
+                convert_nargs_to_dict(args.training_script_args), log_file
+            )
+        return error_code, thrpt, log_file_ctx, memo
+
+    with executor:
+        if args.search == "binary":
+            curr_best = tune(
+                args,
+                load_config(args.config),
+                eval_fn,
+                cost_model,
+                args.top_k,
+                num_parallel=executor.num_slots,
+            )
+        else:
+            strategy = get_search_strategy(args.search, **json.loads(args.search_args))
+            curr_best = tune_space(
+                args,
+                load_update_space(args.config),
+                eval_fn,
+                strategy,
+                num_parallel=executor.num_slots,
+            )
     logger.info("Best config: %s", curr_best)
 
 
@@ -0,0 +1,432 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Evaluate tuning trials in long-lived worker processes.
+
+Instead of launching the training script for every trial, a worker group
+imports the tuning config once, initializes the process group once, and
+calls `get_eval_fn(args)` of the config once, so that the model can be
+created and traced a single time and cached by the returned `eval_fn`.
+Each trial then calls `eval_fn(cfg)`, which applies the config (e.g., the
+batch size and the checkpoint ratio) and returns a training step, and the
+worker runs a fixed number of warmup and timed steps. A worker group is
+recycled after an out-of-memory error or a timeout, because the device
+memory or the collectives may be left in a broken state.
+
+.. code-block:: python
+
+    # In the tuning config.
+    def get_eval_fn(args):
+        model = build_and_trace_model(args)  # Only once per worker.
+
+        def eval_fn(cfg):
+            sch_model, optimizer = apply_config(model, cfg)
+
+            def step():
+                loss = sch_model(*make_inputs(cfg["batch_size"]))
+                loss.backward()
+                optimizer.step()
+
+            return step, cfg["batch_size"]
+
+        return eval_fn
+"""
+from __future__ import annotations
+
+import importlib
+import multiprocessing as mp
+import os
+import pathlib
+import queue
+import socket
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Optional
+
+from slapo.logger import get_logger
+
+logger = get_logger()
+
+
+def get_free_port() -> int:
+    """Get a free TCP port on this node."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def is_oom_error(exc: BaseException) -> bool:
+    """Whether the exception is an out-of-memory error."""
+    # pylint: disable=import-outside-toplevel
+    import torch
+
+    oom_cls = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_cls is not None and isinstance(exc, oom_cls):
+        return True
+    return isinstance(exc, (RuntimeError, MemoryError)) and "out of memory" in str(exc)
+
+
+def measure_thrpt(
+    step_fn: Callable, batch_size: int, num_warmup: int = 3, num_steps: int = 10
+) -> float:
+    """Measure the throughput of a training step.
+
+    Parameters
+    ----------
+    step_fn : Callable
+        The function that runs a training step.
+    batch_size : int
+        The number of samples of a training step.
+    num_warmup : int
+        The number of warmup steps that are not timed.
+    num_steps : int
+        The number of timed steps.
+
+    Returns
+    -------
+    float
+        The throughput in samples per second.
+    """
+    # pylint: disable=import-outside-toplevel
+    import torch
+
+    def sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    for _ in range(num_warmup):
+        step_fn()
+    sync()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        step_fn()
+    sync()
+    return batch_size * num_steps / max(time.perf_counter() - start, 1e-9)
+
+
+def load_eval_fn_factory(config_file: str) -> Callable:
+    """Load `get_eval_fn` from the tuning config."""
+    path = pathlib.Path(config_file).absolute()
+    if str(path.parent) not in sys.path:
+        sys.path.append(str(path.parent))
+    module = importlib.import_module(path.stem)
+    if not hasattr(module, "get_eval_fn"):
+        raise ValueError("Missing 'get_eval_fn' function in config file")
+    return module.get_eval_fn
+
+
+def _worker_main(rank, world_size, init_method, config_file, args, env, conn):
+    """The loop of a worker process, which receives configs and replies
+    (error_code, thrpt, log) until it receives None.
+    """
+    # pylint: disable=import-outside-toplevel
+    os.environ.update(env)
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(world_size))
+    try:
+        import torch
+        import torch.distributed as dist
+
+        if torch.cuda.is_available():
+            torch.cuda.set_device(rank % torch.cuda.device_count())
+        if not dist.is_initialized():
+            dist.init_process_group(
+                "nccl" if torch.cuda.is_available() else "gloo",
+                init_method=init_method,
+                rank=rank,
+                world_size=world_size,
+            )
+        eval_fn = load_eval_fn_factory(config_file)(args)
+    except Exception:  # pylint: disable=broad-except
+        conn.send((2, 0.0, traceback.format_exc()))
+        return
+    conn.send((0, 0.0, ""))
+
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        cfg, num_warmup, num_steps = msg
+        try:
+            step_fn, batch_size = eval_fn(cfg)
+            thrpt = measure_thrpt(step_fn, batch_size, num_warmup, num_steps)
+            conn.send((0, thrpt, ""))
+        except Exception as exc:  # pylint: disable=broad-except
+            error_code = 1 if is_oom_error(exc) else 2
+            conn.send((error_code, 0.0, traceback.format_exc()))
+            if error_code == 1:
+                # The parent recycles this worker after OOM.
+                break
+        finally:
+            step_fn = None
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+class WorkerGroup:
+    """A group of long-lived worker processes that evaluate trials together,
+    one process per device of a slot.
+
+    Parameters
+    ----------
+    config_file : str
+        The tuning config that defines `get_eval_fn(args)`.
+    args : dict
+        The arguments passed to `get_eval_fn`.
+    slot : Optional[str]
+        The devices of the group, e.g., "0,1", which are exposed by
+        `slot_env`. If None, the group has one process.
+    slot_env : str
+        The environment variable to expose the slot.
+    mp_context : str
+        The start method of the processes.
+    """
+
+    def __init__(
+        self,
+        config_file: str,
+        args: dict,
+        slot: Optional[str] = None,
+        slot_env: str = "CUDA_VISIBLE_DEVICES",
+        mp_context: str = "spawn",
+    ):
+        self.config_file = str(pathlib.Path(config_file).absolute())
+        self.args = args
+        self.slot = slot
+        self.slot_env = slot_env
+        self.ctx = mp.get_context(mp_context)
+        self.world_size = len(slot.split(",")) if slot else 1
+        self.procs = []
+        self.conns = []
+        # Whether some ranks did not reply the last trial.
+        self.broken = False
+
+    @property
+    def alive(self) -> bool:
+        return (
+            bool(self.procs)
+            and not self.broken
+            and all(proc.is_alive() for proc in self.procs)
+        )
+
+    def start(self, timeout: Optional[float] = None) -> tuple[int, str]:
+        """Start the processes and wait for the initialization.
+
+        Returns
+        -------
+        tuple[int, str]
+            The error code and the log.
+        """
+        env = {self.slot_env: self.slot} if self.slot is not None else {}
+        init_method = f"tcp://127.0.0.1:{get_free_port()}"
+        for rank in range(self.world_size):
+            parent_conn, child_conn = self.ctx.Pipe()
+            proc = self.ctx.Process(
+                target=_worker_main,
+                args=(
+                    rank,
+                    self.world_size,
+                    init_method,
+                    self.config_file,
+                    self.args,
+                    env,
+                    child_conn,
+                ),
+                daemon=True,
+            )
+            proc.start()
+            child_conn.close()
+            self.procs.append(proc)
+            self.conns.append(parent_conn)
+        return self._gather(timeout)
+
+    def _gather(self, timeout, grace=5.0):
+        """Gather the replies of all ranks. After the first error, the other
+        ranks are only waited for a grace period, since they may hang in the
+        collectives, and the group is marked broken if they do not reply.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        replies = [None] * len(self.conns)
+        error = None
+        while any(reply is None for reply in replies):
+            for rank, conn in enumerate(self.conns):
+                if replies[rank] is not None:
+                    continue
+                try:
+                    if not conn.poll(0.1):
+                        if not self.procs[rank].is_alive():
+                            self.broken = True
+                            return error or (2, f"Worker {rank} exited unexpectedly")
+                        continue
+                    replies[rank] = conn.recv()
+                except (EOFError, OSError):
+                    self.broken = True
+                    return error or (2, f"Worker {rank} exited unexpectedly")
+                if replies[rank][0] != 0 and error is None:
+                    error = (replies[rank][0], replies[rank][2])
+                    if deadline is None or deadline > time.time() + grace:
+                        deadline = time.time() + grace
+            if deadline is not None and time.time() >= deadline:
+                self.broken = True
+                return error or (3, "Timeout")
+        return error or (0, replies[0][1])
+
+    def run(
+        self,
+        cfg: dict,
+        num_warmup: int = 3,
+        num_steps: int = 10,
+        timeout: Optional[float] = None,
+    ) -> tuple[int, float, str]:
+        """Evaluate a config on all ranks.
+
+        Returns
+        -------
+        tuple[int, float, str]
+            The error code consistent with `parse_log`, the throughput of
+            rank 0, and the log of the error if any.
+        """
+        for conn in self.conns:
+            conn.send((cfg, num_warmup, num_steps))
+        error_code, ret = self._gather(timeout)
+        if error_code != 0:
+            return error_code, 0.0, ret
+        return 0, ret, ""
+
+    def stop(self, force: bool = False):
+        """Stop the processes gracefully, or kill them if they hang or
+        `force` is True.
+        """
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for proc in self.procs:
+            proc.join(timeout=0 if force else 5)
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+        for conn in self.conns:
+            conn.close()
+        self.procs = []
+        self.conns = []
+        self.broken = False
+
+
+class InProcessEvaluator:
+    """Evaluate trials with `eval_fn` of the tuning config in long-lived
+    worker groups, one per resource slot, so the trials do not pay for
+    importing the frameworks, tracing the model, and initializing the
+    process groups. A worker group is recycled after an out-of-memory
+    error, a crash of a process, or a timeout.
+
+    .. code-block:: python
+
+        with InProcessEvaluator("tune_cfg.py", args, ["0,1", "2,3"]) as ev:
+            error_code, thrpt, log = ev({"batch_size": 16, "ckpt_ratio": 0.5})
+
+    Parameters
+    ----------
+    config_file : str
+        The tuning config that defines `get_eval_fn(args)`.
+    args : dict
+        The arguments passed to `get_eval_fn`.
+    slots : Optional[list[str]]
+        The resource slots, e.g., ["0,1", "2,3"]. A trial holds a slot while
+        running. If None, there is one slot of one process.
+    num_warmup : int
+        The number of warmup steps of a trial.
+    num_steps : int
+        The number of timed steps of a trial.
+    timeout : Optional[float]
+        The wall-clock timeout in seconds of a trial.
+    slot_env : str
+        The environment variable to expose a slot to a worker group.
+    mp_context : str
+        The start method of the worker processes.
+    """
+
+    def __init__(
+        self,
+        config_file: str,
+        args: dict,
+        slots: Optional[list[str]] = None,
+        num_warmup: int = 3,
+        num_steps: int = 10,
+        timeout: Optional[float] = None,
+        slot_env: str = "CUDA_VISIBLE_DEVICES",
+        mp_context: str = "spawn",
+    ):
+        self.num_warmup = num_warmup
+        self.num_steps = num_steps
+        self.timeout = timeout
+        self.groups = queue.Queue()
+        self.all_groups = [
+            WorkerGroup(config_file, args, slot, slot_env, mp_context)
+            for slot in slots or [None]
+        ]
+        for group in self.all_groups:
+            self.groups.put(group)
+        self.lock = threading.Lock()
+        # The number of started worker groups, including the recycled ones.
+        self.num_starts = 0
+
+    @property
+    def num_slots(self) -> int:
+        return len(self.all_groups)
+
+    def __call__(self, cfg: dict) -> tuple[int, float, str]:
+        """Evaluate a config and wait for a free worker group if none.
+
+        Parameters
+        ----------
+        cfg : dict
+            The config.
+
+        Returns
+        -------
+        tuple[int, float, str]
+            The error code consistent with `parse_log` (3 means timeout),
+            the throughput, and the log of the error if any.
+        """
+        group = self.groups.get()
+        try:
+            if not group.alive:
+                group.stop()
+                with self.lock:
+                    self.num_starts += 1
+                logger.info("\tStarting worker group (slot %s)", group.slot)
+                error_code, log = group.start(self.timeout)
+                if error_code != 0:
+                    group.stop(force=True)
+                    return error_code, 0.0, log
+            logger.info("\tEvaluating in worker group (slot %s): %s", group.slot, cfg)
+            error_code, thrpt, log = group.run(
+                cfg, self.num_warmup, self.num_steps, self.timeout
+            )
+            if error_code in (1, 3) or not group.alive:
+                # The memory or collectives may be broken, so start a new
+                # worker group for the next trial.
+                logger.info(
+                    "\tRecycling worker group (slot %s) after error %d",
+                    group.slot,
+                    error_code,
+                )
+                group.stop(force=True)
+            return error_code, thrpt, log
+        finally:
+            self.groups.put(group)
+
+    def close(self):
+        """Stop all worker groups."""
+        for group in self.all_groups:
+            group.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,6 +3,7 @@
 """Functions to build the model based on the schedule."""
 from __future__ import annotations
 
+import functools
 import gc
 import inspect
 from collections.abc import Callable
@@ -11,10 +12,12 @@ from typing import Optional, Union
 import torch
 from torch import distributed as dist
 from torch import nn
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 from .utils.common import transfor_param_tags
 from .framework_dialect import get_dialect_cls
 from .logger import get_logger
+from .mesh import DeviceMesh, get_process_group
 from .pipeline import (
     analyze_tie_weights,
     build_pipeline_model,
@@ -25,16 +28,123 @@ from .schedule import Schedule
 logger = get_logger()
 
 
+class _BroadcastBucket:
+    """Coalesce tensors into flat buffers and broadcast them asynchronously,
+    so that the broadcast is bandwidth-bound instead of latency-bound when
+    there are many small tensors, and overlaps with the initialization of
+    the following modules.
+
+    Parameters
+    ----------
+    group : dist.ProcessGroup
+        The process group to broadcast.
+    src : int
+        The global rank of the source device.
+    bucket_size : int
+        The size of a bucket in bytes. A bucket is broadcasted once it is full.
+    max_inflight : int
+        The maximum number of buckets being broadcasted, which bounds the
+        memory of the flat buffers.
+    """
+
+    def __init__(self, group, src, bucket_size, max_inflight=2):
+        self.group = group
+        self.src = src
+        self.bucket_size = bucket_size
+        self.max_inflight = max_inflight
+        # The tensors and the callbacks after they are broadcasted by dtype.
+        self.buckets = {}
+        self.bucket_bytes = {}
+        self.inflight = []
+
+    def add(self, tensor, callback=None):
+        """Add a tensor to be broadcasted.
+
+        Parameters
+        ----------
+        tensor : torch.Tensor
+            The tensor to be broadcasted in place.
+        callback : Optional[Callable[[], None]]
+            The function to be called after the tensor is broadcasted.
+        """
+        dtype = tensor.dtype
+        self.buckets.setdefault(dtype, []).append((tensor, callback))
+        self.bucket_bytes[dtype] = (
+            self.bucket_bytes.get(dtype, 0) + tensor.numel() * tensor.element_size()
+        )
+        if self.bucket_bytes[dtype] >= self.bucket_size:
+            self._launch(dtype)
+
+    def _launch(self, dtype):
+        entries = self.buckets.pop(dtype)
+        del self.bucket_bytes[dtype]
+        tensors = [tensor.detach() for tensor, _ in entries]
+        if dist.get_rank() == self.src:
+            flat = _flatten_dense_tensors(tensors)
+        else:
+            flat = torch.empty(
+                sum(tensor.numel() for tensor in tensors),
+                dtype=dtype,
+                device=tensors[0].device,
+            )
+        handle = dist.broadcast(flat, src=self.src, group=self.group, async_op=True)
+        self.inflight.append((handle, flat, entries))
+        while len(self.inflight) > self.max_inflight:
+            self._wait_oldest()
+
+    def _wait_oldest(self):
+        handle, flat, entries = self.inflight.pop(0)
+        handle.wait()
+        tensors = [tensor.detach() for tensor, _ in entries]
+        if dist.get_rank() != self.src:
+            for tensor, synced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+                tensor.copy_(synced)
+        for _, callback in entries:
+            if callback is not None:
+                callback()
+
+    def flush(self):
+        """Broadcast the remaining tensors and wait for all broadcasts."""
+        for dtype in list(self.buckets):
+            self._launch(dtype)
+        while self.inflight:
+            self._wait_oldest()
+
+
 def consolidate_model(
     sch: Schedule,
     target: str,
     param_init_fn: Optional[Callable[[nn.Module], None]] = None,
+    shard_local: bool = False,
+    bucket_size: int = 25 * 1024 * 1024,
     **kwargs,
 ):
     """Consolidate the model weights.
     FIXME: When pipeline is enabled, this function only supports DeepSpeed
     runtime because it relies on DeepSpeed topology. We should use dialects
     in this function to make it general applicable.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule of the model.
+    target : str
+        The target runtime.
+    param_init_fn : Optional[Callable[[nn.Module], None]]
+        The function to initialize the parameters of a module.
+    shard_local : bool
+        If True, only the first device of each pipeline stage materializes the
+        complete sharded parameters for initialization, and scatters the
+        shards to the other devices. Otherwise, every device materializes the
+        complete parameters, which are broadcasted and then sharded. Both
+        result in the same weights.
+    bucket_size : int
+        The size in bytes of the buckets to coalesce parameters into for
+        broadcasting. The buckets are broadcasted asynchronously while the
+        following modules are initialized.
+    **kwargs
+        Other arguments such as the topology, which is a DeviceMesh or a
+        DeepSpeed topology.
     """
     topology = kwargs.get("topology", None)
     if dist.is_initialized() and dist.get_world_size() > sch.world_size:
@@ -89,19 +199,26 @@ def consolidate_model(
                 # [0, 1, 2, 3]
                 # create dist group for broadcasting
                 num_pp = topology.get_dim("pipe")
-                # each group contains the devices on the same stage
-                stage_groups = []
-                for i in range(num_pp):
-                    stage_groups.append(
-                        dist.new_group(ranks=topology.filter_match(pipe=i))
-                    )
+                # each group contains the devices on the same stage, which
+                # are cached and reused by the following builds.
+                stage_groups = [
+                    get_process_group(topology.filter_match(pipe=i))
+                    for i in range(num_pp)
+                ]
             else:
-                stage_groups = [dist.new_group()]
+                stage_groups = [get_process_group()]
 
             global_ranks = list(range(dist.get_world_size()))
     else:
         return sch
 
+    shard_local = shard_local and dist.is_initialized()
+    # The tensor parallel ranks of the devices in each pipeline stage group,
+    # keyed by the stage index and the tensor parallel group.
+    stage_tp_ranks = {}
+    # The broadcast buckets of each pipeline stage group.
+    stage_buckets = {}
+
     def _init_module(sch: Schedule):
         if param_init_fn:
             # count number of arguments in the given function to determine whether
@@ -127,13 +244,56 @@ def consolidate_model(
                 "to be provided in order to support delay initialization"
             )
 
+    def _get_stage_tp_ranks(sch: Schedule, curr_part_idx: int):
+        """Get the tensor parallel ranks of the devices in the stage group."""
+        key = (curr_part_idx, sch.group)
+        if key not in stage_tp_ranks:
+            curr_stage_group = stage_groups[curr_part_idx]
+            tp_ranks = [None] * dist.get_world_size(curr_stage_group)
+            dist.all_gather_object(tp_ranks, sch.rank, group=curr_stage_group)
+            stage_tp_ranks[key] = tp_ranks
+        return stage_tp_ranks[key]
+
+    def _scatter_shards(
+        sch: Schedule, curr_part_idx: int, curr_stage_devices, sharded_shapes
+    ):
+        """Scatter the shards of the sharded params from the first device in
+        the stage group, so that other devices only materialize their shards.
+        """
+        curr_stage_group = stage_groups[curr_part_idx]
+        src = curr_stage_devices[0]
+        tp_ranks = None
+        for param_name, shard_shape in sharded_shapes.items():
+            param = sch.mod.get_parameter(param_name)
+            if tp_ranks is None:
+                tp_ranks = _get_stage_tp_ranks(sch, curr_part_idx)
+            sharded_param = torch.empty(
+                shard_shape, dtype=param.dtype, device=local_rank
+            )
+            scatter_list = None
+            if global_rank == src:
+                axis = [
+                    idx
+                    for idx, new_size in enumerate(shard_shape)
+                    if new_size != param.shape[idx]
+                ]
+                assert len(axis) == 1, "Can only have one sharded dimension!"
+                shards = param.detach().split(shard_shape[axis[0]], dim=axis[0])
+                shards = [shard.contiguous() for shard in shards]
+                # The devices in the group are ordered by their global ranks.
+                scatter_list = [shards[tp_rank] for tp_rank in tp_ranks]
+            dist.scatter(sharded_param, scatter_list, src=src, group=curr_stage_group)
+            new_param = nn.Parameter(sharded_param)
+            sch.mod.register_parameter(param_name, new_param)
+            transfor_param_tags(sch, param, new_param)
+
     def _consolidate_and_broadcast(sch: Schedule):
         if isinstance(sch.mod, torch.jit.ScriptModule):
             # Scripted module requires the parameters to be initialized in advance,
             # so no need to consolidate
             return 0, 0
 
-        if hasattr(sch, "partition_idx") and topology is not None:
+        if sch.partition_idx is not None and topology is not None:
             curr_part_idx = sch.partition_idx
             # topology stores the global ranks
             curr_stage_devices = topology.filter_match(pipe=curr_part_idx)
@@ -146,14 +306,28 @@ def consolidate_model(
             return 0, 0
 
         # Register parameters with the original shape (if sharded) for initialization.
+        # In the shard local mode, only the first device materializes the
+        # complete sharded parameters.
+        is_src = global_rank == curr_stage_devices[0]
         num_params = 0
+        # The number of sharded params, which is counted before they are
+        # materialized since the non-source ranks only get their shards in
+        # the shard local mode.
+        cnt_shard = 0
         new_param_shapes = {}
+        sharded_shapes = {}
         for param_name, param in sch.mod.named_parameters(recurse=False):
             num_params += 1
             new_param_shapes[param_name] = param.shape
             orig_shape = (
                 param.orig_shape if hasattr(param, "orig_shape") else param.shape
             )
+            if tuple(orig_shape) != tuple(param.shape):
+                cnt_shard += 1
+            if shard_local and tuple(orig_shape) != tuple(param.shape):
+                sharded_shapes[param_name] = param.shape
+                if not is_src:
+                    orig_shape = param.shape
             new_param = nn.Parameter(
                 torch.zeros(orig_shape, dtype=param.dtype, device=local_rank)
             )
@@ -183,17 +357,11 @@ def consolidate_model(
                         sch.name,
                     )
 
-        # Broadcast complete params from rank 0 to make sure all the TP+DP ranks
-        # take the same params.
-        if dist.is_initialized():
-            curr_stage_group = stage_groups[curr_part_idx]
-            for _, param in sch.mod.named_parameters(recurse=False):
-                dist.broadcast(param, src=curr_stage_devices[0], group=curr_stage_group)
-
         # Only keep the partition for this device for sharded params.
         tp_rank = sch.rank
-        cnt_shard = 0
-        for param_name, param in sch.mod.named_parameters(recurse=False):
+
+        def _keep_local_shard(param_name):
+            param = sch.mod.get_parameter(param_name)
             is_found = False
             for idx, new_size in enumerate(new_param_shapes[param_name]):
                 if new_size != param.shape[idx]:
@@ -202,13 +370,32 @@ def consolidate_model(
                     axis = idx
                     is_found = True
             if is_found:
-                cnt_shard += 1
                 sharded_param = param.detach().split(sharded_size, dim=axis)[tp_rank]
                 sharded_param = sharded_param.contiguous()
                 new_param = nn.Parameter(sharded_param)
                 sch.mod.register_parameter(param_name, new_param)
                 transfor_param_tags(sch, param, new_param)
 
+        # Broadcast complete params from rank 0 to make sure all the TP+DP ranks
+        # take the same params. The sharded params are partitioned after
+        # they are broadcasted.
+        if dist.is_initialized():
+            if curr_part_idx not in stage_buckets:
+                stage_buckets[curr_part_idx] = _BroadcastBucket(
+                    stage_groups[curr_part_idx], curr_stage_devices[0], bucket_size
+                )
+            bucket = stage_buckets[curr_part_idx]
+            for param_name, param in sch.mod.named_parameters(recurse=False):
+                if param_name in sharded_shapes:
+                    # Scatter the shards of sharded params instead.
+                    continue
+                bucket.add(param, functools.partial(_keep_local_shard, param_name))
+        else:
+            for param_name in new_param_shapes:
+                _keep_local_shard(param_name)
+        if sharded_shapes:
+            _scatter_shards(sch, curr_part_idx, curr_stage_devices, sharded_shapes)
+
         for subsch in sch.child.values():
             ret = _consolidate_and_broadcast(subsch)
             num_params += ret[0]
@@ -218,6 +405,8 @@ def consolidate_model(
 
     if cnt_meta != 0 or cnt_materialized != 0:
         num_params, cnt_shard = _consolidate_and_broadcast(sch)
+        for bucket in stage_buckets.values():
+            bucket.flush()
 
     logger.info(
         "Finished consolidating %d parameter tensors with %d being sharded",
@@ -246,6 +435,8 @@ def build(
     init_weights: Optional[Union[bool, Callable]] = True,
     **kwargs,
 ):
+    if target == "deepspeed" and isinstance(kwargs.get("topology", None), DeviceMesh):
+        kwargs["topology"] = kwargs["topology"].to_topology()
     if sch.metadata.primitives["cut_pipeline_stage"]:
         # pipeline stages will be wrapped into PipeStageWrapper
         sch = generate_pipeline_partition(sch)
@@ -3,11 +3,39 @@
 
 import re
 
+from ..log_stream import LogStream
 from ..registry import register_framework_dialect
 
 
+class DeepSpeedLogStream(LogStream):
+    """Parse a DeepSpeed log incrementally, where every logging step reports
+    the average samples/sec from the beginning, so the throughput of each
+    window is derived from the consecutive averages.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.num_records = 0
+        self.last_avg = 0.0
+
+    def parse_line(self, line):
+        match = re.search(r"SamplesPerSec=+([\d\.]+)", line)
+        if match:
+            avg = float(match.group(1))
+            self.num_records += 1
+            self.windows.append(
+                avg * self.num_records - self.last_avg * (self.num_records - 1)
+            )
+            self.last_avg = avg
+
+
 @register_framework_dialect("deepspeed", "log_parser")
 class DeepSpeedLogParser:
+    @staticmethod
+    def create_stream():
+        """Create an incremental parser of the log."""
+        return DeepSpeedLogStream()
+
     @staticmethod
     def parse_log(log_filename):
         with open(log_filename, "r", encoding="utf-8") as f:
@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Parse training logs incrementally while the training is running."""
+from __future__ import annotations
+
+from typing import Optional
+
+
+class LogStream:
+    """The base class of incremental log parsers. The log is fed in chunks,
+    and the errors are detected as soon as they are printed. The subclasses
+    parse the throughput of each logging window in `parse_line`.
+    """
+
+    OOM_PATTERNS = ("CUDA out of memory", "OutOfMemoryError")
+    CRASH_PATTERNS = ("Traceback (most recent call last)",)
+
+    def __init__(self):
+        # The throughputs (samples/sec) of the logging windows.
+        self.windows = []
+        # None if no error, 1 if out of memory, and 2 if crashed, which is
+        # consistent with `parse_log`.
+        self.error_code = None
+        self.partial = ""
+
+    def feed(self, text: str):
+        """Feed a chunk of the log."""
+        lines = (self.partial + text).split("\n")
+        # The last line may be incomplete.
+        self.partial = lines.pop()
+        for line in lines:
+            self._parse(line)
+
+    def close(self):
+        """Parse the remaining incomplete line at the end of the log."""
+        if self.partial:
+            self._parse(self.partial)
+            self.partial = ""
+
+    def _parse(self, line):
+        if any(pattern in line for pattern in self.OOM_PATTERNS):
+            self.error_code = 1
+        elif self.error_code is None and any(
+            pattern in line for pattern in self.CRASH_PATTERNS
+        ):
+            self.error_code = 2
+        self.parse_line(line)
+
+    def parse_line(self, line: str):
+        """Parse a complete line, and append the throughput to `windows` if
+        the line reports it.
+        """
+        raise NotImplementedError
+
+    def estimate(self) -> float:
+        """The throughput excluding the first window as the warmup."""
+        if not self.windows:
+            return 0.0
+        if len(self.windows) == 1:
+            return self.windows[0]
+        return sum(self.windows[1:]) / (len(self.windows) - 1)
+
+    def steady_thrpt(
+        self, min_windows: int = 3, tolerance: float = 0.05
+    ) -> Optional[float]:
+        """The throughput once it is stable, i.e., the last `min_windows`
+        windows after the warmup are within the relative tolerance.
+
+        Parameters
+        ----------
+        min_windows : int
+            The number of windows to check the stability.
+        tolerance : float
+            The relative range of the throughputs.
+
+        Returns
+        -------
+        Optional[float]
+            The estimated throughput, or None if it is not stable yet.
+        """
+        windows = self.windows[1:][-min_windows:]
+        if len(windows) < min_windows:
+            return None
+        mean = sum(windows) / len(windows)
+        if mean <= 0 or (max(windows) - min(windows)) / mean > tolerance:
+            return None
+        return self.estimate()
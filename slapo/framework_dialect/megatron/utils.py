@@ -3,11 +3,35 @@
 
 import re
 
+from ..log_stream import LogStream
 from ..registry import register_framework_dialect
 
 
+class MegatronLogStream(LogStream):
+    """Parse a Megatron-LM log incrementally, where every logging step reports
+    the average iteration time of the past steps.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.global_batch_size = None
+
+    def parse_line(self, line):
+        match = re.search(r"global batch size: +([\d\.]+)", line)
+        if match:
+            self.global_batch_size = float(match.group(1))
+        match = re.search(r"elapsed time per iteration \(ms\): +([\d\.]+)", line)
+        if match and self.global_batch_size:
+            self.windows.append(self.global_batch_size / float(match.group(1)) * 1e3)
+
+
 @register_framework_dialect("megatron", "log_parser")
 class MegatronLogParser:
+    @staticmethod
+    def create_stream():
+        """Create an incremental parser of the log."""
+        return MegatronLogStream()
+
     @staticmethod
     def parse_log(log_filename):
         with open(log_filename, "r", encoding="utf8") as f:
@@ -0,0 +1,294 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""The subgraph matching engine used by `Schedule.find_subgraph`.
+
+A pattern is traced and compiled only once. The compiled pattern keeps
+a predicate for each of its compute nodes, so that matching a graph only
+needs to look up the candidate nodes of each pattern node from an index
+of the graph instead of re-walking the graph for every start node.
+"""
+# pylint: disable=exec-used
+from __future__ import annotations
+
+import re
+import weakref
+from bisect import bisect_right
+from collections import OrderedDict
+from types import FunctionType
+
+from torch import fx
+
+from .pattern import Pattern, ModulePattern
+from .tracer import trace as trace_module
+from .utils.mapping import MAPPING_FROM_FUNCTIONAL_TO_MODULE
+
+# Compiled patterns of `Pattern` instances, which are released together
+# with the pattern instances.
+_MODULE_PATTERN_CACHE = weakref.WeakKeyDictionary()
+# Compiled patterns of pattern functions. Pattern functions are usually
+# defined inside schedule functions, so a new function object is created
+# every time the schedule function is called. They are thus keyed by their
+# code objects and the values they capture.
+_FUNCTION_PATTERN_CACHE = OrderedDict()
+_FUNCTION_PATTERN_CACHE_SIZE = 128
+
+
+class PatternNode:
+    """A compute node of a pattern graph with its matching predicate.
+
+    Parameters
+    ----------
+    node : fx.Node
+        The node in the pattern graph.
+    pattern_modules : dict[str, nn.Module]
+        The submodules of the pattern graph module.
+    """
+
+    def __init__(self, node, pattern_modules):
+        self.op = node.op
+        self.target = node.target
+        # The module type that a functional op is equivalent to.
+        self.module_type = None
+        # The regex of the module name specified by the pattern language.
+        self.module_regex = None
+        # The module type specified by the pattern class.
+        self.pattern_module_type = None
+
+        if self.op == "call_function":
+            self.module_type = MAPPING_FROM_FUNCTIONAL_TO_MODULE.get(self.target, None)
+            if getattr(self.target, "__name__", None) == "call_module":
+                self.module_regex = re.compile(node.args[0])
+        elif self.op == "call_module":
+            pattern_mod = pattern_modules[self.target]
+            self.pattern_module_type = type(pattern_mod)
+            if isinstance(pattern_mod, ModulePattern):
+                self.module_regex = re.compile(pattern_mod.name)
+
+    def match_module(self, node, mod):
+        """Check whether a `call_module` node matches this pattern node.
+
+        Parameters
+        ----------
+        node : fx.Node
+            The `call_module` node.
+        mod : Optional[nn.Module]
+            The module called by the node.
+
+        Returns
+        -------
+        bool
+            Whether the node matches.
+        """
+        if self.op == "call_function":
+            # nn.Module and nn.functional are viewed as the same.
+            if self.module_type is not None and self.module_type is type(mod):
+                return True
+            # Use pattern language to match.
+            return (
+                self.module_regex is not None
+                and self.module_regex.match(node.target) is not None
+            )
+        if self.op == "call_module":
+            # Exactly match, or use pattern class for matching.
+            if node.target == self.target or self.pattern_module_type is type(mod):
+                return True
+            # Use pattern lanauge + pattern class for matching.
+            return (
+                self.module_regex is not None
+                and self.module_regex.match(node.target) is not None
+            )
+        return False
+
+
+class CompiledPattern:
+    """A traced pattern whose compute nodes are ready for matching.
+
+    Parameters
+    ----------
+    pattern_mod : fx.GraphModule
+        The traced pattern graph.
+    """
+
+    def __init__(self, pattern_mod):
+        assert isinstance(pattern_mod, fx.GraphModule)
+        pattern_modules = dict(pattern_mod.named_modules())
+        self.graph_module = pattern_mod
+        # The compute nodes of the pattern in topological order. Placeholders
+        # are skipped and the output node always matches.
+        self.nodes = [
+            PatternNode(node, pattern_modules)
+            for node in pattern_mod.graph.nodes
+            if node.op not in ("placeholder", "output")
+        ]
+        if not self.nodes:
+            raise RuntimeError("Cannot find the first non-placeholder operator")
+
+    def match(self, graph_modules, named_modules):
+        """Match the pattern in the given graphs.
+
+        The matching follows the greedy algorithm that leverages the
+        sequential representation of the computation graph: For each start
+        node in graph order, each following pattern node is matched with the
+        first unmatched node after the previously matched node. An example is
+        shown below:
+        original graph:
+         x = a + b
+         y = c + d (totally independent from x)
+         z = x + 1
+        pattern graph:
+         m = p + q
+         n = m + 1
+        should match:
+         x = a + b
+         z = x + 1
+        The implication here is that the generated pattern graph should follow
+        **the same topological order** of the original graph. In general,
+        subgraph isomorphism is an NP-complete problem, so the pattern graph is
+        not matched with the dataflow of the original graph.
+
+        Parameters
+        ----------
+        graph_modules : Iterable[tuple[str, fx.GraphModule]]
+            The graph modules to be matched with their names.
+        named_modules : dict[str, nn.Module]
+            The mapping from module names to modules, which is used to look
+            up the modules of `call_module` nodes.
+
+        Returns
+        -------
+        list[list[tuple[str, fx.Node]]]
+            The matched subgraphs.
+        """
+        res = []
+        for parent_name, graph_mod in graph_modules:
+            candidates = self.index_candidates(
+                graph_mod.graph, parent_name, named_modules
+            )
+            if any(not nodes for nodes, _ in candidates):
+                continue
+            matched = set()
+            for start, pos in zip(*candidates[0]):
+                if start in matched:
+                    continue
+                subgraph = [start]
+                for nodes, positions in candidates[1:]:
+                    # Find the first unmatched candidate after the previous
+                    # matched node.
+                    idx = bisect_right(positions, pos)
+                    while idx < len(nodes) and nodes[idx] in matched:
+                        idx += 1
+                    if idx == len(nodes):
+                        break
+                    subgraph.append(nodes[idx])
+                    pos = positions[idx]
+                else:
+                    matched.update(subgraph)
+                    res.append([(parent_name, node) for node in subgraph])
+        return res
+
+    def index_candidates(self, graph, parent_name, named_modules):
+        """Collect the candidate nodes of each pattern node in one scan of
+        the graph, so that matching does not need to walk the graph again.
+
+        Parameters
+        ----------
+        graph : fx.Graph
+            The graph to be indexed.
+        parent_name : str
+            The name of the graph module that owns the graph.
+        named_modules : dict[str, nn.Module]
+            The mapping from module names to modules.
+
+        Returns
+        -------
+        list[tuple[list[fx.Node], list[int]]]
+            The candidate nodes and their positions in the graph for each
+            pattern node.
+        """
+        prefix = f"{parent_name}." if parent_name else ""
+        by_op_target = {}
+        module_nodes = []
+        for pos, node in enumerate(graph.nodes):
+            if node.op in ("placeholder", "output"):
+                continue
+            if node.op == "call_module":
+                mod = named_modules.get(prefix + node.target, None)
+                module_nodes.append((pos, node, mod))
+            else:
+                by_op_target.setdefault((node.op, node.target), []).append((pos, node))
+
+        candidates = []
+        for pattern_node in self.nodes:
+            if pattern_node.op == "call_module":
+                entries = []
+            else:
+                entries = by_op_target.get((pattern_node.op, pattern_node.target), [])
+            if pattern_node.op in ("call_function", "call_module"):
+                entries = entries + [
+                    (pos, node)
+                    for pos, node, mod in module_nodes
+                    if pattern_node.match_module(node, mod)
+                ]
+                entries.sort(key=lambda entry: entry[0])
+            candidates.append(
+                ([node for _, node in entries], [pos for pos, _ in entries])
+            )
+        return candidates
+
+
+def _function_pattern_key(pattern_fn):
+    """The cache key of a pattern function, or None if the function
+    captures unhashable values.
+    """
+    try:
+        closure = tuple(cell.cell_contents for cell in pattern_fn.__closure__ or ())
+        key = (pattern_fn.__code__, pattern_fn.__defaults__, closure)
+        hash(key)
+    except (TypeError, ValueError):
+        return None
+    return key
+
+
+def compile_pattern(pattern_fn):
+    """Trace and compile a pattern. The compiled pattern is cached, so that
+    matching the same pattern multiple times does not re-trace it.
+
+    Parameters
+    ----------
+    pattern_fn : Union[FunctionType, Pattern]
+        The subgraph pattern.
+
+    Returns
+    -------
+    CompiledPattern
+        The compiled pattern.
+    """
+    assert isinstance(pattern_fn, (FunctionType, Pattern))
+    if isinstance(pattern_fn, Pattern):
+        if pattern_fn not in _MODULE_PATTERN_CACHE:
+            pattern_mod = trace_module(
+                pattern_fn,
+                recursive=True,
+                flatten=True,
+                leaf_modules=["ModulePattern"],
+            )
+            _MODULE_PATTERN_CACHE[pattern_fn] = CompiledPattern(pattern_mod)
+        return _MODULE_PATTERN_CACHE[pattern_fn]
+
+    key = _function_pattern_key(pattern_fn)
+    if key is not None and key in _FUNCTION_PATTERN_CACHE:
+        _FUNCTION_PATTERN_CACHE.move_to_end(key)
+        return _FUNCTION_PATTERN_CACHE[key]
+    # Workaround for fx wrap functions:
+    # https://github.com/pytorch/pytorch/issues/53534
+    if "call_module" in pattern_fn.__globals__:
+        exec(
+            "import torch.fx; torch.fx.wrap('call_module')",
+            pattern_fn.__globals__,
+        )
+    compiled = CompiledPattern(fx.symbolic_trace(pattern_fn))
+    if key is not None:
+        _FUNCTION_PATTERN_CACHE[key] = compiled
+        if len(_FUNCTION_PATTERN_CACHE) > _FUNCTION_PATTERN_CACHE_SIZE:
+            _FUNCTION_PATTERN_CACHE.popitem(last=False)
+    return compiled
@@ -0,0 +1,262 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""The device mesh of pipeline, data and tensor parallelism, and the cache
+of process groups shared by building, verification and model schedules.
+
+Creating a process group is a collective operation over all devices and
+allocates communicator resources, so a group of the same ranks is only
+created once and reused afterwards.
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Optional
+
+from torch import distributed as dist
+
+from .logger import get_logger
+
+logger = get_logger()
+
+# The cached process groups keyed by the sorted global ranks.
+_PROCESS_GROUPS = {}
+
+
+def get_process_group(ranks: Optional[Sequence[int]] = None):
+    """Get the process group of the given global ranks, which is created
+    at the first time. Since creating a group is a collective operation,
+    all devices must call this function with the same ranks in the same
+    order, even if they are not in the group.
+
+    Parameters
+    ----------
+    ranks : Optional[Sequence[int]]
+        The global ranks in the group. If None, use all devices.
+
+    Returns
+    -------
+    Optional[dist.ProcessGroup]
+        The process group, or None if distributed is not initialized.
+    """
+    if not dist.is_initialized():
+        return None
+    world_size = dist.get_world_size()
+    key = tuple(sorted(ranks)) if ranks is not None else tuple(range(world_size))
+    if key == tuple(range(world_size)):
+        return dist.group.WORLD
+    if key not in _PROCESS_GROUPS:
+        logger.debug("Create a process group of ranks %s", key)
+        _PROCESS_GROUPS[key] = dist.new_group(ranks=list(key))
+    return _PROCESS_GROUPS[key]
+
+
+def clear_process_groups():
+    """Destroy the cached process groups, e.g., before destroying the
+    default process group.
+    """
+    for group in _PROCESS_GROUPS.values():
+        try:
+            dist.destroy_process_group(group)
+        except (RuntimeError, ValueError):
+            pass
+    _PROCESS_GROUPS.clear()
+
+
+class DeviceMesh:
+    """The device mesh of pipeline ("pipe"), data ("data") and tensor
+    ("model") parallelism. The global ranks are laid out in the same way as
+    `PipeModelDataParallelTopology` in DeepSpeed, where the ranks in the same
+    tensor parallel group are consecutive. For example, with 2-way pipeline,
+    data and tensor parallelism:
+
+    .. code-block:: python
+
+        >>> mesh = DeviceMesh(tp_size=2, pp_size=2, dp_size=2)
+        >>> mesh.get_axis_comm_lists("model")
+        [[0, 1], [2, 3], [4, 5], [6, 7]]
+        >>> mesh.get_axis_comm_lists("pipe")
+        [[0, 4], [1, 5], [2, 6], [3, 7]]
+        >>> mesh.filter_match(pipe=0)
+        [0, 1, 2, 3]
+
+    The mesh can be used as the topology of `slapo.build`, and its process
+    groups are created once and cached.
+
+    Parameters
+    ----------
+    tp_size : int
+        The tensor parallel size.
+    pp_size : int
+        The pipeline parallel size.
+    dp_size : Optional[int]
+        The data parallel size. If None, use the rest of the devices.
+    world_size : Optional[int]
+        The number of devices. If None, use the world size of the default
+        process group, or 1 if distributed is not initialized.
+    """
+
+    AXES = ("pipe", "data", "model")
+
+    def __init__(
+        self,
+        tp_size: int = 1,
+        pp_size: int = 1,
+        dp_size: Optional[int] = None,
+        world_size: Optional[int] = None,
+    ):
+        if world_size is None:
+            world_size = dist.get_world_size() if dist.is_initialized() else 1
+        if dp_size is None:
+            if world_size % (tp_size * pp_size) != 0:
+                raise ValueError(
+                    f"World size {world_size} is not divisible by "
+                    f"TP={tp_size} x PP={pp_size}"
+                )
+            dp_size = world_size // (tp_size * pp_size)
+        if tp_size * pp_size * dp_size != world_size:
+            raise ValueError(
+                f"TP={tp_size} x PP={pp_size} x DP={dp_size} does not match "
+                f"world size {world_size}"
+            )
+        self.dims = {"pipe": pp_size, "data": dp_size, "model": tp_size}
+
+    @classmethod
+    def from_topology(cls, topology):
+        """Create a mesh from a DeepSpeed `PipeModelDataParallelTopology`."""
+        if isinstance(topology, cls):
+            return topology
+        return cls(
+            tp_size=topology.get_dim("model"),
+            pp_size=topology.get_dim("pipe"),
+            dp_size=topology.get_dim("data"),
+        )
+
+    def __repr__(self):
+        return (
+            f"DeviceMesh(tp_size={self.tp_size}, pp_size={self.pp_size}, "
+            f"dp_size={self.dp_size})"
+        )
+
+    @property
+    def tp_size(self) -> int:
+        return self.dims["model"]
+
+    @property
+    def pp_size(self) -> int:
+        return self.dims["pipe"]
+
+    @property
+    def dp_size(self) -> int:
+        return self.dims["data"]
+
+    @property
+    def world_size(self) -> int:
+        return self.tp_size * self.pp_size * self.dp_size
+
+    def get_dim(self, axis: str) -> int:
+        """Get the size of an axis."""
+        return self.dims[axis]
+
+    def get_coord(self, rank: int) -> dict[str, int]:
+        """Get the coordinate of a global rank.
+
+        Parameters
+        ----------
+        rank : int
+            The global rank.
+
+        Returns
+        -------
+        dict[str, int]
+            The index of each axis.
+        """
+        if not 0 <= rank < self.world_size:
+            raise ValueError(f"Rank {rank} is out of the mesh {self}")
+        coord = {}
+        for axis in reversed(self.AXES):
+            rank, coord[axis] = divmod(rank, self.dims[axis])
+        return {axis: coord[axis] for axis in self.AXES}
+
+    def get_rank(self, **coord) -> int:
+        """Get the global rank of a coordinate, e.g., `get_rank(pipe=1,
+        data=0, model=1)`. The missing axes are 0.
+        """
+        rank = 0
+        for axis in self.AXES:
+            rank = rank * self.dims[axis] + coord.get(axis, 0)
+        return rank
+
+    def filter_match(self, **filters) -> list[int]:
+        """Get the global ranks that match the given axis indices, e.g.,
+        `filter_match(pipe=0)` returns the ranks of the first stage.
+        """
+        return [
+            rank
+            for rank in range(self.world_size)
+            if all(self.get_coord(rank)[axis] == idx for axis, idx in filters.items())
+        ]
+
+    def get_axis_comm_lists(self, axis: str) -> list[list[int]]:
+        """Get the lists of global ranks that communicate along an axis."""
+        others = [other for other in self.AXES if other != axis]
+        lists = {}
+        for rank in range(self.world_size):
+            coord = self.get_coord(rank)
+            lists.setdefault(tuple(coord[other] for other in others), []).append(rank)
+        return list(lists.values())
+
+    def get_group(self, axis: str, rank: Optional[int] = None):
+        """Get the process group along an axis that contains the given rank.
+        The groups of all devices along this axis are created together, so
+        all devices must call this function.
+
+        Parameters
+        ----------
+        axis : str
+            The axis, including "pipe", "data" and "model".
+        rank : Optional[int]
+            The global rank. If None, use the rank of this device.
+
+        Returns
+        -------
+        Optional[dist.ProcessGroup]
+            The process group, or None if distributed is not initialized.
+        """
+        if not dist.is_initialized():
+            return None
+        if rank is None:
+            rank = dist.get_rank()
+        group = None
+        for ranks in self.get_axis_comm_lists(axis):
+            curr_group = get_process_group(ranks)
+            if rank in ranks:
+                group = curr_group
+        return group
+
+    @property
+    def tp_group(self):
+        """The tensor parallel group of this device."""
+        return self.get_group("model")
+
+    @property
+    def dp_group(self):
+        """The data parallel group of this device."""
+        return self.get_group("data")
+
+    @property
+    def pp_group(self):
+        """The pipeline parallel group of this device."""
+        return self.get_group("pipe")
+
+    def get_stage_group(self, stage: int):
+        """Get the process group of all devices in a pipeline stage."""
+        return get_process_group(self.filter_match(pipe=stage))
+
+    def to_topology(self):
+        """Convert to a DeepSpeed `PipeModelDataParallelTopology`."""
+        # pylint: disable=import-outside-toplevel
+        from deepspeed.runtime.pipe.topology import PipeModelDataParallelTopology
+
+        return PipeModelDataParallelTopology(
+            num_pp=self.pp_size, num_mp=self.tp_size, num_dp=self.dp_size
+        )
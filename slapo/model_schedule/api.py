@@ -9,7 +9,12 @@ def apply_schedule(
     schedule_key,
     **sch_config,
 ):
-    """Apply schedule to a model."""
+    """Apply schedule to a model. If a DeviceMesh is given as `mesh` in the
+    config, its tensor parallel group is used unless `group` is specified.
+    """
+    mesh = sch_config.get("mesh", None)
+    if mesh is not None and sch_config.get("group", None) is None:
+        sch_config["group"] = mesh.tp_group
     schedule_method = get_schedule(schedule_key)
     if schedule_method is None:
         raise ValueError(f"Schedule method for {schedule_key} does not exist.")
@@ -9,6 +9,7 @@ from torch import nn
 import torch.nn.functional as F
 
 from ..schedule import create_schedule
+from ..template import apply_template
 from ..initialization import init_empty_weights
 from ..op import FlashAttention
 from ..logger import get_logger
@@ -284,14 +285,19 @@ def fuse_bias_gelu(sch, model_config, path="encoder.layer.N.intermediate"):
     def bias_gelu_pattern(x, bias):
         return F.gelu(x + bias)
 
-    for idx in range(model_config.num_hidden_layers):
-        subsch = sch[path.replace("N", str(idx))]
+    def fuse_fn(subsch):
         subsch["dense"].decompose()
         subsch.trace(flatten=True)
-
         subgraph = subsch.find(bias_gelu_pattern)
         subsch.fuse(subgraph, compiler="TorchScript", name="FusedBiasGeLU")
 
+    # The layers are identical, so the fusion is only searched in the first
+    # layer and stamped onto the others.
+    paths = [
+        path.replace("N", str(idx)) for idx in range(model_config.num_hidden_layers)
+    ]
+    apply_template(sch, paths, fuse_fn)
+
 
 # pylint: disable=dangerous-default-value
 def shard_mlp(
@@ -300,17 +306,17 @@ def shard_mlp(
     if sch.world_size == 1:
         return
 
-    for idx in range(model_config.num_hidden_layers):
-        prefix = path.replace("N", str(idx))
-        sch[f"{prefix}.{fc_names[0]}.dense"].shard("weight", axis=0)
-        sch[f"{prefix}.{fc_names[0]}.dense"].shard("bias", axis=0)
-        sch[f"{prefix}.{fc_names[0]}.dense"].sync(
-            mode="bwd_post", sync_op_or_fn="all_reduce"
-        )
-        sch[f"{prefix}.{fc_names[1]}.dense"].shard("weight", axis=1)
-        sch[f"{prefix}.{fc_names[1]}.dense"].sync(
-            mode="fwd_post", sync_op_or_fn="all_reduce"
-        )
+    def shard_fn(subsch):
+        subsch[f"{fc_names[0]}.dense"].shard("weight", axis=0)
+        subsch[f"{fc_names[0]}.dense"].shard("bias", axis=0)
+        subsch[f"{fc_names[0]}.dense"].sync(mode="bwd_post", sync_op_or_fn="all_reduce")
+        subsch[f"{fc_names[1]}.dense"].shard("weight", axis=1)
+        subsch[f"{fc_names[1]}.dense"].sync(mode="fwd_post", sync_op_or_fn="all_reduce")
+
+    paths = [
+        path.replace("N", str(idx)) for idx in range(model_config.num_hidden_layers)
+    ]
+    apply_template(sch, paths, shard_fn)
 
 
 def checkpoint(
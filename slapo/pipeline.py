@@ -69,6 +69,7 @@ def propagate_partition(sch, starting_stage_id=0, stop_at=None):
     # Register partitioned submodules to parent module
     for name, child in mod_after_split.named_children():
         parent_mod.add_module(name, child)
+    sch.parent.invalidate_module_index()
 
     # Replace call_module in parent graph with submodule calls (inline).
     new_node = target_call_node
@@ -300,6 +301,10 @@ def analyze_tie_weights(top_mod, is_pipeline_partitioned):
     """
     # Mapping from parameter name to (the pipeline stage ID, the parameter object).
     params = {}
+    # Mapping from the parameter object ID to the parameter names, so that
+    # finding the parameters sharing the same memory does not need to
+    # iterate all parameters.
+    param_names_by_id = {}
     # The result tie groups.
     tie_groups = {}
 
@@ -318,27 +323,27 @@ def analyze_tie_weights(top_mod, is_pipeline_partitioned):
                 continue
 
             # Check if this parameter is tie to another one in a different stage.
-            for target_param_full_name, (
-                target_stage,
-                target_param,
-            ) in params.items():
+            for target_param_full_name in param_names_by_id.get(id(curr_param), []):
+                target_stage, _ = params[target_param_full_name]
                 if is_pipeline_partitioned and stage_id == target_stage:
                     continue
-                if id(curr_param) == id(target_param):
-                    if curr_param in tie_groups:
-                        # Get the tie group of the target parameter.
-                        tie_group = tie_groups[curr_param]
-                    else:
-                        # Create a new tie group, and use the target parameter name
-                        # as the primary key.
-                        tie_group = set([(target_param_full_name, target_stage)])
-                        tie_groups[curr_param] = tie_group
-
-                    # Add the current parameter to the tie group.
-                    tie_group.add((curr_param_full_name, stage_id))
+                if curr_param in tie_groups:
+                    # Get the tie group of the target parameter.
+                    tie_group = tie_groups[curr_param]
+                else:
+                    # Create a new tie group, and use the target parameter name
+                    # as the primary key.
+                    tie_group = set([(target_param_full_name, target_stage)])
+                    tie_groups[curr_param] = tie_group
+
+                # Add the current parameter to the tie group.
+                tie_group.add((curr_param_full_name, stage_id))
 
             # Add this parameter for the rest analysis.
             params[curr_param_full_name] = (stage_id, curr_param)
+            param_names_by_id.setdefault(id(curr_param), []).append(
+                curr_param_full_name
+            )
 
         # Traverse children.
         for name, mod in curr_mod.named_children():
@@ -352,6 +357,7 @@ def analyze_tie_weights(top_mod, is_pipeline_partitioned):
 
     # Explicitly delete the reference to parameters for safety.
     del params
+    del param_names_by_id
 
     # Remove module name.
     if is_pipeline_partitioned:
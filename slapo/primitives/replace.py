@@ -244,9 +244,27 @@ def _replace_module(self_sch, new_mod, subgraphs=None, name=None, concrete_args=
             name = new_mod._get_name().split(".")[-1]
         name = _get_unique_module_name(self_sch.mod, name)
     # Create a new schedule for the replaced module
-    new_sch = create_schedule(
-        new_mod, name, self_sch.path, self_sch.parent, self_sch.group
-    )
+    if subgraphs is None:
+        # The descendants of the current schedule will be replaced.
+        self_sch.invalidate_path_index()
+        new_sch = create_schedule(
+            new_mod,
+            name,
+            self_sch.path,
+            self_sch.parent,
+            self_sch.group,
+            lazy=self_sch.lazy,
+        )
+    else:
+        self_sch.invalidate_path_index(name)
+        new_sch = create_schedule(
+            new_mod,
+            name,
+            self_sch.get_full_path(name),
+            self_sch,
+            self_sch.group,
+            lazy=self_sch.lazy,
+        )
     # Replace the corresponding part in the current module
     if subgraphs is None:
         # If subgraphs is None, replace the whole self_sch module.
@@ -257,6 +275,7 @@ def _replace_module(self_sch, new_mod, subgraphs=None, name=None, concrete_args=
         self_sch.child = new_sch.child
         for _, sch in self_sch.child.items():
             sch.parent = self_sch
+        self_sch.register_path(self_sch)
         if self_sch.parent:
             self_sch.update_submodule(self_sch.parent.mod, self_sch.name, new_mod)
     else:
@@ -312,53 +331,81 @@ class ReplacePrimitive(Primitive):
         else:
             _replace_module(sch, new_mod_or_func, target_ops, name, concrete_args)
 
-        # Clean up and update the schedule child list.
-        if isinstance(sch.mod, fx.GraphModule):
-            sch.mod.graph.eliminate_dead_code()
-            sch.mod.delete_all_unused_submodules()
-            sch.mod.graph.lint()
-            sch.mod.recompile()
-
-            # Remove OOD child.
-            named_children = []
-            for child_name, submod in sch.mod.named_children():  # immediate children
-                if is_module_list(submod, child_name, sch):
-                    named_children += [
-                        f"{child_name}.{name_idx}"
-                        for name_idx, _ in submod.named_children()
-                    ]
-                else:
-                    named_children.append(child_name)
-            to_be_removed = []
-            for child_name in sch.child:
-                if child_name not in named_children:
-                    to_be_removed.append(child_name)
-
-            for child_name in to_be_removed:
-                del sch.child[child_name]
-
-            # Add new child.
-            for child_name, submod in sch.mod.named_children():
-                path = sch.path
-                next_path = f"{path}.{child_name}" if path else child_name
-                if child_name not in sch.child:
-                    for name_idx, layer in submod.named_children():
-                        if is_module_list(submod, child_name, sch):
-                            sch.child[f"{child_name}.{name_idx}"] = create_schedule(
-                                layer,
-                                f"{child_name}.{name_idx}",
-                                f"{next_path}.{name_idx}",
-                                sch,
-                                sch.group,
-                            )
-                        else:
-                            sch.child[child_name] = create_schedule(
-                                submod,
-                                child_name,
-                                next_path,
-                                sch,
-                                sch.group,
-                            )
+        # The module hierarchy has been changed.
+        sch.invalidate_module_index()
+
+        top_sch = sch.get_top_schedule()
+        if top_sch.pending_updates is not None:
+            # Defer the graph clean up to the end of the batch.
+            top_sch.pending_updates[id(sch)] = sch
+        else:
+            ReplacePrimitive.update_graph(sch)
+
+    @staticmethod
+    def update_graph(sch):
+        """Clean up and recompile the graph of the schedule after replacement,
+        and update its child schedules accordingly.
+
+        Parameters
+        ----------
+        sch : Schedule
+            The schedule with replaced modules or functions.
+        """
+        if not isinstance(sch.mod, fx.GraphModule):
+            return
+
+        # Clean up the graph.
+        sch.mod.graph.eliminate_dead_code()
+        sch.mod.delete_all_unused_submodules()
+        sch.mod.graph.lint()
+        sch.mod.recompile()
+
+        # The module hierarchy has been changed.
+        sch.invalidate_module_index()
+
+        # Update the schedule child list.
+        # Remove OOD child.
+        named_children = []
+        for child_name, submod in sch.mod.named_children():  # immediate children
+            if is_module_list(submod, child_name, sch):
+                named_children += [
+                    f"{child_name}.{name_idx}"
+                    for name_idx, _ in submod.named_children()
+                ]
+            else:
+                named_children.append(child_name)
+        to_be_removed = []
+        for child_name in sch.child:
+            if child_name not in named_children:
+                to_be_removed.append(child_name)
+
+        for child_name in to_be_removed:
+            # Invalidate the index before the subtree is detached.
+            sch.invalidate_path_index(child_name)
+            del sch.child[child_name]
+
+        # Add new child.
+        for child_name, submod in sch.mod.named_children():
+            path = sch.path
+            next_path = f"{path}.{child_name}" if path else child_name
+            if child_name not in sch.child:
+                for name_idx, layer in submod.named_children():
+                    if is_module_list(submod, child_name, sch):
+                        sch.child[f"{child_name}.{name_idx}"] = create_schedule(
+                            layer,
+                            f"{child_name}.{name_idx}",
+                            f"{next_path}.{name_idx}",
+                            sch,
+                            sch.group,
+                        )
+                    else:
+                        sch.child[child_name] = create_schedule(
+                            submod,
+                            child_name,
+                            next_path,
+                            sch,
+                            sch.group,
+                        )
 
 
 @register_primitive()
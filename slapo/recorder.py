@@ -0,0 +1,324 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Record the primitives applied to a schedule, so that the schedule can be
+saved and replayed onto a fresh model without re-running the schedule
+function (e.g., pattern matching).
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+import io
+import pickle
+from contextlib import contextmanager
+from typing import Any, Optional
+
+from torch import fx, nn
+
+from .logger import get_logger
+
+logger = get_logger()
+
+# The version of the serialized schedule log format.
+LOG_FORMAT_VERSION = 1
+
+
+class _ArgPickler(pickle.Pickler):
+    """Pickle the arguments of a primitive. The objects in the model, such as
+    parameters, submodules and fx nodes, are pickled as references by their
+    names, so that they can be resolved in another model when replaying.
+    """
+
+    def __init__(self, file, top_sch):
+        super().__init__(file)
+        self.top_sch = top_sch
+        self.module_names = None
+        self.param_names = None
+
+    def _build_name_maps(self):
+        top_mod = self.top_sch.mod
+        self.module_names = {id(mod): name for name, mod in top_mod.named_modules()}
+        self.param_names = {
+            id(param): name for name, param in top_mod.named_parameters()
+        }
+
+    def persistent_id(self, obj):
+        # Avoid importing Schedule that imports this module.
+        if type(obj).__name__ == "Schedule" and hasattr(obj, "get_top_schedule"):
+            return ("schedule", obj.path)
+        if isinstance(obj, (fx.Node, nn.Module)):
+            if self.module_names is None:
+                self._build_name_maps()
+            if isinstance(obj, fx.Node):
+                owning_mod = obj.graph.owning_module
+                if owning_mod is None or id(owning_mod) not in self.module_names:
+                    raise pickle.PicklingError(
+                        f"Node {obj.name} does not belong to the model"
+                    )
+                return ("node", self.module_names[id(owning_mod)], obj.name)
+            if id(obj) in self.module_names:
+                return ("module", self.module_names[id(obj)])
+            return None
+        if isinstance(obj, nn.Parameter):
+            if self.param_names is None:
+                self._build_name_maps()
+            if id(obj) in self.param_names:
+                return ("param", self.param_names[id(obj)])
+        return None
+
+
+class _ArgUnpickler(pickle.Unpickler):
+    """Unpickle the arguments of a primitive and resolve the references to the
+    objects in the model being replayed.
+    """
+
+    def __init__(self, file, top_sch):
+        super().__init__(file)
+        self.top_sch = top_sch
+        self.node_maps = {}
+
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind == "schedule":
+            return self.top_sch[pid[1]] if pid[1] else self.top_sch
+        if kind == "module":
+            return self.top_sch.mod.get_submodule(pid[1])
+        if kind == "param":
+            return self.top_sch.mod.get_parameter(pid[1])
+        if kind == "node":
+            _, mod_name, node_name = pid
+            if mod_name not in self.node_maps:
+                graph_mod = self.top_sch.mod.get_submodule(mod_name)
+                self.node_maps[mod_name] = {
+                    node.name: node for node in graph_mod.graph.nodes
+                }
+            return self.node_maps[mod_name][node_name]
+        raise pickle.UnpicklingError(f"Unknown reference {pid}")
+
+
+def schedule_fingerprint(sch):
+    """Compute a fingerprint of the scheduled model, including the module
+    hierarchy, the generated code of traced modules, the parameter shapes,
+    and the sharding metadata. Two schedules with the same fingerprint
+    result in the same model.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule.
+
+    Returns
+    -------
+    str
+        The fingerprint.
+    """
+    digest = hashlib.sha256()
+    for name, mod in sch.mod.named_modules():
+        digest.update(f"{name}:{type(mod).__name__}\n".encode())
+        if isinstance(mod, fx.GraphModule):
+            digest.update(mod.code.encode())
+    for name, param in sch.mod.named_parameters():
+        digest.update(f"{name}:{tuple(param.shape)}:{param.dtype}\n".encode())
+    for path, subsch in sch.named_schedules():
+        shard_meta = subsch.metadata.primitives.get("shard", None)
+        if shard_meta:
+            digest.update(f"{path}:{sorted(shard_meta.items())}\n".encode())
+    return digest.hexdigest()
+
+
+class ScheduleLog:
+    """The log of the primitives applied to a schedule.
+
+    Each entry includes the path of the schedule, the name of the
+    primitive (or schedule method such as `trace`), and its pickled
+    arguments. Objects in the model are pickled as references, so that
+    the log can be replayed onto a fresh model. For example:
+
+    .. code-block:: python
+
+        sch = slapo.create_schedule(model)
+        with slapo.record(sch) as log:
+            schedule_fn(sch)
+        log.save("schedule.pkl")
+
+        sch = slapo.create_schedule(fresh_model)
+        slapo.ScheduleLog.load("schedule.pkl").replay(sch)
+    """
+
+    def __init__(self):
+        # A list of (path, name, pickled arguments, error message).
+        self.entries = []
+        # The fingerprint of the schedule after applying all entries.
+        self.fingerprint = None
+        # The depth of the primitive calls, as primitives may call
+        # other primitives (e.g., fuse calls replace).
+        self.depth = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, sch, name, fn, args, kwargs):
+        """Apply and record a primitive. The nested primitives are not
+        recorded, as they are applied by the outer-most primitive.
+
+        Parameters
+        ----------
+        sch : Schedule
+            The schedule to apply the primitive.
+        name : str
+            The name of the primitive.
+        fn : Callable
+            The function to apply the primitive, which takes the schedule
+            as the first argument.
+        args : tuple
+            The positional arguments of the primitive.
+        kwargs : dict
+            The keyword arguments of the primitive.
+
+        Returns
+        -------
+        Any
+            The return value of the primitive.
+        """
+        if self.depth > 0:
+            return fn(sch, *args, **kwargs)
+
+        # The arguments have to be pickled before applying the primitive,
+        # because the referenced objects may be changed by the primitive.
+        buffer = io.BytesIO()
+        error = None
+        try:
+            _ArgPickler(buffer, sch.get_top_schedule()).dump((args, kwargs))
+        except (pickle.PicklingError, AttributeError, TypeError) as err:
+            error = f"Cannot serialize the arguments of {name} on {sch.path}: {err}"
+            logger.warning(error)
+
+        self.depth += 1
+        try:
+            ret = fn(sch, *args, **kwargs)
+        finally:
+            self.depth -= 1
+        self.entries.append((sch.path, name, buffer.getvalue(), error))
+        return ret
+
+    def save(self, path: str):
+        """Save the log to a file.
+
+        Parameters
+        ----------
+        path : str
+            The file path.
+        """
+        for entry_path, name, _, error in self.entries:
+            if error is not None:
+                raise ValueError(
+                    f"Cannot save the schedule log because {name} on "
+                    f"'{entry_path}' is not serializable: {error}"
+                )
+        with open(path, "wb") as filep:
+            pickle.dump(
+                {
+                    "version": LOG_FORMAT_VERSION,
+                    "entries": [entry[:3] for entry in self.entries],
+                    "fingerprint": self.fingerprint,
+                },
+                filep,
+            )
+
+    @staticmethod
+    def load(path: str):
+        """Load a log from a file.
+
+        Parameters
+        ----------
+        path : str
+            The file path.
+
+        Returns
+        -------
+        ScheduleLog
+            The loaded log.
+        """
+        with open(path, "rb") as filep:
+            data = pickle.load(filep)
+        if data["version"] != LOG_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported schedule log version {data['version']}, "
+                f"expected {LOG_FORMAT_VERSION}"
+            )
+        log = ScheduleLog()
+        log.entries = [(*entry, None) for entry in data["entries"]]
+        log.fingerprint = data["fingerprint"]
+        return log
+
+    def replay(self, sch, verify: bool = True):
+        """Replay the log onto a schedule of a fresh model.
+
+        Parameters
+        ----------
+        sch : Schedule
+            The top schedule of the model, which has to be the same as the
+            model that the log was recorded on.
+        verify : bool
+            Whether to verify the replayed schedule results in the same model
+            as the recorded one.
+
+        Returns
+        -------
+        Schedule
+            The replayed schedule.
+        """
+        for path, name, payload, _ in self.entries:
+            args, kwargs = _ArgUnpickler(io.BytesIO(payload), sch).load()
+            target = sch[path] if path else sch
+            getattr(target, name)(*args, **kwargs)
+
+        if verify and self.fingerprint is not None:
+            fingerprint = schedule_fingerprint(sch)
+            if fingerprint != self.fingerprint:
+                raise RuntimeError(
+                    "The replayed schedule is not equivalent to the recorded one"
+                )
+        return sch
+
+
+@contextmanager
+def record(sch, log: Optional[ScheduleLog] = None):
+    """Record the primitives applied to the schedule within the context.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The top schedule.
+    log : Optional[ScheduleLog]
+        The log to append the records. If None, create a new one.
+
+    Yields
+    ------
+    ScheduleLog
+        The log of the applied primitives.
+    """
+    if sch.parent is not None:
+        raise ValueError("Recording can only be enabled on the top schedule")
+    if sch.recorder is not None:
+        raise RuntimeError("The schedule is already being recorded")
+    log = log if log is not None else ScheduleLog()
+    sch.recorder = log
+    try:
+        yield log
+    finally:
+        sch.recorder = None
+    log.fingerprint = schedule_fingerprint(sch)
+
+
+def recordable(fn):
+    """Record the decorated schedule method when the schedule is recorded."""
+
+    @functools.wraps(fn)
+    def wrapper(sch, *args: Any, **kwargs: Any):
+        recorder = sch.get_top_schedule().recorder
+        if recorder is None:
+            return fn(sch, *args, **kwargs)
+        return recorder.record(sch, fn.__name__, fn, args, kwargs)
+
+    return wrapper
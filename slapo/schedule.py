@@ -1,15 +1,15 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-# pylint: disable=exec-used
 from __future__ import annotations
 
+import functools
 import re
 from collections import OrderedDict
+from contextlib import contextmanager
 from collections.abc import Callable
 from dataclasses import dataclass, field
-from functools import partial
-from types import FunctionType
+from types import FunctionType, MethodType
 from typing import Any, Optional
 
 import torch
@@ -22,12 +22,27 @@ from .pipeline import analyze_tie_weights
 
 from .tracer import trace as trace_module
 from .utils.common import is_module_list
-from .utils.mapping import MAPPING_FROM_FUNCTIONAL_TO_MODULE
-from .pattern import Pattern, ModulePattern
+from .matcher import compile_pattern
+from .pattern import Pattern
+from .recorder import recordable
 
 logger = get_logger()
 
 
+class PrimitiveMetadata(OrderedDict):
+    """The primitive specific metadata of a schedule. The metadata of a
+    primitive is initialized when it is accessed for the first time, so that
+    schedules of the modules that are not scheduled do not allocate it.
+    """
+
+    def __missing__(self, key):
+        if key not in PRIMITIVES:
+            raise KeyError(key)
+        value = PRIMITIVES[key].init_metadata()
+        self[key] = value
+        return value
+
+
 @dataclass
 class ScheduleMetadata:
     """The metadata of a schedule. It is used to store the metadata of
@@ -54,10 +69,32 @@ class ScheduleMetadata:
     param_tags: set[str] = field(default_factory=set)
 
     # Primitive specific metadata.
-    primitives: dict[str, Any] = field(default_factory=lambda: OrderedDict())
+    primitives: dict[str, Any] = field(default_factory=PrimitiveMetadata)
 
 
 class Schedule:
+    # A schedule is created for every module in the model, so its attributes
+    # are fixed to keep it compact. Primitives are not bound to each schedule
+    # but looked up on demand in __getattr__.
+    __slots__ = (
+        "group",
+        "world_size",
+        "rank",
+        "mod",
+        "name",
+        "path",
+        "parent",
+        "_child",
+        "lazy",
+        "metadata",
+        "_path_index",
+        "module_index",
+        "called_modules",
+        "partition_idx",
+        "recorder",
+        "pending_updates",
+    )
+
     def __init__(
         self,
         mod: nn.Module,
@@ -65,8 +102,13 @@ class Schedule:
         path: str = "",
         parent: Optional["Schedule"] = None,
         group: Optional[dist.ProcessGroup] = None,
+        lazy: bool = False,
     ):
-        if dist.is_initialized():
+        if parent is not None and parent.group is group:
+            # Reuse the world size and rank of the parent in the same group.
+            world_size = parent.world_size
+            rank = parent.rank
+        elif dist.is_initialized():
             world_size = dist.get_world_size(group)
             rank = dist.get_rank(group)
         else:
@@ -80,8 +122,43 @@ class Schedule:
         self.name = name
         self.path = path
         self.parent = parent
-        self.child = {}
-        self.metadata = ScheduleMetadata()
+        self._child = {}
+        # Whether to create child schedules when they are accessed for the
+        # first time. Child schedules are created by create_schedule in lazy
+        # mode, and _child is None until they are created.
+        self.lazy = lazy
+        if parent is None:
+            self.metadata = ScheduleMetadata()
+        else:
+            # Inherit tie_weights from parent.
+            self.metadata = ScheduleMetadata(tie_weights=parent.metadata.tie_weights)
+
+        # A mapping from the full path (from the top module) to the schedule.
+        # It is only stored on the top schedule and shared by all schedules in
+        # the same tree via `path_index`, so that looking up a schedule by its
+        # path does not have to walk the schedule tree.
+        self._path_index = {} if parent is None else None
+
+        # A mapping from the module name to the module (i.e., named_modules)
+        # of this schedule. It is lazily built and invalidated when the module
+        # hierarchy is changed by primitives such as replace.
+        self.module_index = None
+        # The set of submodule names called in the traced graph of this
+        # schedule. It is invalidated together with the module index.
+        self.called_modules = None
+
+        # The pipeline stage of this module, which is annotated when
+        # partitioning the model into pipeline stages.
+        self.partition_idx = None
+
+        # The log that records the primitives applied to the schedule tree.
+        # It is only set on the top schedule within `slapo.record`.
+        self.recorder = None
+
+        # The schedules whose graphs have to be cleaned up and recompiled at
+        # the end of the current batch. It is only set on the top schedule
+        # within `batch`.
+        self.pending_updates = None
 
         if parent is None:
             # Tie weight analysis only at the top level module.
@@ -90,14 +167,39 @@ class Schedule:
             # scheduling (e.g., sharding).
             for param in analyze_tie_weights(mod, False):
                 self.metadata.tie_weights[param] = param
-        else:
-            # Inherit tie_weights from parent.
-            self.metadata.tie_weights = parent.metadata.tie_weights
 
-        # Register primitives.
-        for pname, cls in PRIMITIVES.items():
-            setattr(self, pname, partial(cls.apply, self))
-            self.metadata.primitives[pname] = cls.init_metadata()
+    def __getattr__(self, name):
+        # Only called when the attribute is not found, so that primitives
+        # are bound to the schedule on demand.
+        if name in PRIMITIVES:
+            recorder = self.get_top_schedule().recorder
+            if recorder is not None:
+
+                @functools.wraps(PRIMITIVES[name].apply)
+                def apply(*args, **kwargs):
+                    return recorder.record(
+                        self, name, PRIMITIVES[name].apply, args, kwargs
+                    )
+
+                return apply
+            return MethodType(PRIMITIVES[name].apply, self)
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'"
+        )
+
+    def __dir__(self):
+        return list(super().__dir__()) + list(PRIMITIVES.keys())
+
+    @property
+    def child(self):
+        if self._child is None:
+            # Create the child schedules in lazy mode.
+            self._child = create_child_schedules(self)
+        return self._child
+
+    @child.setter
+    def child(self, child):
+        self._child = child
 
     @staticmethod
     def tokenize_module_path(module_path: str) -> list[str]:
@@ -120,10 +222,83 @@ class Schedule:
         else:
             setattr(mod, submod_name, new_submod)
 
+    def get_full_path(self, sub_path: str = "") -> str:
+        """Get the full path (from the top module) of a sub-schedule.
+
+        Parameters
+        ----------
+        sub_path : str
+            The path relative to this schedule. If empty, return the path
+            of this schedule.
+
+        Returns
+        -------
+        str
+            The full path.
+        """
+        if not sub_path:
+            return self.path
+        return f"{self.path}.{sub_path}" if self.path else sub_path
+
+    @property
+    def path_index(self) -> dict[str, "Schedule"]:
+        """The path index of the schedule tree, which is stored on the top
+        schedule, so that it is still shared after the parents are changed
+        (e.g., by replacing a schedule).
+        """
+        top_sch = self.get_top_schedule()
+        if top_sch._path_index is None:
+            top_sch._path_index = {}
+        return top_sch._path_index
+
+    def register_path(self, sch: "Schedule"):
+        """Register a schedule to the path index."""
+        if sch.path:
+            self.path_index[sch.path] = sch
+
+    def invalidate_path_index(self, sub_path: str = ""):
+        """Invalidate the cached lookups of a sub-schedule and all its descendants.
+        This has to be called whenever the child schedules are changed.
+
+        Parameters
+        ----------
+        sub_path : str
+            The path relative to this schedule. If empty, invalidate
+            all descendants of this schedule.
+        """
+        full_path = self.get_full_path(sub_path)
+        if not full_path:
+            self.path_index.clear()
+            return
+        path_index = self.path_index
+        sch = path_index.pop(full_path, None)
+        if sch is None:
+            try:
+                sch = self._lookup(sub_path) if sub_path else self
+            except KeyError:
+                return
+        # Only walk the subtree, because the descendants are indexed by
+        # their paths.
+        stack = [sch]
+        while stack:
+            for child in stack.pop().child.values():
+                if child:
+                    path_index.pop(child.path, None)
+                    stack.append(child)
+
     def __getitem__(self, full_path):
         if not full_path:
             return self
 
+        key = self.get_full_path(full_path)
+        if key in self.path_index:
+            return self.path_index[key]
+        curr_sch = self._lookup(full_path)
+        self.path_index[key] = curr_sch
+        return curr_sch
+
+    def _lookup(self, full_path):
+        """Look up a sub-schedule by walking the schedule tree."""
         curr_sch = self
         for token in self.tokenize_module_path(full_path):
             sub_tokens = token.split(".")
@@ -144,6 +319,8 @@ class Schedule:
         return curr_sch
 
     def __contains__(self, full_path):
+        if self.get_full_path(full_path) in self.path_index:
+            return True
         curr_sch = self
         for token in self.tokenize_module_path(full_path):
             if token not in curr_sch.child:
@@ -158,8 +335,54 @@ class Schedule:
             return self
         return self.parent.get_top_schedule()
 
+    def get_module_index(self):
+        """Get the mapping from the module name to the module of this schedule.
+        The mapping is cached until the module hierarchy is changed.
+
+        Returns
+        -------
+        dict[str, nn.Module]
+            The mapping from the module name to the module.
+        """
+        if self.module_index is None:
+            self.module_index = dict(self.mod.named_modules())
+        return self.module_index
+
+    def invalidate_module_index(self):
+        """Invalidate the cached module index of this schedule and its ancestors,
+        because the module hierarchy of ancestors also includes this module.
+        This has to be called whenever the module hierarchy is changed.
+        """
+        curr_sch = self
+        while curr_sch is not None:
+            curr_sch.module_index = None
+            curr_sch.called_modules = None
+            curr_sch = curr_sch.parent
+
+    def get_called_modules(self):
+        """Get the names of the submodules directly called in the traced
+        graph of this schedule. The set is cached until the module
+        hierarchy is changed.
+
+        Returns
+        -------
+        set[str]
+            The names of the called submodules. Empty if this schedule
+            is not traced.
+        """
+        if self.called_modules is None:
+            if isinstance(self.mod, fx.GraphModule):
+                self.called_modules = {
+                    node.target
+                    for node in self.mod.graph.nodes
+                    if node.op == "call_module"
+                }
+            else:
+                self.called_modules = set()
+        return self.called_modules
+
     def get_module(self, name):
-        return dict(self.mod.named_modules())[name]
+        return self.get_module_index()[name]
 
     def named_schedules(self, prefix: str = ""):
         r"""Returns an iterator over all subschedules in the current schedule, yielding
@@ -237,6 +460,8 @@ class Schedule:
             )
         self.trace()
 
+        if isinstance(regex_or_pattern_fn, str):
+            regex = re.compile(regex_or_pattern_fn)
         res = []
         for name, mod in self.mod.named_modules():
             if not isinstance(mod, fx.GraphModule):
@@ -244,9 +469,7 @@ class Schedule:
 
             for node in mod.graph.nodes:
                 if isinstance(regex_or_pattern_fn, str):
-                    if node.op == "call_module" and re.match(
-                        regex_or_pattern_fn, node.target
-                    ):
+                    if node.op == "call_module" and regex.match(node.target):
                         res.append((name, node))
                 elif regex_or_pattern_fn(node):
                     res.append((name, node))
@@ -272,129 +495,47 @@ class Schedule:
             belongs to, and the matched node object.
         """
 
-        named_modules = dict(self.mod.named_modules())
-        assert isinstance(pattern_fn, (FunctionType, Pattern))
-
-        def find_match_subgraph(curr, target, subgraph):
-            if target.op == "output":
-                # "output" always matches.
-                return True
-            if (parent_name, curr) in all_nodes:
-                # Already matched.
-                return False
-            if not (
-                (curr.op == target.op and curr.target == target.target)  # exactly match
-                or (  # nn.Module and nn.functional are viewed as the same
-                    curr.op == "call_module"
-                    and target.op == "call_function"
-                    and MAPPING_FROM_FUNCTIONAL_TO_MODULE.get(target.target, None)
-                    == type(named_modules.get(curr.target, None))
-                )
-                or (  # use pattern language to match
-                    curr.op == "call_module"
-                    and target.op == "call_function"
-                    and target.target.__name__ == "call_module"
-                    and re.match(target.args[0], curr.target)
-                )
-                or (  # use pattern class for matching
-                    curr.op == "call_module"
-                    and target.op == "call_module"
-                    and type(dict(pattern_mod.named_modules())[target.target])
-                    is type(named_modules.get(curr.target, None))
-                )
-                or (  # use pattern lanauge + pattern class for matching
-                    curr.op == "call_module"
-                    and target.op == "call_module"
-                    and isinstance(
-                        dict(pattern_mod.named_modules())[target.target], ModulePattern
-                    )
-                    and re.match(
-                        dict(pattern_mod.named_modules())[target.target].name,
-                        curr.target,
-                    )
-                )
-            ):
-                # Not matched.
-                return False
-            if (parent_name, curr) not in subgraph:
-                # New matched.
-                subgraph.append((parent_name, curr))
-            ptr = curr.next
-            found = False
-            # This loop is supposed to tackle the following case that the
-            # user of the current node is not the immediate successor, which requires
-            # iteratively traverse the graph until it finds the user or reaches the
-            # end of the graph. An example is shown below:
-            # original graph:
-            #  x = a + b
-            #  y = c + d (totally independent from x)
-            #  z = x + 1
-            # pattern graph:
-            #  m = p + q
-            #  n = m + 1
-            # should match:
-            #  x = a + b
-            #  z = x + 1
-            # The implication here is that the generated pattern graph should follows **the same
-            # topological order** of the original graph. Otherwise, the current implementation
-            # will not be able to match the pattern graph. In general, subgraph isomorphism
-            # is an NP-complete problem, and the current implementation is a greedy algorithm
-            # that leverages the property of sequential representation of the computation graph.
-            #
-            # The successor of the last operation of the fx graph is binded to the root node,
-            # so when ptr.op == "root", it means it reaches the end of the graph.
-            while ptr.op != "root":
-                if find_match_subgraph(ptr, target.next, subgraph):
-                    found = True
-                    break
-                ptr = ptr.next
-            return found
-
+        compiled = compile_pattern(pattern_fn)
         self.trace()
+        graph_modules = [
+            (name, mod)
+            for name, mod in self.mod.named_modules()
+            if isinstance(mod, fx.GraphModule)
+        ]
+        return compiled.match(graph_modules, self.get_module_index())
+
+    def find_subgraph_in(self, paths, pattern_fn):
+        """Find a subgraph in the static dataflow graphs of multiple
+        sub-modules, such as all the layers of a model. The pattern is only
+        traced and compiled once, and the graphs of each sub-module are only
+        scanned once.
 
-        if pattern_fn is not None:
-            if isinstance(pattern_fn, Pattern):
-                pattern_mod = trace_module(
-                    pattern_fn,
-                    recursive=True,
-                    flatten=True,
-                    leaf_modules=["ModulePattern"],
-                )
-            else:
-                # Workaround for fx wrap functions:
-                # https://github.com/pytorch/pytorch/issues/53534
-                if "call_module" in pattern_fn.__globals__:
-                    exec(
-                        "import torch.fx; torch.fx.wrap('call_module')",
-                        pattern_fn.__globals__,
-                    )
-                pattern_mod = fx.symbolic_trace(pattern_fn)
-        assert isinstance(pattern_mod, fx.GraphModule)
-
-        first_op = None
-        for target_node in list(pattern_mod.graph.nodes):
-            # get the first NON-placeholder,
-            # i.e., the first compute op of the target graph
-            if target_node.op != "placeholder":
-                first_op = target_node
-                break
-        else:
-            raise RuntimeError("Cannot find the first non-placeholder operator")
+        Parameters
+        ----------
+        paths : List[str]
+            The paths to the sub-modules.
+        pattern_fn : Union[FunctionType, Pattern]
+            This argument specifies the subgraph pattern.
 
-        res = []
-        all_nodes = []
-        for parent_name, submod in self.mod.named_modules():
-            if not isinstance(submod, fx.GraphModule):
-                continue
-            for node in submod.graph.nodes:
-                if node.op == "placeholder":
-                    continue
-                subgraph = []
-                target_node = first_op
-                curr_node = node
-                if find_match_subgraph(curr_node, target_node, subgraph):
-                    all_nodes.extend(subgraph)
-                    res.append(subgraph.copy())
+        Returns
+        -------
+        Dict[str, List[List[Tuple[str, fx.Node]]]]
+            The mapping from each path to the matched subgraphs in the
+            sub-module. The parent module names in the subgraphs are relative
+            to the sub-module, so the subgraphs can be directly used by the
+            schedule of the sub-module, e.g., `sch[path].fuse(subgraphs)`.
+        """
+        compiled = compile_pattern(pattern_fn)
+        res = {}
+        for path in paths:
+            sch = self[path]
+            sch.trace()
+            graph_modules = [
+                (name, mod)
+                for name, mod in sch.mod.named_modules()
+                if isinstance(mod, fx.GraphModule)
+            ]
+            res[path] = compiled.match(graph_modules, sch.get_module_index())
         return res
 
     def find(self, regex_or_pattern_fn):
@@ -425,6 +566,37 @@ class Schedule:
             return self.find_node(regex_or_pattern_fn)
         raise RuntimeError(f"Unrecognized pattern type {type(regex_or_pattern_fn)}")
 
+    @contextmanager
+    def batch(self):
+        """Defer the graph clean up, recompilation and the update of child
+        schedules after each replacement to the end of the context, so that
+        they are only performed once per graph. For example:
+
+        .. code-block:: python
+
+            with sch.batch():
+                for subgraph in sch.find(pattern):
+                    sch.replace(new_func, subgraph)
+
+        Within the context, the generated code of the modified graphs is
+        outdated, and the child schedules of replaced submodules are not
+        removed until the end of the context.
+        """
+        top = self.get_top_schedule()
+        if top.pending_updates is not None:
+            # Nested batches are merged into the outer-most one.
+            yield
+            return
+        top.pending_updates = {}
+        try:
+            yield
+        finally:
+            pending_updates = top.pending_updates
+            top.pending_updates = None
+            for sch in pending_updates.values():
+                PRIMITIVES["replace"].update_graph(sch)
+
+    @recordable
     def trace_until(self, paths, **kwargs):
         """A syntax sugar that traces from the top module until the sub-module
         specified in path, so that we can apply computation optimization, such as
@@ -459,6 +631,7 @@ class Schedule:
             concrete_args=concrete_args,
         )
 
+    @recordable
     def trace(self, recursive=True, flatten=False, **kwargs):
         if isinstance(self.mod, fx.GraphModule):
             return True
@@ -506,12 +679,58 @@ def list_primitives(name_only=True):
     return list(PRIMITIVES.keys()) if name_only else PRIMITIVES
 
 
+def create_child_schedules(sch: Schedule):
+    """Create the schedules of the immediate children of the given schedule.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The parent schedule.
+
+    Returns
+    -------
+    dict[str, Schedule]
+        The mapping from the child name to the child schedule.
+    """
+    child_schedules = {}
+    for child_name, submod in sch.mod.named_children():
+        next_path = sch.get_full_path(child_name)
+        if is_module_list(submod, name=sch.name, parent=sch.parent):
+            # We assume ModuleList will be iteratively traversed in forward function.
+            # For example:
+            # In __init__: self.layers = nn.ModuleList([nn.Linear(10, 10) for _ in range(3)])
+            # In forwrad :
+            #     for layer in self.layers:
+            #         x = layer(x)
+            # In this case, we register submodule as layer.0, layer.1, etc.
+            for name_idx, layer in submod.named_children():
+                child_schedules[f"{child_name}.{name_idx}"] = create_schedule(
+                    layer,
+                    f"{child_name}.{name_idx}",
+                    f"{next_path}.{name_idx}",
+                    sch,
+                    sch.group,
+                    lazy=sch.lazy,
+                )
+        else:
+            # For other submodules including nn.Sequential, we assume they are directly
+            # called in forward function. For example:
+            # In __init__: self.block = nn.Sequential(...)
+            # In forward : out = self.block(x)
+            # In this case, fx IR will create directly call the submodule such as block.
+            child_schedules[child_name] = create_schedule(
+                submod, child_name, next_path, sch, sch.group, lazy=sch.lazy
+            )
+    return child_schedules
+
+
 def create_schedule(
     root: nn.Module,
     name: str = "",
     path: str = "",
     parent: Optional[Schedule] = None,
     group: Optional[dist.ProcessGroup] = None,
+    lazy: Optional[bool] = None,
     **kwargs,
 ):
     """Create a schedule for the given module and preserve the module hierarchy.
@@ -528,6 +747,12 @@ def create_schedule(
         The parent schedule. None if the module is the top module.
     group : Optional[dist.ProcessGroup]
         The process group for the module. If None, use all available devices.
+    lazy : Optional[bool]
+        Whether to create the schedules of submodules when they are accessed
+        for the first time (e.g., via `sch[path]`, `child`, or `named_schedules`),
+        so that the creation time only depends on the number of scheduled
+        submodules. If None, follow the parent schedule, or False if this is the
+        top module.
     **kwargs
         Additional arguments for the schedule.
 
@@ -543,39 +768,16 @@ def create_schedule(
             or module.__module__.startswith("torch.ao.nn")
         ) and not isinstance(module, torch.nn.Sequential)
 
-    root_sch = Schedule(root, name, path, parent, group, **kwargs)
+    if lazy is None:
+        lazy = parent.lazy if parent is not None else False
+    root_sch = Schedule(root, name, path, parent, group, lazy=lazy, **kwargs)
+    root_sch.register_path(root_sch)
     if is_leaf(root):
         return root_sch
 
-    child_schedules = {}
-    for child_name, submod in root.named_children():
-        next_path = f"{path}.{child_name}" if path else child_name
-        if is_module_list(submod, name=name, parent=parent):
-            # We assume ModuleList will be iteratively traversed in forward function.
-            # For example:
-            # In __init__: self.layers = nn.ModuleList([nn.Linear(10, 10) for _ in range(3)])
-            # In forwrad :
-            #     for layer in self.layers:
-            #         x = layer(x)
-            # In this case, we register submodule as layer.0, layer.1, etc.
-            for name_idx, layer in submod.named_children():
-                child_schedules[f"{child_name}.{name_idx}"] = create_schedule(
-                    layer,
-                    f"{child_name}.{name_idx}",
-                    f"{next_path}.{name_idx}",
-                    root_sch,
-                    group,
-                    **kwargs,
-                )
-        else:
-            # For other submodules including nn.Sequential, we assume they are directly
-            # called in forward function. For example:
-            # In __init__: self.block = nn.Sequential(...)
-            # In forward : out = self.block(x)
-            # In this case, fx IR will create directly call the submodule such as block.
-            child_schedules[child_name] = create_schedule(
-                submod, child_name, next_path, root_sch, group, **kwargs
-            )
-
-    root_sch.child = child_schedules
+    if lazy:
+        # The child schedules will be created when they are accessed.
+        root_sch.child = None
+    else:
+        root_sch.child = create_child_schedules(root_sch)
     return root_sch
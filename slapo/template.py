@@ -0,0 +1,380 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Apply a schedule function to one layer and stamp the same transformation
+onto the structurally identical layers, such as the layers of a transformer
+model, without re-running the schedule function (e.g., pattern matching)
+on every layer.
+"""
+from __future__ import annotations
+
+import contextlib
+import copy
+from collections.abc import Callable
+from typing import Union
+
+import torch
+from torch import fx, nn
+from torch.fx import graph_module
+
+from .logger import get_logger
+from .recorder import schedule_fingerprint
+from .trace_cache import _module_signature
+
+logger = get_logger()
+
+
+class _Unstampable(Exception):
+    """Raised when a primitive cannot be stamped onto other layers."""
+
+
+class _Ref:
+    """A reference to an object in the template layer.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of the object, including "schedule", "module", "param"
+        and "node".
+    name : str
+        The name of the object relative to the template layer. For nodes,
+        this is the name of the graph module that owns the node.
+    node_name : Optional[str]
+        The name of the node.
+    """
+
+    __slots__ = ("kind", "name", "node_name")
+
+    def __init__(self, kind, name, node_name=None):
+        self.kind = kind
+        self.name = name
+        self.node_name = node_name
+
+
+def _relative_path(root, sch):
+    """The path of a schedule relative to the root schedule."""
+    if sch is root:
+        return ""
+    prefix = f"{root.path}." if root.path else ""
+    if not sch.path.startswith(prefix):
+        raise _Unstampable(f"Schedule {sch.path} is not in {root.path}")
+    return sch.path[len(prefix) :]
+
+
+def _map_args(args, fn):
+    """Apply a function to each leaf of nested lists, tuples and dicts."""
+    if isinstance(args, tuple) and hasattr(args, "_fields"):
+        return type(args)(*(_map_args(arg, fn) for arg in args))
+    if isinstance(args, (list, tuple)):
+        return type(args)(_map_args(arg, fn) for arg in args)
+    if isinstance(args, dict):
+        return {key: _map_args(arg, fn) for key, arg in args.items()}
+    return fn(args)
+
+
+# The types of the node arguments whose generated code only depends on
+# their values.
+_CONSTANT_TYPES = (
+    type(None),
+    bool,
+    int,
+    float,
+    str,
+    slice,
+    type(Ellipsis),
+    torch.dtype,
+    torch.device,
+    torch.layout,
+    torch.memory_format,
+)
+
+
+def _graph_key(graph, args, kwargs):
+    """The key of the code generated for a graph, or None if the code may
+    refer to objects that are not shared by the layers.
+    """
+
+    def arg_key(arg):
+        if isinstance(arg, fx.Node):
+            return f"%{arg.name}"
+        if not isinstance(arg, _CONSTANT_TYPES):
+            raise _Unstampable(f"Cannot generate the key of {type(arg)}")
+        return f"{type(arg).__name__}:{arg!r}"
+
+    try:
+        key = [repr(args), repr(sorted(kwargs.items())), type(graph._codegen)]
+        pytree_info = getattr(graph._codegen, "pytree_info", None)
+        if pytree_info is not None:
+            key.append(repr(pytree_info))
+        for node in graph.nodes:
+            target = node.target if isinstance(node.target, str) else id(node.target)
+            key.append(
+                (
+                    node.op,
+                    node.name,
+                    target,
+                    repr(node.type),
+                    repr(_map_args((node.args, node.kwargs), arg_key)),
+                )
+            )
+        return tuple(key)
+    except _Unstampable:
+        return None
+
+
+@contextlib.contextmanager
+def _share_codegen():
+    """Reuse the code generated and compiled for identical graphs, so that
+    recompiling the graph modules of the stamped layers does not generate
+    and compile the same code again.
+    """
+    python_code = fx.Graph.python_code
+    forward_from_src = graph_module._forward_from_src
+    # Map from graph keys to the generated code.
+    codes = {}
+    # Map from the code and globals to the compiled forward functions.
+    forwards = {}
+
+    def cached_python_code(graph, *args, **kwargs):
+        key = _graph_key(graph, args, kwargs)
+        if key is None:
+            return python_code(graph, *args, **kwargs)
+        if key not in codes:
+            codes[key] = python_code(graph, *args, **kwargs)
+        return codes[key]
+
+    def cached_forward_from_src(src, globals_, *args, **kwargs):
+        key = (src, id(globals_))
+        if key not in forwards:
+            # Keep the globals alive so that their ID is not reused.
+            forwards[key] = (forward_from_src(src, globals_, *args, **kwargs), globals_)
+        return forwards[key][0]
+
+    fx.Graph.python_code = cached_python_code
+    graph_module._forward_from_src = cached_forward_from_src
+    try:
+        yield
+    finally:
+        fx.Graph.python_code = python_code
+        graph_module._forward_from_src = forward_from_src
+
+
+class TemplateRecorder:
+    """Record the primitives applied to the template layer with the
+    references to the objects in it, so that they can be resolved in
+    other layers.
+
+    Parameters
+    ----------
+    top : Schedule
+        The top schedule.
+    path : str
+        The full path of the template layer.
+    outer : Optional[ScheduleLog]
+        The recorder that was attached to the top schedule. The primitives
+        are also passed to it.
+    """
+
+    def __init__(self, top, path, outer=None):
+        self.top = top
+        self.path = path
+        self.outer = outer
+        # A list of (relative path, name, args, kwargs).
+        self.entries = []
+        # The reason why the primitives cannot be stamped, if any.
+        self.error = None
+        self.depth = 0
+
+    @property
+    def root(self):
+        # The schedule of the template layer may be re-created by primitives
+        # such as trace, so it is always looked up by its path.
+        return self.top[self.path]
+
+    def _make_ref(self, obj, module_names, param_names):
+        # Avoid importing Schedule that imports this module.
+        if type(obj).__name__ == "Schedule" and hasattr(obj, "get_top_schedule"):
+            return _Ref("schedule", _relative_path(self.root, obj))
+        if isinstance(obj, fx.Node):
+            owning_mod = obj.graph.owning_module
+            if id(owning_mod) not in module_names:
+                raise _Unstampable(f"Node {obj.name} is not in {self.path}")
+            return _Ref("node", module_names[id(owning_mod)], obj.name)
+        if isinstance(obj, nn.Parameter) and id(obj) in param_names:
+            return _Ref("param", param_names[id(obj)])
+        if isinstance(obj, nn.Module) and id(obj) in module_names:
+            return _Ref("module", module_names[id(obj)])
+        return obj
+
+    def record(self, sch, name, fn, args, kwargs):
+        """Apply and record a primitive. The interface is the same as
+        `ScheduleLog.record`.
+        """
+        if self.depth > 0:
+            return fn(sch, *args, **kwargs)
+
+        if self.error is None:
+            root = self.root
+            root_mod = root.mod
+            module_names = {id(mod): n for n, mod in root_mod.named_modules()}
+            param_names = {id(param): n for n, param in root_mod.named_parameters()}
+            try:
+                self.entries.append(
+                    (
+                        _relative_path(root, sch),
+                        name,
+                        *_map_args(
+                            (args, kwargs),
+                            lambda obj: self._make_ref(obj, module_names, param_names),
+                        ),
+                    )
+                )
+            except _Unstampable as err:
+                self.error = str(err)
+
+        self.depth += 1
+        try:
+            if self.outer is not None:
+                return self.outer.record(sch, name, fn, args, kwargs)
+            return fn(sch, *args, **kwargs)
+        finally:
+            self.depth -= 1
+
+    def stamp(self, layer_path):
+        """Apply the recorded primitives to another layer.
+
+        Parameters
+        ----------
+        layer_path : str
+            The full path of the layer.
+        """
+        for path, name, args, kwargs in self.entries:
+            sch = self.top[layer_path]
+            node_maps = {}
+
+            def resolve(obj):
+                if isinstance(obj, _Ref):
+                    # pylint: disable=cell-var-from-loop
+                    if obj.kind == "schedule":
+                        return sch[obj.name]
+                    if obj.kind == "module":
+                        return sch.mod.get_submodule(obj.name)
+                    if obj.kind == "param":
+                        return sch.mod.get_parameter(obj.name)
+                    if obj.name not in node_maps:
+                        graph_mod = sch.mod.get_submodule(obj.name)
+                        node_maps[obj.name] = {
+                            node.name: node for node in graph_mod.graph.nodes
+                        }
+                    return node_maps[obj.name][obj.node_name]
+                if isinstance(obj, nn.Module):
+                    # New modules (e.g., the ones to replace with) cannot be
+                    # shared by layers.
+                    return copy.deepcopy(obj)
+                return obj
+
+            args, kwargs = _map_args((args, kwargs), resolve)
+            getattr(sch[path], name)(*args, **kwargs)
+
+
+def apply_template(
+    sch,
+    paths: Union[str, list[str]],
+    schedule_fn: Callable,
+    verify: bool = True,
+):
+    """Apply a schedule function to the first layer, and stamp the applied
+    primitives onto the rest layers. The primitives are replayed with their
+    arguments referring to the corresponding objects (e.g., the nodes
+    returned by `find`) in each layer, so the searches and other logic in
+    the schedule function only run once. The code generated for the graph
+    modules of the first layer is also reused by the identical graph modules
+    of the rest layers instead of being generated again. For example:
+
+    .. code-block:: python
+
+        def fuse_fn(subsch):
+            subsch.trace(flatten=True)
+            subsch.fuse(subsch.find(pattern), compiler="TorchScript")
+
+        slapo.apply_template(sch, "encoder.layer", fuse_fn)
+
+    The layers must be structurally identical, and the schedule function
+    must only change the layer via the primitives of its schedules. The
+    modules created by the schedule function are copied for each layer, so
+    their parameters are not shared. The layers that are not structurally
+    identical to the first one are scheduled by calling the schedule
+    function directly.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule that contains the layers.
+    paths : Union[str, list[str]]
+        The paths of the layers relative to `sch`, or the path of the
+        nn.ModuleList of the layers.
+    schedule_fn : Callable
+        The schedule function that takes the schedule of a layer.
+    verify : bool
+        Whether to verify that each stamped layer is the same as the
+        first one after scheduling.
+
+    Returns
+    -------
+    list[Schedule]
+        The schedules of the layers.
+    """
+    if isinstance(paths, str):
+        mod_list = sch.mod.get_submodule(paths)
+        if not isinstance(mod_list, nn.ModuleList):
+            raise ValueError(f"{paths} is not an nn.ModuleList")
+        paths = [f"{paths}.{idx}" for idx in range(len(mod_list))]
+    if not paths:
+        return []
+
+    layers = [sch[path] for path in paths]
+    template = layers[0]
+    signature = _module_signature(template.mod)
+    # Check the structure before scheduling the template.
+    isomorphic = [
+        layer.mod is not template.mod and _module_signature(layer.mod) == signature
+        for layer in layers[1:]
+    ]
+
+    with _share_codegen():
+        return _apply_template(sch, paths, schedule_fn, verify, isomorphic)
+
+
+def _apply_template(sch, paths, schedule_fn, verify, isomorphic):
+    template = sch[paths[0]]
+    top = sch.get_top_schedule()
+    outer = top.recorder
+    recorder = TemplateRecorder(top, template.path, outer)
+    top.recorder = recorder
+    try:
+        schedule_fn(template)
+    finally:
+        top.recorder = outer
+    if recorder.error is not None:
+        logger.warning(
+            "Cannot stamp the schedule of %s onto other layers: %s",
+            template.path,
+            recorder.error,
+        )
+        isomorphic = [False] * len(isomorphic)
+    # The layer schedules may be replaced (e.g., by trace), so they are
+    # retrieved again.
+    layers = [sch[path] for path in paths]
+    fingerprint = schedule_fingerprint(layers[0]) if verify else None
+
+    for idx, (path, stampable) in enumerate(zip(paths[1:], isomorphic), 1):
+        if not stampable:
+            logger.debug("Apply the schedule function to %s", path)
+            schedule_fn(layers[idx])
+            continue
+        recorder.stamp(layers[idx].path)
+        layers[idx] = sch[path]
+        if verify and schedule_fingerprint(layers[idx]) != fingerprint:
+            raise RuntimeError(
+                f"The stamped schedule of {path} is not the same as " f"{template.path}"
+            )
+    return [sch[path] for path in paths]
@@ -0,0 +1,400 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""The cache of traced graphs.
+
+Structurally identical submodules, such as the layers of a transformer model,
+result in the same graph, so only the first one is traced and the rest reuse
+a copy of its graph. The graphs can also be persisted to a cache directory,
+so that the traced graphs can be reused across runs.
+"""
+from __future__ import annotations
+
+import copy
+import hashlib
+import inspect
+import os
+import pickle
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import torch
+from torch import fx, nn
+
+from .logger import get_logger
+from .version import __version__
+
+logger = get_logger()
+
+# The in-memory cache from the cache key to the traced graph, the tensor
+# constants attached to the traced module by the tracer, and the references
+# to the objects identified by their IDs in the key.
+_TRACE_CACHE = OrderedDict()
+_TRACE_CACHE_SIZE = 64
+
+# The environment variable to specify the default cache directory.
+CACHE_DIR_ENV = "SLAPO_TRACE_CACHE_DIR"
+
+# The values of these types are hashable and may affect the traced graph
+# (e.g., control flow), so they are a part of the cache key.
+_SIMPLE_TYPES = (bool, int, float, str, type(None), torch.dtype, torch.device)
+
+# The source code fingerprints of module classes.
+_CLASS_FINGERPRINTS = {}
+
+
+class _Uncacheable(Exception):
+    """Raised when a value cannot be a part of the persistent cache key."""
+
+
+@dataclass
+class CacheKey:
+    """The key of a traced graph.
+
+    Parameters
+    ----------
+    key : tuple
+        The key of the in-memory cache.
+    refs : tuple
+        The objects identified by their IDs in `key`.
+    digest : Optional[str]
+        The key of the persistent cache. None if the graph is not persisted.
+    cache_dir : Optional[str]
+        The cache directory.
+    """
+
+    key: tuple
+    refs: tuple = ()
+    digest: Optional[str] = None
+    cache_dir: Optional[str] = None
+
+
+def clear_trace_cache():
+    """Clear the in-memory cache of traced graphs."""
+    _TRACE_CACHE.clear()
+
+
+def _class_fingerprint(cls):
+    """The name and source code hash of a class, which are stable across runs."""
+    if cls not in _CLASS_FINGERPRINTS:
+        try:
+            source = inspect.getsource(cls)
+        except (OSError, TypeError):
+            source = None
+        if source is None:
+            _CLASS_FINGERPRINTS[cls] = None
+        else:
+            digest = hashlib.sha256(source.encode()).hexdigest()
+            _CLASS_FINGERPRINTS[cls] = f"{cls.__module__}.{cls.__qualname__}:{digest}"
+    if _CLASS_FINGERPRINTS[cls] is None:
+        raise _Uncacheable(f"Cannot get the source code of {cls}")
+    return _CLASS_FINGERPRINTS[cls]
+
+
+def _make_hashable(value, stable=False, refs=None):
+    """Convert a value to a hashable key. Values other than the simple types
+    and containers of them are identified by their object IDs, and they are
+    appended to `refs` if given, because an ID may be reused after the object
+    is garbage collected. If stable, the key has to be the same across runs,
+    so object IDs cannot be used.
+    """
+    if isinstance(value, _SIMPLE_TYPES):
+        return value
+    if isinstance(value, (tuple, list)):
+        return (
+            type(value).__name__,
+            tuple(_make_hashable(v, stable, refs) for v in value),
+        )
+    if isinstance(value, (set, frozenset)):
+        items = [_make_hashable(v, stable, refs) for v in value]
+        if stable:
+            return (type(value).__name__, tuple(sorted(items, key=repr)))
+        return (type(value), frozenset(items))
+    if isinstance(value, dict):
+        return (
+            dict,
+            tuple((k, _make_hashable(v, stable, refs)) for k, v in value.items()),
+        )
+    if not stable:
+        if refs is not None:
+            refs.append(value)
+        if isinstance(value, torch.Tensor):
+            return (torch.Tensor, tuple(value.shape), value.dtype, id(value))
+        return (type(value), id(value))
+    if isinstance(value, type):
+        return _class_fingerprint(value)
+    if callable(value) and hasattr(value, "__qualname__"):
+        # Functions are identified by their names.
+        return f"{getattr(value, '__module__', None)}.{value.__qualname__}"
+    if callable(getattr(value, "to_dict", None)):
+        # Configurations such as HF PretrainedConfig.
+        return (
+            _class_fingerprint(type(value)),
+            _make_hashable(value.to_dict(), stable),
+        )
+    raise _Uncacheable(f"Cannot make a persistent key of {type(value)}")
+
+
+def _module_signature(root: nn.Module, stable=False, refs=None):
+    """The structural signature of a module, including the types of all its
+    submodules, the shapes of parameters and buffers, and the attributes that
+    may affect the traced graph. Two modules with the same signature and class
+    are traced to the same graph. See `_make_hashable` for `refs`.
+    """
+    signature = []
+    for name, mod in root.named_modules():
+        attrs = []
+        for key, value in vars(mod).items():
+            if key in ("_parameters", "_buffers", "_modules"):
+                continue
+            if key.startswith("_") and not isinstance(value, _SIMPLE_TYPES):
+                # Internal states of nn.Module such as hooks.
+                continue
+            attrs.append((key, _make_hashable(value, stable, refs)))
+        mod_type = _class_fingerprint(type(mod)) if stable else type(mod)
+        signature.append((name, mod_type, tuple(attrs)))
+    for name, param in root.named_parameters():
+        signature.append((name, tuple(param.shape), param.dtype, param.requires_grad))
+    for name, buffer in root.named_buffers():
+        signature.append((name, tuple(buffer.shape), buffer.dtype))
+    return tuple(signature)
+
+
+def get_cache_key(
+    root: nn.Module,
+    tracer_name: str,
+    call_node: Optional[fx.Node],
+    concrete_args: Any,
+    kwargs: dict[str, Any],
+):
+    """Get the cache key of the graph traced from a module.
+
+    Parameters
+    ----------
+    root : nn.Module
+        The module to be traced.
+    tracer_name : str
+        The name of the tracer.
+    call_node : Optional[fx.Node]
+        The node that calls the module in the graph of its parent.
+    concrete_args : Any
+        The concrete arguments used to trace the module.
+    kwargs : dict[str, Any]
+        The tracing arguments. "leaf_modules", "flatten", and "cache_dir" are
+        used. If "cache_dir" is not specified, the environment variable
+        SLAPO_TRACE_CACHE_DIR is used.
+
+    Returns
+    -------
+    Optional[CacheKey]
+        The cache key, or None if the traced graph cannot be cached.
+    """
+    if call_node is not None:
+        call_sig = (
+            tuple(isinstance(arg, fx.Node) for arg in call_node.args),
+            tuple((k, isinstance(v, fx.Node)) for k, v in call_node.kwargs.items()),
+        )
+    else:
+        call_sig = None
+
+    def make_key(stable, refs=None):
+        return (
+            _class_fingerprint(type(root)) if stable else type(root),
+            tracer_name,
+            tuple(kwargs.get("leaf_modules", [])),
+            kwargs.get("flatten", False),
+            call_sig,
+            _make_hashable(concrete_args, stable, refs),
+            _module_signature(root, stable, refs),
+        )
+
+    refs = []
+    key = make_key(stable=False, refs=refs)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    cache_key = CacheKey(key, tuple(refs))
+
+    cache_dir = kwargs.get("cache_dir", None) or os.environ.get(CACHE_DIR_ENV, None)
+    if cache_dir:
+        try:
+            stable_key = make_key(stable=True)
+        except _Uncacheable as err:
+            logger.debug("Do not persist the graph of %s: %s", type(root), err)
+            return cache_key
+        versions = (__version__, torch.__version__)
+        if tracer_name == "huggingface":
+            import transformers
+
+            versions += (transformers.__version__,)
+        cache_key.digest = hashlib.sha256(
+            repr((versions, stable_key)).encode()
+        ).hexdigest()
+        cache_key.cache_dir = cache_dir
+    return cache_key
+
+
+class _NodeRef:
+    """A reference to a node in a persisted graph."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class _GraphPickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        if isinstance(obj, fx.Node):
+            return obj.name
+        return None
+
+
+class _GraphUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return _NodeRef(pid)
+
+
+def _save_graph(path, graph, constants):
+    """Persist a graph as its generated code and the list of its nodes."""
+    if type(graph._codegen) is not fx.graph.CodeGen:
+        # Graphs with customized code generation (e.g., pytree inputs)
+        # are not supported.
+        return
+    nodes = [
+        (node.op, node.name, node.target, node.args, node.kwargs, node.type)
+        for node in graph.nodes
+    ]
+    code = graph.python_code(root_module="self").src
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as filep:
+            _GraphPickler(filep).dump(
+                {"code": code, "nodes": nodes, "constants": constants}
+            )
+        # Multiple processes may write the same graph, so the file is
+        # atomically replaced to avoid partial reads.
+        os.replace(tmp_path, path)
+    except (pickle.PicklingError, AttributeError, TypeError) as err:
+        logger.debug("Failed to persist the graph to %s: %s", path, err)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _load_graph(path):
+    """Load a persisted graph. Return None if the graph cannot be loaded."""
+    try:
+        with open(path, "rb") as filep:
+            data = _GraphUnpickler(filep).load()
+        graph = fx.Graph()
+        env = {}
+
+        def load_arg(arg):
+            return env[arg.name] if isinstance(arg, _NodeRef) else arg
+
+        for op, name, target, args, kwargs, type_expr in data["nodes"]:
+            env[name] = graph.create_node(
+                op,
+                target,
+                fx.node.map_aggregate(args, load_arg),
+                fx.node.map_aggregate(kwargs, load_arg),
+                name=name,
+                type_expr=type_expr,
+            )
+    except Exception as err:  # pylint: disable=broad-except
+        logger.warning("Failed to load the traced graph from %s: %s", path, err)
+        return None
+    if graph.python_code(root_module="self").src != data["code"]:
+        logger.warning("The traced graph in %s is inconsistent", path)
+        return None
+    return graph, data["constants"]
+
+
+def load_cached_graph(root: nn.Module, cache_key: CacheKey):
+    """Load the cached graph of a module from the in-memory cache or the cache
+    directory.
+
+    Parameters
+    ----------
+    root : nn.Module
+        The module to be traced. The tensor constants of the cached graph
+        are attached to it.
+    cache_key : CacheKey
+        The cache key.
+
+    Returns
+    -------
+    Optional[fx.Graph]
+        A copy of the cached graph, or None if not found.
+    """
+    if cache_key.key in _TRACE_CACHE and not _is_alive(_TRACE_CACHE[cache_key.key][2]):
+        # An object in the key was garbage collected, so its ID may have
+        # been reused by another object.
+        del _TRACE_CACHE[cache_key.key]
+    if cache_key.key in _TRACE_CACHE:
+        _TRACE_CACHE.move_to_end(cache_key.key)
+        graph, constants, _ = _TRACE_CACHE[cache_key.key]
+    elif cache_key.digest is not None:
+        path = os.path.join(cache_key.cache_dir, f"{cache_key.digest}.pkl")
+        if not os.path.exists(path):
+            return None
+        entry = _load_graph(path)
+        if entry is None:
+            return None
+        logger.debug("Load the traced graph of %s from %s", type(root), path)
+        _update_memory_cache(cache_key, entry)
+        graph, constants = entry
+    else:
+        return None
+    # The tensor constants were attached to the traced module by the tracer.
+    for name, constant in constants.items():
+        setattr(root, name, constant)
+    return copy.deepcopy(graph)
+
+
+def save_cached_graph(root: nn.Module, cache_key: CacheKey, graph: fx.Graph):
+    """Cache the graph traced from a module.
+
+    Parameters
+    ----------
+    root : nn.Module
+        The traced module.
+    cache_key : CacheKey
+        The cache key.
+    graph : fx.Graph
+        The traced graph. A copy of it is cached.
+    """
+    constants = {
+        name: value
+        for name, value in vars(root).items()
+        if name.startswith("_tensor_constant")
+    }
+    graph = copy.deepcopy(graph)
+    _update_memory_cache(cache_key, (graph, constants))
+    if cache_key.digest is not None:
+        os.makedirs(cache_key.cache_dir, exist_ok=True)
+        path = os.path.join(cache_key.cache_dir, f"{cache_key.digest}.pkl")
+        _save_graph(path, graph, constants)
+
+
+def _make_ref(obj):
+    """A weak reference to an object, or the object itself if it does not
+    support weak references.
+    """
+    try:
+        return weakref.ref(obj)
+    except TypeError:
+        return obj
+
+
+def _is_alive(refs):
+    return all(
+        ref() is not None for ref in refs if isinstance(ref, weakref.ReferenceType)
+    )
+
+
+def _update_memory_cache(cache_key, entry):
+    refs = tuple(_make_ref(obj) for obj in cache_key.refs)
+    _TRACE_CACHE[cache_key.key] = (*entry, refs)
+    if len(_TRACE_CACHE) > _TRACE_CACHE_SIZE:
+        _TRACE_CACHE.popitem(last=False)
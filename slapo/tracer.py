@@ -17,6 +17,12 @@ from torch.fx.graph import _PyTreeCodeGen, _PyTreeInfo
 from torch.fx.node import base_types
 
 from .logger import get_logger
+from .trace_cache import (
+    clear_trace_cache,
+    get_cache_key,
+    load_cached_graph,
+    save_cached_graph,
+)
 
 logger = get_logger()
 
@@ -94,6 +100,47 @@ def fix_hf_module(
     return root_graph
 
 
+def _hf_dummy_input_names(root: nn.Module, call_node: fx.Node):
+    """The names of the arguments of a submodule that are traced with dummy
+    inputs, i.e., the arguments that are nodes in the graph of its parent.
+    """
+    assert call_node is not None
+    arg_names = list(inspect.signature(root.forward).parameters.keys())
+    names = [
+        arg_names[i] for i, arg in enumerate(call_node.args) if isinstance(arg, fx.Node)
+    ]
+    for key, arg in call_node.kwargs.items():
+        assert key in arg_names
+        if isinstance(arg, fx.Node):
+            names.append(key)
+    return names
+
+
+def get_hf_concrete_args(
+    root: nn.Module,
+    is_top: bool,
+    call_node: fx.Node,
+    kwargs: dict[str, Any],
+):
+    """Get the concrete arguments to trace a module with the HF tracer. This
+    does not generate dummy inputs, so it is cheap enough to compute the key
+    of the trace cache.
+    """
+    if is_top:
+        assert "concrete_args" in kwargs
+        if not hasattr(root, "device"):
+            root.device = next(root.named_parameters())[1].device
+        if not hasattr(root, "config"):
+            assert "config" in kwargs, "Please provide `config` for HF tracer"
+            root.config = kwargs["config"]
+        return kwargs["concrete_args"]  # those are args having None value
+    sig = inspect.signature(root.forward)
+    dummy_names = _hf_dummy_input_names(root, call_node)
+    return {
+        p.name: p.default for p in sig.parameters.values() if p.name not in dummy_names
+    }
+
+
 def generate_hf_tracer_inputs(
     root: nn.Module,
     tracer: fx.Tracer,
@@ -105,18 +152,12 @@ def generate_hf_tracer_inputs(
     batch_size = random.randint(10, 20)
     sequence_length = random.randint(10, 20)
     shape = [batch_size, sequence_length]
-    # generate concrete_args and dummy_inputs
+    # generate dummy_inputs
     if is_top:
         sig = inspect.signature(
             root.forward if isinstance(root, torch.nn.Module) else root
         )
-        assert "concrete_args" in kwargs
-        if not hasattr(root, "device"):
-            root.device = next(root.named_parameters())[1].device
-        if not hasattr(root, "config"):
-            assert "config" in kwargs, "Please provide `config` for HF tracer"
-            root.config = kwargs["config"]
-        concrete_args = kwargs["concrete_args"]  # those are args having None value
+        concrete_args = kwargs["concrete_args"]
         input_names = sig.parameters.keys() - concrete_args.keys()
         inputs = {}
         for input_name in input_names:
@@ -124,27 +165,12 @@ def generate_hf_tracer_inputs(
         kwargs["dummy_inputs"] = inputs
         dummy_inputs = copy.copy(inputs)
     else:
-        assert call_node is not None
-        sig = inspect.signature(root.forward)
-        arg_names = list(sig.parameters.keys())
-        dummy_inputs = {}
-        for i, arg in enumerate(call_node.args):
-            if isinstance(arg, fx.Node):
-                # FIXME: shape and dtype do affect the control flow branches
-                dummy_inputs[arg_names[i]] = torch.zeros(shape, dtype=torch.float32)
-            else:
-                # ignore value=None
-                pass
-        for _, (key, arg) in enumerate(call_node.kwargs.items(), len(call_node.args)):
-            assert key in arg_names
-            if isinstance(arg, fx.Node):
-                dummy_inputs[key] = torch.zeros(shape, dtype=torch.float32)
-        concrete_args = {
-            p.name: p.default
-            for p in sig.parameters.values()
-            if p.name not in dummy_inputs
+        # FIXME: shape and dtype do affect the control flow branches
+        dummy_inputs = {
+            name: torch.zeros(shape, dtype=torch.float32)
+            for name in _hf_dummy_input_names(root, call_node)
         }
-    return concrete_args, dummy_inputs
+    return dummy_inputs
 
 
 def trace_submodule(
@@ -152,6 +178,7 @@ def trace_submodule(
     tracer_class,
     is_top: bool = False,
     call_node: fx.Node = None,
+    use_cache: bool = True,
     **kwargs,
 ):
     # generate top graph module
@@ -179,25 +206,36 @@ def trace_submodule(
     tracer = tracer_class(leaf_modules=leaf_modules)
 
     if tracer.name == "huggingface":
-        concrete_args, dummy_inputs = generate_hf_tracer_inputs(
-            root, tracer, is_top, call_node, kwargs
-        )
-        try:
-            root_graph = tracer.trace(
-                root, concrete_args=concrete_args, dummy_inputs=dummy_inputs
-            )
-        except Exception as err:
-            logger.warning(traceback.format_exc())
-            logger.warning("Cannot trace module %s: %s", root.__class__.__name__, err)
-            return root
+        concrete_args = get_hf_concrete_args(root, is_top, call_node, kwargs)
     else:
         concrete_args = kwargs.get("concrete_args", {})
+
+    cache_key = None
+    if use_cache:
+        cache_key = get_cache_key(root, tracer.name, call_node, concrete_args, kwargs)
+    root_graph = load_cached_graph(root, cache_key) if cache_key else None
+    if root_graph is not None:
+        # Reuse the graph of a structurally identical module.
+        # The tracer is still used to resolve the paths of submodules.
+        tracer.root = root
+    else:
         try:
-            root_graph = tracer.trace(root, concrete_args=concrete_args)
+            if tracer.name == "huggingface":
+                # Dummy inputs are only generated when the graph is not cached.
+                dummy_inputs = generate_hf_tracer_inputs(
+                    root, tracer, is_top, call_node, kwargs
+                )
+                root_graph = tracer.trace(
+                    root, concrete_args=concrete_args, dummy_inputs=dummy_inputs
+                )
+            else:
+                root_graph = tracer.trace(root, concrete_args=concrete_args)
         except Exception as err:
             logger.warning(traceback.format_exc())
             logger.warning("Cannot trace module %s: %s", root.__class__.__name__, err)
             return root
+        if cache_key is not None:
+            save_cached_graph(root, cache_key, root_graph)
     call_arg_map = {}
     for node in root_graph.nodes:
         if node.op == "call_module":
@@ -230,6 +268,7 @@ def trace_submodule(
                             tracer_class,
                             is_top=False,
                             call_node=call_arg_map[f"{name}.{i}"],
+                            use_cache=use_cache,
                             **kwargs,
                         )
                     submods[f"{name}.{i}"] = gm_submod
@@ -251,6 +290,7 @@ def trace_submodule(
                         tracer_class,
                         is_top=False,
                         call_node=call_arg_map[name],
+                        use_cache=use_cache,
                         **kwargs,
                     )
                 submods[name] = gm_submod
@@ -273,7 +313,12 @@ def trace_submodule(
 
 
 def trace(model: nn.Module, **kwargs: dict[str, Any]):
-    """Traces a model to a GraphModule."""
+    """Traces a model to a GraphModule. Structurally identical submodules
+    (e.g., the layers in a nn.ModuleList) are only traced once and share
+    the traced graph, unless `use_cache=False` is specified. If `cache_dir`
+    (or the environment variable SLAPO_TRACE_CACHE_DIR) is specified, the
+    traced graphs are also persisted to the directory and reused across runs.
+    """
     tracer_cls_name = kwargs.get("tracer", "pytorch")
     logger.debug("Tracer: %s Model: %s", tracer_cls_name, model.__class__.__name__)
 
@@ -656,6 +701,8 @@ def trace(model: nn.Module, **kwargs: dict[str, Any]):
             kwargs.pop("tracer")
             kwargs.pop("recursive")
             kwargs.pop("flatten")
+            kwargs.pop("use_cache", None)
+            kwargs.pop("cache_dir", None)
             top_gm, _ = dynamo.export(model, *args, **kwargs)
         else:
             raise ValueError(f"Unknown tracer: {tracer_cls_name}")
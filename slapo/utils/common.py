@@ -147,9 +147,8 @@ def is_module_list(module, name="", parent=None):
         # If the module and its parent are both traced, we can check
         # the caller in the parent. If there is a caller that directly
         # calls this module, then this is not a module list.
-        for node in parent.mod.graph.nodes:
-            if node.op == "call_module" and node.target == name:
-                return False
+        if name in parent.get_called_modules():
+            return False
 
     # If all above cannot work, we could only chacke if its children are indexed by
     # sequential integers, and treat it as a module list if so.
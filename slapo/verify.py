@@ -94,7 +94,9 @@ class Verify(ContextDecorator):
         for param_name, param in self.sch.mod.named_parameters():
             if hasattr(param, "orig_shape"):
                 copied_mod.get_parameter(param_name).orig_shape = param.orig_shape
-        new_sch = create_schedule(copied_mod)
+        # The original process group is used, so that its cached groups are
+        # reused by building the model.
+        new_sch = create_schedule(copied_mod, group=self.sch.group)
         # 7. Use original weights to initialize the new model
         #    Notice init_weights is called before actual sharding, so we only need to
         #    assign the original weights to the corresponding modules
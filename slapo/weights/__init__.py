@@ -0,0 +1,13 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Reading and writing model weights."""
+
+from .formats import CheckpointReader, open_checkpoint, save_flat
+from .loader import get_local_slice, load_pretrained
+from .checkpoint import (
+    CheckpointWriter,
+    get_checkpoint_rank,
+    get_rank_file,
+    load_checkpoint,
+    save_checkpoint,
+)
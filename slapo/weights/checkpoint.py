@@ -0,0 +1,346 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Save and load the sharded checkpoints of a scheduled model.
+
+Each rank writes its local shards to its own flat file (see `save_flat`)
+without gathering the parameters, and the index file records the manifest
+of each tensor, including its original shape, sharded axis, tensor parallel
+rank and pipeline stage, so that the checkpoint can be loaded back by the
+same parallel configuration or be resharded offline.
+"""
+from __future__ import annotations
+
+import json
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+
+from ..logger import get_logger
+from ..mesh import DeviceMesh
+from .formats import open_checkpoint, save_flat
+from .loader import _collect_tensors, load_tensors
+
+logger = get_logger()
+
+# The version of the checkpoint manifest.
+CHECKPOINT_VERSION = 1
+
+
+def get_rank_file(rank: int) -> str:
+    """The name of the index file of a rank in a sharded checkpoint."""
+    return f"rank_{rank:05d}.json"
+
+
+def _get_global_rank():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def _make_manifest(sch, entries):
+    """Make the manifest of the local tensors to be saved."""
+    top_sch = sch.get_top_schedule()
+    rank, world_size = _get_global_rank()
+    manifest = {
+        "version": CHECKPOINT_VERSION,
+        "rank": rank,
+        "world_size": world_size,
+        "tp_rank": top_sch.rank,
+        "tp_world_size": top_sch.world_size,
+        "stages": sorted({entry["stage"] or 0 for entry in entries}),
+        "tensors": {},
+        # The names of all tensors including the tied ones in the module
+        # order, which is used to split pipeline stages when resharding.
+        "order": [],
+    }
+    saved = {key for entry in entries for key in entry["keys"]}
+    manifest["order"] = [
+        name for name in sch.mod.state_dict(keep_vars=True) if name in saved
+    ]
+    for entry in entries:
+        tensor = entry["tensor"]
+        manifest["tensors"][entry["keys"][0]] = {
+            "orig_shape": list(getattr(tensor, "orig_shape", tensor.shape)),
+            "axis": entry["axis"],
+            "tp_rank": entry["rank"] if entry["axis"] is not None else top_sch.rank,
+            "tp_world_size": entry["world_size"]
+            if entry["axis"] is not None
+            else top_sch.world_size,
+            "stage": entry["stage"] or 0,
+            "aliases": entry["keys"][1:],
+        }
+    return manifest
+
+
+def _local_entries(sch):
+    """The persistent tensors materialized on this rank. The tensors on the
+    meta device belong to other pipeline stages and are skipped.
+    """
+    return [
+        entry
+        for entry in _collect_tensors(sch, None)
+        if entry["persistent"] and entry["tensor"].device.type != "meta"
+    ]
+
+
+def save_checkpoint(sch, path: str, metadata: Optional[dict] = None):
+    """Save the local shards of a scheduled model to a sharded checkpoint.
+    Each rank should call this function with the same path, which is a
+    directory shared by the ranks. Use `CheckpointWriter` to save the
+    checkpoint in the background.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule of the model.
+    path : str
+        The directory of the checkpoint.
+    metadata : Optional[dict]
+        Additional metadata (e.g., the training step) to be saved.
+    """
+    entries = _local_entries(sch)
+    tensors = {entry["keys"][0]: entry["tensor"] for entry in entries}
+    _write(path, tensors, _make_manifest(sch, entries), metadata)
+
+
+def _write(path, tensors, manifest, metadata):
+    os.makedirs(path, exist_ok=True)
+    manifest = dict(manifest, user=metadata or {})
+    save_flat(
+        tensors, os.path.join(path, get_rank_file(manifest["rank"])), metadata=manifest
+    )
+    logger.info("Saved %d tensors to %s", len(tensors), path, ranks=0)
+
+
+class CheckpointWriter:
+    """Save sharded checkpoints in a background thread, so that the training
+    only stalls for copying the local tensors to host memory. The tensors
+    are copied to pinned host buffers, which are reused by the following
+    saves, and then written to the disk while the training continues.
+
+    .. code-block:: python
+
+        writer = slapo.weights.CheckpointWriter()
+        for step in range(num_steps):
+            train_step()
+            if step % 1000 == 0:
+                writer.save(sch, f"ckpt/step_{step}", {"step": step})
+        writer.close()
+
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="slapo-checkpoint"
+        )
+        self.future = None
+        # The reusable host buffers keyed by the tensor names.
+        self.buffers = {}
+
+    def _snapshot(self, entries):
+        tensors = {}
+        has_cuda = False
+        for entry in entries:
+            name, tensor = entry["keys"][0], entry["tensor"].detach()
+            buf = self.buffers.get(name, None)
+            if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+                buf = torch.empty(
+                    tensor.shape, dtype=tensor.dtype, pin_memory=tensor.is_cuda
+                )
+                self.buffers[name] = buf
+            buf.copy_(tensor, non_blocking=tensor.is_cuda)
+            has_cuda |= tensor.is_cuda
+            tensors[name] = buf
+        if has_cuda:
+            # Wait for the device-to-host copies before writing.
+            torch.cuda.current_stream().synchronize()
+        return tensors
+
+    def save(
+        self, sch, path: str, metadata: Optional[dict] = None, blocking: bool = False
+    ) -> Future:
+        """Snapshot the local shards of a scheduled model and save them to a
+        sharded checkpoint in the background. If the previous save is still
+        in progress, wait for it first.
+
+        Parameters
+        ----------
+        sch : Schedule
+            The schedule of the model.
+        path : str
+            The directory of the checkpoint.
+        metadata : Optional[dict]
+            Additional metadata (e.g., the training step) to be saved.
+        blocking : bool
+            Whether to wait until the checkpoint is written.
+
+        Returns
+        -------
+        Future
+            The future of the background writing.
+        """
+        # The buffers are being written by the previous save.
+        self.wait()
+        entries = _local_entries(sch)
+        tensors = self._snapshot(entries)
+        self.future = self.executor.submit(
+            _write, path, tensors, _make_manifest(sch, entries), metadata
+        )
+        future = self.future
+        if blocking:
+            self.wait()
+        return future
+
+    def wait(self):
+        """Wait for the pending save, and raise its error if any."""
+        future, self.future = self.future, None
+        if future is not None:
+            future.result()
+
+    def close(self):
+        """Wait for the pending save and stop the background thread."""
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+            self.buffers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_checkpoint_rank(
+    path: str, rank: int, world_size: int, mesh: Optional[DeviceMesh] = None
+) -> int:
+    """Get the rank of the file in a sharded checkpoint to be loaded by a
+    global rank. A checkpoint saved with the same world size has a file per
+    global rank. Otherwise, the checkpoint (e.g., resharded by
+    `slapo.weights.reshard`) has a file per pipeline stage and tensor
+    parallel rank, which is shared by the data parallel replicas.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the checkpoint.
+    rank : int
+        The global rank.
+    world_size : int
+        The global world size.
+    mesh : Optional[DeviceMesh]
+        The device mesh of the model. If None, the mesh is inferred from the
+        checkpoint with the rest of the devices as data parallelism.
+
+    Returns
+    -------
+    int
+        The rank of the file.
+    """
+    index_path = os.path.join(path, get_rank_file(0))
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"Cannot find {index_path}")
+    with open(index_path, "r", encoding="utf-8") as filep:
+        manifest = json.load(filep).get("metadata", {})
+    ckpt_world_size = manifest.get("world_size", world_size)
+    if ckpt_world_size == world_size:
+        return rank
+    tp_size = manifest["tp_world_size"]
+    pp_size = ckpt_world_size // tp_size
+    if mesh is None:
+        mesh = DeviceMesh(tp_size=tp_size, pp_size=pp_size, world_size=world_size)
+    if (mesh.tp_size, mesh.pp_size) != (tp_size, pp_size):
+        raise ValueError(
+            f"The checkpoint in {path} has TP={tp_size} x PP={pp_size}, but the "
+            f"mesh is {mesh}. Reshard the checkpoint with slapo.weights.reshard."
+        )
+    coord = mesh.get_coord(rank)
+    return coord["pipe"] * tp_size + coord["model"]
+
+
+def load_checkpoint(
+    sch,
+    path: str,
+    rank: Optional[int] = None,
+    device: Optional[str] = None,
+    strict: bool = True,
+    mesh: Optional[DeviceMesh] = None,
+) -> dict:
+    """Load a sharded checkpoint saved by `save_checkpoint` into a scheduled
+    model with the same parallel configuration. Each rank only memory-maps
+    its own file. Use `slapo.weights.reshard` to convert the checkpoint to
+    another parallel configuration first.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule of the model.
+    path : str
+        The directory of the checkpoint.
+    rank : Optional[int]
+        The rank of the file to be loaded. If None, it is derived from the
+        global rank by `get_checkpoint_rank`.
+    device : Optional[str]
+        The device of the loaded tensors. If None, use the device of the
+        original tensors, or CPU if they are on the meta device.
+    strict : bool
+        Whether to raise an error if a tensor of the pipeline stages in the
+        file is not found.
+    mesh : Optional[DeviceMesh]
+        The device mesh to derive the file from the global rank. See
+        `get_checkpoint_rank`.
+
+    Returns
+    -------
+    dict
+        The additional metadata saved with the checkpoint.
+    """
+    if rank is None:
+        rank = get_checkpoint_rank(path, *_get_global_rank(), mesh)
+    index_path = os.path.join(path, get_rank_file(rank))
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"Cannot find {index_path}")
+    reader = open_checkpoint(index_path)
+    manifest = reader.metadata
+    tensor_specs = manifest["tensors"]
+    for name, spec in list(tensor_specs.items()):
+        for alias in spec.get("aliases", []):
+            tensor_specs.setdefault(alias, spec)
+
+    def get_local(entry, key):
+        spec = tensor_specs[key]
+        tensor = entry["tensor"]
+        orig_shape = getattr(tensor, "orig_shape", tensor.shape)
+        if (
+            spec["axis"] != entry["axis"]
+            or list(spec["orig_shape"]) != list(orig_shape)
+            or (
+                entry["axis"] is not None
+                and (spec["tp_rank"], spec["tp_world_size"])
+                != (entry["rank"], entry["world_size"])
+            )
+        ):
+            raise ValueError(
+                f"The sharding of {key} in the checkpoint ({spec}) does not match "
+                "the model. Reshard the checkpoint with slapo.weights.reshard."
+            )
+        return reader.get_tensor(key)
+
+    missing = load_tensors(sch, reader, get_local, None, device, strict=False)
+    # The tensors of the other pipeline stages are not in this file.
+    stages = set(manifest["stages"])
+    entry_stages = {
+        key: entry["stage"] or 0
+        for entry in _collect_tensors(sch, None)
+        for key in entry["keys"]
+    }
+    missing = [name for name in missing if entry_stages.get(name, 0) in stages]
+    if missing:
+        if strict:
+            raise KeyError(f"Missing tensors in the checkpoint: {missing}")
+        logger.warning("Missing tensors in the checkpoint: %s", missing)
+    return manifest.get("user", {})
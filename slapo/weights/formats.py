@@ -0,0 +1,307 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Memory-mapped readers and writers of the checkpoint formats.
+
+The following formats are supported:
+
+- PyTorch files (e.g., `pytorch_model.bin`) saved by `torch.save`.
+- Safetensors files (e.g., `model.safetensors`), which are parsed directly
+  so that the `safetensors` package is not required.
+- Flat files, which are raw tensor bytes indexed by a JSON file. This is
+  the format of the sharded checkpoints saved by Slapo.
+- HuggingFace index files (e.g., `pytorch_model.bin.index.json`) of the
+  checkpoints split into multiple files in the above formats.
+
+Tensors are memory-mapped instead of being read into memory, so reading a
+slice of a tensor only loads the corresponding pages from the disk.
+"""
+from __future__ import annotations
+
+import inspect
+import json
+import os
+import struct
+from typing import Optional
+
+import numpy as np
+import torch
+
+from ..logger import get_logger
+
+logger = get_logger()
+
+# The format name in the index file of flat checkpoints.
+FLAT_FORMAT = "slapo-flat"
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+_DEFAULT_FILES = (
+    "model.safetensors.index.json",
+    "pytorch_model.bin.index.json",
+    "model.safetensors",
+    "pytorch_model.bin",
+)
+
+
+def dtype_to_str(dtype: torch.dtype) -> str:
+    """Convert a torch dtype to its name, such as "float16"."""
+    return str(dtype).split(".")[-1]
+
+
+def str_to_dtype(name: str) -> torch.dtype:
+    """Convert a dtype name, such as "float16", to the torch dtype."""
+    dtype = getattr(torch, name, None)
+    if not isinstance(dtype, torch.dtype):
+        raise ValueError(f"Unknown dtype {name}")
+    return dtype
+
+
+class _MappedFile:
+    """A memory-mapped file to create tensors without copying."""
+
+    def __init__(self, path):
+        # Copy-on-write mode so that the tensors are writable, but the
+        # changes are never written back to the file.
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="c")
+
+    def tensor(self, offset, dtype, shape):
+        count = int(np.prod(shape, dtype=np.int64))
+        if count == 0:
+            return torch.empty(shape, dtype=dtype)
+        return torch.frombuffer(
+            self.buffer, dtype=dtype, count=count, offset=offset
+        ).view(shape)
+
+
+class _FileReader:
+    """The base class of the readers of a single file."""
+
+    def keys(self):
+        raise NotImplementedError
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        raise NotImplementedError
+
+
+class _TorchFileReader(_FileReader):
+    """The reader of the files saved by `torch.save`."""
+
+    def __init__(self, path):
+        kwargs = {"map_location": "cpu"}
+        if "mmap" in inspect.signature(torch.load).parameters:
+            kwargs.update(mmap=True, weights_only=True)
+        try:
+            self.state_dict = torch.load(path, **kwargs)
+        except RuntimeError as err:
+            # The legacy (non-zip) format cannot be memory-mapped.
+            logger.warning(
+                "Cannot memory-map %s and it is loaded to memory: %s", path, err
+            )
+            self.state_dict = torch.load(path, map_location="cpu")
+
+    def keys(self):
+        return self.state_dict.keys()
+
+    def get_tensor(self, name):
+        return self.state_dict[name]
+
+
+class _SafetensorsReader(_FileReader):
+    """The reader of the safetensors files."""
+
+    def __init__(self, path):
+        with open(path, "rb") as filep:
+            (header_size,) = struct.unpack("<Q", filep.read(8))
+            header = json.loads(filep.read(header_size))
+        header.pop("__metadata__", None)
+        self.header = header
+        self.data_offset = 8 + header_size
+        self.file = _MappedFile(path)
+
+    def keys(self):
+        return self.header.keys()
+
+    def get_tensor(self, name):
+        info = self.header[name]
+        begin, _ = info["data_offsets"]
+        return self.file.tensor(
+            self.data_offset + begin, _SAFETENSORS_DTYPES[info["dtype"]], info["shape"]
+        )
+
+
+class _FlatReader(_FileReader):
+    """The reader of the flat files indexed by a JSON file."""
+
+    def __init__(self, index_path, index=None):
+        if index is None:
+            with open(index_path, "r", encoding="utf-8") as filep:
+                index = json.load(filep)
+        self.root = os.path.dirname(index_path)
+        self.tensors = index["tensors"]
+        self.files = {}
+
+    def keys(self):
+        return self.tensors.keys()
+
+    def get_tensor(self, name):
+        info = self.tensors[name]
+        if info["file"] not in self.files:
+            self.files[info["file"]] = _MappedFile(
+                os.path.join(self.root, info["file"])
+            )
+        return self.files[info["file"]].tensor(
+            info["offset"], str_to_dtype(info["dtype"]), info["shape"]
+        )
+
+
+def _open_file(path):
+    if path.endswith(".safetensors"):
+        return _SafetensorsReader(path)
+    return _TorchFileReader(path)
+
+
+class CheckpointReader:
+    """The reader of a checkpoint, which maps tensor names to memory-mapped
+    tensors. The files of the checkpoint are opened on demand.
+
+    Parameters
+    ----------
+    path : str
+        The path of the checkpoint file, index file, or the directory that
+        contains `model.safetensors(.index.json)` or
+        `pytorch_model.bin(.index.json)`.
+    """
+
+    def __init__(self, path: str):
+        if os.path.isdir(path):
+            for name in _DEFAULT_FILES:
+                if os.path.exists(os.path.join(path, name)):
+                    path = os.path.join(path, name)
+                    break
+            else:
+                raise FileNotFoundError(f"Cannot find a checkpoint in {path}")
+
+        # The mapping from tensor names to file names, and the opened files.
+        self.weight_map = {}
+        self.readers = {}
+        # The metadata saved in the index file.
+        self.metadata = {}
+        if path.endswith(".json"):
+            with open(path, "r", encoding="utf-8") as filep:
+                index = json.load(filep)
+            if index.get("format", None) == FLAT_FORMAT:
+                reader = _FlatReader(path, index)
+                self.readers[path] = reader
+                self.metadata = index.get("metadata", {})
+                self.weight_map = {name: path for name in reader.keys()}
+            elif "weight_map" in index:
+                root = os.path.dirname(path)
+                self.metadata = index.get("metadata", {})
+                self.weight_map = {
+                    name: os.path.join(root, file_name)
+                    for name, file_name in index["weight_map"].items()
+                }
+            else:
+                raise ValueError(f"Unrecognized checkpoint index {path}")
+        else:
+            reader = _open_file(path)
+            self.readers[path] = reader
+            self.weight_map = {name: path for name in reader.keys()}
+
+    def keys(self):
+        return self.weight_map.keys()
+
+    def __contains__(self, name):
+        return name in self.weight_map
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        """Get a memory-mapped tensor.
+
+        Parameters
+        ----------
+        name : str
+            The tensor name.
+
+        Returns
+        -------
+        torch.Tensor
+            The tensor on CPU. Its data is not read from the disk until
+            it is accessed.
+        """
+        file_path = self.weight_map[name]
+        if file_path not in self.readers:
+            self.readers[file_path] = _open_file(file_path)
+        return self.readers[file_path].get_tensor(name)
+
+
+def open_checkpoint(path: str) -> CheckpointReader:
+    """Open a checkpoint for reading memory-mapped tensors.
+
+    Parameters
+    ----------
+    path : str
+        The path of the checkpoint file, index file or directory.
+
+    Returns
+    -------
+    CheckpointReader
+        The checkpoint reader.
+    """
+    return CheckpointReader(path)
+
+
+def save_flat(
+    tensors: dict[str, torch.Tensor],
+    index_path: str,
+    file_name: Optional[str] = None,
+    metadata: Optional[dict] = None,
+):
+    """Save tensors to a flat file and its JSON index.
+
+    Parameters
+    ----------
+    tensors : dict[str, torch.Tensor]
+        The tensors to be saved.
+    index_path : str
+        The path of the index file.
+    file_name : Optional[str]
+        The name of the data file in the same directory as the index file.
+        If None, use the index file name with the ".bin" suffix.
+    metadata : Optional[dict]
+        Additional metadata to be saved in the index file.
+    """
+    if file_name is None:
+        file_name = os.path.splitext(os.path.basename(index_path))[0] + ".bin"
+    data_path = os.path.join(os.path.dirname(index_path), file_name)
+    index = {"format": FLAT_FORMAT, "metadata": metadata or {}, "tensors": {}}
+    offset = 0
+    # The files are written to temporary files and then renamed, so that an
+    # existing checkpoint is not corrupted if the writing is interrupted.
+    with open(f"{data_path}.tmp", "wb") as filep:
+        for name, tensor in tensors.items():
+            tensor = tensor.detach().contiguous().cpu()
+            index["tensors"][name] = {
+                "file": file_name,
+                "dtype": dtype_to_str(tensor.dtype),
+                "shape": list(tensor.shape),
+                "offset": offset,
+            }
+            # View as bytes to support the dtypes not supported by numpy.
+            data = tensor.reshape(-1).view(torch.uint8).numpy()
+            filep.write(data.data)
+            offset += data.nbytes
+    os.replace(f"{data_path}.tmp", data_path)
+    with open(f"{index_path}.tmp", "w", encoding="utf-8") as filep:
+        json.dump(index, filep)
+    os.replace(f"{index_path}.tmp", index_path)
@@ -0,0 +1,237 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Load pretrained weights into a scheduled model, whose parameters can be
+on the meta device (see `slapo.init_empty_weights`). Each device only copies
+its own slice of the sharded parameters from the memory-mapped checkpoint,
+so no device reads the complete checkpoint into memory.
+"""
+from __future__ import annotations
+
+from collections.abc import Callable
+from typing import Optional, Union
+
+import torch
+from torch import nn
+
+from ..logger import get_logger
+from ..utils.common import transfor_param_tags
+from .formats import CheckpointReader, open_checkpoint
+
+logger = get_logger()
+
+
+def get_local_slice(
+    tensor: torch.Tensor,
+    axis: Optional[int],
+    rank: int,
+    world_size: int,
+):
+    """Get the slice of a complete tensor that belongs to the given rank,
+    following the semantic of the shard primitive.
+
+    Parameters
+    ----------
+    tensor : torch.Tensor
+        The complete tensor.
+    axis : Optional[int]
+        The sharded axis. None if the tensor is not sharded.
+    rank : int
+        The tensor parallel rank.
+    world_size : int
+        The tensor parallel world size.
+
+    Returns
+    -------
+    torch.Tensor
+        The view of the local slice.
+    """
+    if axis is None:
+        return tensor
+    if tensor.shape[axis] % world_size != 0:
+        raise RuntimeError(
+            f"Cannot shard axis {axis} with size {tensor.shape[axis]} by {world_size}"
+        )
+    sharded_size = tensor.shape[axis] // world_size
+    return tensor.narrow(axis, rank * sharded_size, sharded_size)
+
+
+def _collect_tensors(sch, key_fn):
+    """Collect the parameters and buffers of the scheduled model with their
+    checkpoint keys and sharding specs. Tied parameters are collected once
+    with all their keys.
+    """
+    schedules = {id(subsch.mod): subsch for _, subsch in sch.named_schedules()}
+    tensors = {}
+    for mod_name, mod in sch.mod.named_modules():
+        if isinstance(mod, torch.jit.ScriptModule):
+            continue
+        subsch = schedules.get(id(mod), None)
+        shard_meta = subsch.metadata.primitives.get("shard", {}) if subsch else {}
+        # The pipeline stage of the module.
+        stage, curr_sch = None, subsch
+        while curr_sch is not None and stage is None:
+            stage = curr_sch.partition_idx
+            curr_sch = curr_sch.parent
+        prefix = f"{mod_name}." if mod_name else ""
+        named_tensors = [
+            (name, tensor, True) for name, tensor in mod.named_parameters(recurse=False)
+        ] + [
+            (name, tensor, name not in mod._non_persistent_buffers_set)
+            for name, tensor in mod.named_buffers(recurse=False)
+        ]
+        for name, tensor, persistent in named_tensors:
+            if tensor is None:
+                continue
+            key = key_fn(prefix + name) if key_fn is not None else prefix + name
+            if id(tensor) not in tensors:
+                tensors[id(tensor)] = {
+                    "tensor": tensor,
+                    "owners": [],
+                    "keys": [],
+                    "axis": None,
+                    "rank": 0,
+                    "world_size": 1,
+                    "stage": stage,
+                    "persistent": False,
+                }
+            entry = tensors[id(tensor)]
+            entry["owners"].append((mod, name))
+            if key is not None:
+                entry["keys"].append(key)
+            entry["persistent"] |= persistent
+            if name in shard_meta and entry["axis"] is None:
+                entry["axis"] = shard_meta[name]
+                entry["rank"] = subsch.rank
+                entry["world_size"] = subsch.world_size
+    return list(tensors.values())
+
+
+def load_pretrained(
+    sch,
+    path_or_reader: Union[str, CheckpointReader],
+    key_fn: Optional[Callable[[str], Optional[str]]] = None,
+    device: Optional[Union[str, torch.device]] = None,
+    strict: bool = True,
+):
+    """Load pretrained weights into a scheduled model. The parameters and
+    buffers are replaced with the local slices of the checkpoint tensors
+    according to their sharding specs, so the model can be created on the
+    meta device, and built with `init_weights=False` afterwards.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule of the model.
+    path_or_reader : Union[str, CheckpointReader]
+        The checkpoint path (see `open_checkpoint`) or an opened reader.
+    key_fn : Optional[Callable[[str], Optional[str]]]
+        The function to map the parameter name in the scheduled model to
+        the tensor name in the checkpoint, e.g., when the model is a
+        submodule of the pretrained model. If it returns None, the tensor
+        is not loaded.
+    device : Optional[Union[str, torch.device]]
+        The device of the loaded tensors. If None, use the device of the
+        original tensors, or CPU if they are on the meta device.
+    strict : bool
+        Whether to raise an error if a persistent tensor is not found.
+
+    Returns
+    -------
+    list[str]
+        The names of the missing tensors.
+    """
+    if isinstance(path_or_reader, CheckpointReader):
+        reader = path_or_reader
+    else:
+        reader = open_checkpoint(path_or_reader)
+
+    def get_local(entry, key):
+        full_tensor = reader.get_tensor(key)
+        orig_shape = getattr(entry["tensor"], "orig_shape", entry["tensor"].shape)
+        if tuple(full_tensor.shape) != tuple(orig_shape):
+            raise ValueError(
+                f"The shape of {key} in the checkpoint {tuple(full_tensor.shape)} "
+                f"does not match the shape in the model {tuple(orig_shape)}"
+            )
+        return get_local_slice(
+            full_tensor, entry["axis"], entry["rank"], entry["world_size"]
+        )
+
+    return load_tensors(sch, reader, get_local, key_fn, device, strict)
+
+
+def load_tensors(sch, reader, get_local, key_fn=None, device=None, strict=True):
+    """Replace the parameters and buffers of a scheduled model with the local
+    tensors from a checkpoint. See `load_pretrained` for details.
+
+    Parameters
+    ----------
+    sch : Schedule
+        The schedule of the model.
+    reader : CheckpointReader
+        The checkpoint reader.
+    get_local : Callable[[dict, str], torch.Tensor]
+        The function that takes the tensor entry with its sharding spec and
+        the checkpoint key, and returns the local tensor.
+    key_fn : Optional[Callable[[str], Optional[str]]]
+        The function to map the tensor names to the checkpoint keys.
+    device : Optional[Union[str, torch.device]]
+        The device of the loaded tensors.
+    strict : bool
+        Whether to raise an error if a persistent tensor is not found.
+
+    Returns
+    -------
+    list[str]
+        The names of the missing tensors.
+    """
+    top_sch = sch.get_top_schedule()
+    replaced = {}
+    missing = []
+    for entry in _collect_tensors(sch, key_fn):
+        tensor = entry["tensor"]
+        key = next((key for key in entry["keys"] if key in reader), None)
+        if key is None:
+            if entry["persistent"] and entry["keys"]:
+                missing.append(entry["keys"][0])
+            continue
+
+        local = get_local(entry, key)
+        if tuple(local.shape) != tuple(tensor.shape):
+            raise ValueError(
+                f"The local slice of {key} has shape {tuple(local.shape)}, "
+                f"but the model expects {tuple(tensor.shape)}"
+            )
+
+        target_device = device
+        if target_device is None:
+            target_device = "cpu" if tensor.device.type == "meta" else tensor.device
+        # Only the local slice is read from the disk.
+        new_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, device=target_device)
+        with torch.no_grad():
+            new_tensor.copy_(local)
+        if isinstance(tensor, nn.Parameter):
+            new_tensor = nn.Parameter(new_tensor, requires_grad=tensor.requires_grad)
+            transfor_param_tags(top_sch, tensor, new_tensor)
+            for mod, name in entry["owners"]:
+                mod.register_parameter(name, new_tensor)
+        else:
+            for mod, name in entry["owners"]:
+                mod.register_buffer(
+                    name,
+                    new_tensor,
+                    persistent=name not in mod._non_persistent_buffers_set,
+                )
+        replaced[id(tensor)] = new_tensor
+
+    # Keep the tied weights up to date.
+    tie_weights = top_sch.metadata.tie_weights
+    for param, tied_param in tie_weights.items():
+        if id(tied_param) in replaced:
+            tie_weights[param] = replaced[id(tied_param)]
+
+    if missing:
+        if strict:
+            raise KeyError(f"Missing tensors in the checkpoint: {missing}")
+        logger.warning("Missing tensors in the checkpoint: %s", missing)
+    return missing
@@ -0,0 +1,354 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""Reshard a checkpoint saved by `save_checkpoint` to another tensor and
+pipeline parallel configuration offline, without materializing the model.
+
+The tensors are processed one at a time: the shards of a tensor are
+memory-mapped and concatenated, and the new shards are written to the
+pre-allocated files of the target ranks. Thus, the peak memory is bounded
+by the largest tensors being processed by the worker processes.
+
+Example:
+
+.. code-block:: bash
+
+    python -m slapo.weights.reshard ckpt/tp4_pp2 ckpt/tp2 --tp 2 --workers 8
+
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+from collections.abc import Callable
+from typing import Optional, Union
+
+import torch
+
+from ..logger import get_logger
+from .checkpoint import CHECKPOINT_VERSION, get_rank_file
+from .formats import FLAT_FORMAT, _MappedFile, str_to_dtype
+from .loader import get_local_slice
+
+logger = get_logger()
+
+
+def _data_file(rank):
+    return get_rank_file(rank).replace(".json", ".bin")
+
+
+def _read_source(path):
+    """Read the manifests of a sharded checkpoint, and collect the locations
+    of the shards of each tensor. The replicas of data parallelism are only
+    read once.
+    """
+    index_files = sorted(glob.glob(os.path.join(path, "rank_*.json")))
+    if not index_files:
+        raise FileNotFoundError(f"Cannot find a sharded checkpoint in {path}")
+
+    tensors = {}
+    user_metadata = {}
+    # The names of all tensors with their stages in the module order.
+    order = {}
+    for index_file in index_files:
+        with open(index_file, "r", encoding="utf-8") as filep:
+            index = json.load(filep)
+        if index.get("format", None) != FLAT_FORMAT or "tensors" not in index.get(
+            "metadata", {}
+        ):
+            raise ValueError(f"{index_file} is not saved by save_checkpoint")
+        manifest = index["metadata"]
+        user_metadata = manifest.get("user", user_metadata)
+        stage = min(manifest["stages"], default=0)
+        for name in manifest.get("order", manifest["tensors"]):
+            order.setdefault(name, (stage, len(order)))
+        for name, spec in manifest["tensors"].items():
+            info = index["tensors"][name]
+            if name not in tensors:
+                tensors[name] = {
+                    "orig_shape": spec["orig_shape"],
+                    "axis": spec["axis"],
+                    "tp_world_size": spec["tp_world_size"],
+                    "stage": spec["stage"],
+                    "aliases": spec.get("aliases", []),
+                    "dtype": info["dtype"],
+                    "shards": {},
+                }
+            entry = tensors[name]
+            if (entry["orig_shape"], entry["axis"], entry["tp_world_size"]) != (
+                spec["orig_shape"],
+                spec["axis"],
+                spec["tp_world_size"],
+            ):
+                raise ValueError(f"Inconsistent sharding of {name} in {index_file}")
+            tp_rank = spec["tp_rank"] if spec["axis"] is not None else 0
+            entry["shards"].setdefault(
+                tp_rank,
+                (
+                    os.path.join(path, info["file"]),
+                    info["offset"],
+                    info["shape"],
+                ),
+            )
+
+    for name, entry in tensors.items():
+        num_shards = entry["tp_world_size"] if entry["axis"] is not None else 1
+        if len(entry["shards"]) != num_shards:
+            raise ValueError(
+                f"Expected {num_shards} shards of {name}, "
+                f"but only found {sorted(entry['shards'])}"
+            )
+    return tensors, order, user_metadata
+
+
+def _split_stages(names, pipeline_split):
+    """Assign the pipeline stages to the ordered tensor names, where a new
+    stage starts from each of the split module names.
+    """
+    splits = list(pipeline_split)
+    stages, stage = {}, 0
+    for name in names:
+        while stage < len(splits) and (
+            name == splits[stage] or name.startswith(f"{splits[stage]}.")
+        ):
+            stage += 1
+        stages[name] = stage
+    if stage != len(splits):
+        raise ValueError(f"Cannot find the split module {splits[stage]}")
+    return stages
+
+
+def _make_plan(tensors, order, tp_size, pipeline_split):
+    """Plan the target files and the offsets of the new shards."""
+    all_names = sorted(
+        {
+            alias
+            for name, entry in tensors.items()
+            for alias in [name] + entry["aliases"]
+        },
+        key=lambda name: order.get(name, (0, len(order))),
+    )
+    if pipeline_split is None:
+        stage_of = {
+            alias: entry["stage"]
+            for name, entry in tensors.items()
+            for alias in [name] + entry["aliases"]
+        }
+    elif callable(pipeline_split):
+        stage_of = {name: pipeline_split(name) for name in all_names}
+    else:
+        stage_of = _split_stages(all_names, pipeline_split)
+    num_stages = max(stage_of.values(), default=0) + 1
+
+    # The data files and their tensors of the target ranks.
+    files = {}
+    tasks = []
+    for name, entry in tensors.items():
+        axis, orig_shape = entry["axis"], entry["orig_shape"]
+        if axis is not None and orig_shape[axis] % tp_size != 0:
+            raise ValueError(
+                f"Cannot shard axis {axis} of {name} with size "
+                f"{orig_shape[axis]} by {tp_size}"
+            )
+        local_shape = list(orig_shape)
+        if axis is not None:
+            local_shape[axis] //= tp_size
+        dtype = str_to_dtype(entry["dtype"])
+        nbytes = (
+            torch.Size(local_shape).numel()
+            * torch.empty((), dtype=dtype).element_size()
+        )
+
+        # Tied tensors are placed in every stage that has one of their names,
+        # and share the same shards as `new_or_get_tied_param` does.
+        stage_names = {}
+        for alias in [name] + entry["aliases"]:
+            stage_names.setdefault(stage_of[alias], []).append(alias)
+        targets = []
+        for stage, names in sorted(stage_names.items()):
+            for tp_rank in range(tp_size):
+                rank = stage * tp_size + tp_rank
+                if rank not in files:
+                    files[rank] = {
+                        "stage": stage,
+                        "tp_rank": tp_rank,
+                        "size": 0,
+                        "tensors": {},
+                        "manifest": {},
+                    }
+                target = files[rank]
+                target["tensors"][names[0]] = {
+                    "file": _data_file(rank),
+                    "dtype": entry["dtype"],
+                    "shape": local_shape,
+                    "offset": target["size"],
+                }
+                target["manifest"][names[0]] = {
+                    "orig_shape": orig_shape,
+                    "axis": axis,
+                    "tp_rank": tp_rank,
+                    "tp_world_size": tp_size,
+                    "stage": stage,
+                    "aliases": names[1:],
+                }
+                targets.append((rank, tp_rank, target["size"]))
+                target["size"] += nbytes
+        tasks.append((name, entry, tp_size, targets))
+    for target in files.values():
+        target["order"] = [
+            name for name in all_names if stage_of[name] == target["stage"]
+        ]
+    return files, tasks, num_stages
+
+
+def _reshard_tensor(task, dst):
+    """Gather the shards of a tensor, and write the new shards."""
+    name, entry, tp_size, targets = task
+    dtype = str_to_dtype(entry["dtype"])
+    shards = []
+    for tp_rank in sorted(entry["shards"]):
+        file_path, offset, shape = entry["shards"][tp_rank]
+        shards.append(_MappedFile(file_path).tensor(offset, dtype, shape))
+    if entry["axis"] is None:
+        full = shards[0]
+    else:
+        full = torch.cat(shards, dim=entry["axis"])
+    if list(full.shape) != list(entry["orig_shape"]):
+        raise ValueError(
+            f"The shards of {name} have shape {tuple(full.shape)}, "
+            f"but its original shape is {tuple(entry['orig_shape'])}"
+        )
+    for rank, tp_rank, offset in targets:
+        local = get_local_slice(full, entry["axis"], tp_rank, tp_size)
+        data = local.contiguous().reshape(-1).view(torch.uint8).numpy()
+        data_path = os.path.join(dst, _data_file(rank))
+        with open(f"{data_path}.tmp", "r+b") as filep:
+            filep.seek(offset)
+            filep.write(data.data)
+    return name
+
+
+def reshard(
+    src: str,
+    dst: str,
+    tp_size: int,
+    pipeline_split: Optional[Union[list[str], Callable[[str], int]]] = None,
+    num_workers: int = 1,
+) -> list[str]:
+    """Reshard a checkpoint saved by `save_checkpoint` to another tensor
+    and pipeline parallel configuration. The sharded tensors are split along
+    the same axes as the shard primitive, and the tied tensors keep sharing
+    the same shards. The target checkpoint has a file per pipeline stage and
+    tensor parallel rank (`stage * tp_size + tp_rank`), which is shared by
+    the data parallel replicas, and `load_checkpoint` picks the file by the
+    coordinate of the global rank in the device mesh.
+
+    Parameters
+    ----------
+    src : str
+        The directory of the source checkpoint.
+    dst : str
+        The directory of the target checkpoint.
+    tp_size : int
+        The target tensor parallel size.
+    pipeline_split : Optional[Union[list[str], Callable[[str], int]]]
+        The target pipeline stages. It can be a list of the module names
+        that start new stages, similar to `pipeline_split`, or a function
+        that maps a tensor name to its stage. If None, the pipeline stages
+        of the source checkpoint are kept.
+    num_workers : int
+        The number of worker processes.
+
+    Returns
+    -------
+    list[str]
+        The paths of the target index files.
+    """
+    tensors, order, user_metadata = _read_source(src)
+    files, tasks, num_stages = _make_plan(tensors, order, tp_size, pipeline_split)
+    os.makedirs(dst, exist_ok=True)
+    for rank, target in files.items():
+        data_path = os.path.join(dst, _data_file(rank))
+        with open(f"{data_path}.tmp", "wb") as filep:
+            filep.truncate(target["size"])
+
+    logger.info(
+        "Resharding %d tensors to %d stages with tensor parallel size %d",
+        len(tasks),
+        num_stages,
+        tp_size,
+    )
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            for name in pool.imap_unordered(
+                _reshard_worker, [(task, dst) for task in tasks]
+            ):
+                logger.debug("Resharded %s", name)
+    else:
+        for task in tasks:
+            logger.debug("Resharded %s", _reshard_tensor(task, dst))
+
+    index_files = []
+    for rank, target in sorted(files.items()):
+        data_path = os.path.join(dst, _data_file(rank))
+        os.replace(f"{data_path}.tmp", data_path)
+        index = {
+            "format": FLAT_FORMAT,
+            "metadata": {
+                "version": CHECKPOINT_VERSION,
+                "rank": rank,
+                "world_size": num_stages * tp_size,
+                "tp_rank": target["tp_rank"],
+                "tp_world_size": tp_size,
+                "stages": [target["stage"]],
+                "tensors": target["manifest"],
+                "order": target["order"],
+                "user": user_metadata,
+            },
+            "tensors": target["tensors"],
+        }
+        index_path = os.path.join(dst, get_rank_file(rank))
+        with open(f"{index_path}.tmp", "w", encoding="utf-8") as filep:
+            json.dump(index, filep)
+        os.replace(f"{index_path}.tmp", index_path)
+        index_files.append(index_path)
+    return index_files
+
+
+def _reshard_worker(args):
+    return _reshard_tensor(*args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Reshard a Slapo checkpoint")
+    parser.add_argument("src", type=str, help="The source checkpoint directory")
+    parser.add_argument("dst", type=str, help="The target checkpoint directory")
+    parser.add_argument(
+        "--tp", type=int, required=True, help="The target tensor parallel size"
+    )
+    parser.add_argument(
+        "--pipeline-split",
+        type=str,
+        nargs="*",
+        default=None,
+        help="The module names that start new pipeline stages. "
+        "If not specified, the source pipeline stages are kept",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="The number of worker processes"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    index_files = reshard(
+        args.src, args.dst, args.tp, args.pipeline_split, num_workers=args.workers
+    )
+    logger.info("Saved %d ranks to %s", len(index_files), args.dst)
+
+
+if __name__ == "__main__":
+    main()
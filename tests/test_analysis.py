@@ -0,0 +1,150 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Test the static analysis of schedules.
+"""
+# pylint: disable=unused-argument
+
+import pytest
+import torch
+from torch import nn
+
+import slapo
+from slapo.analysis import count_cost, estimate_memory
+
+
+class Layer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc1 = nn.Linear(64, 256)
+        self.act = nn.GELU()
+        self.fc2 = nn.Linear(256, 64)
+
+    def forward(self, x):
+        return self.fc2(self.act(self.fc1(x)))
+
+
+class Model(nn.Module):
+    def __init__(self, num_layers=4):
+        super().__init__()
+        self.layers = nn.ModuleList([Layer() for _ in range(num_layers)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def test_estimate_memory():
+    with slapo.init_empty_weights():
+        model = Model()
+    sch = slapo.create_schedule(model)
+    inp = torch.randn(8, 32, 64, device="meta")
+    param_bytes = sum(p.numel() * 4 for p in model.parameters())
+    act_bytes = 8 * 32 * 4
+
+    est = estimate_memory(sch, inp)
+    assert len(est.stages) == 1
+    stage = est.stages[0]
+    assert stage.params == param_bytes
+    assert stage.grads == param_bytes
+    assert stage.optimizer_states == 2 * param_bytes
+    # Each layer saves its input, and the outputs of fc1 and GELU.
+    assert stage.activations == 4 * act_bytes * (64 + 256 + 256)
+
+    # The checkpointed layers only save their inputs.
+    sch["layers.1"].checkpoint()
+    sch["layers.2"].checkpoint()
+    ckpt_est = estimate_memory(sch, inp)
+    stage = ckpt_est.stages[0]
+    assert stage.activations == 2 * act_bytes * (64 + 256 + 256) + 2 * act_bytes * 64
+    assert stage.recompute == act_bytes * (256 + 256)
+    assert ckpt_est.peak < est.peak
+
+    inference = estimate_memory(sch, inp, training=False)
+    assert inference.stages[0].activations == 0
+    assert inference.peak == param_bytes + inference.stages[0].transient
+
+
+def test_estimate_memory_pipeline():
+    sch = slapo.create_schedule(Model())
+    sch["layers.0.fc1"].shard("weight", axis=0)
+    sch["layers.0.fc1"].shard("bias", axis=0)
+    sch["layers.0.fc1"].sync(mode="bwd_post", sync_op_or_fn="all_reduce")
+    sch["layers.0.fc2"].shard("weight", axis=1)
+    sch["layers.0.fc2"].sync(mode="fwd_post", sync_op_or_fn="all_reduce")
+    sch.trace(leaf_modules=["Layer"])
+    sch["layers.1"].cut_pipeline_stage()
+    est = estimate_memory(sch, torch.randn(8, 32, 64), num_microbatches=4)
+    assert len(est.stages) == 2
+    assert est.stages[0].params == est.stages[1].params
+    # The first stage holds two in-flight micro-batches.
+    assert est.stages[0].activations == 2 * est.stages[1].activations
+
+
+def test_estimate_memory_tp():
+    # Estimate tensor parallelism in a single process without distributed.
+    assert not torch.distributed.is_initialized()
+    with slapo.init_empty_weights():
+        model = Model(num_layers=1)
+    sch = slapo.create_schedule(model)
+    sch["layers.0.fc1"].shard("weight", axis=0)
+    sch["layers.0.fc1"].shard("bias", axis=0)
+    sch["layers.0.fc1"].sync(mode="bwd_post", sync_op_or_fn="all_reduce")
+    sch["layers.0.fc2"].shard("weight", axis=1)
+    sch["layers.0.fc2"].sync(mode="fwd_post", sync_op_or_fn="all_reduce")
+    inp = torch.randn(8, 32, 64, device="meta")
+    act_bytes = 8 * 32 * 4
+
+    est = estimate_memory(sch, inp)
+    tp_est = estimate_memory(sch, inp, tp_size=4)
+    # Only the bias of fc2 is replicated.
+    assert tp_est.stages[0].params == (est.stages[0].params - 64 * 4) // 4 + 64 * 4
+    # The outputs of fc1 and GELU are sharded.
+    assert tp_est.stages[0].activations == act_bytes * (64 + 256 // 4 * 2)
+    with pytest.raises(ValueError):
+        estimate_memory(sch, inp, tp_size=3)
+
+    report = count_cost(sch, inp, training=False, tp_size=4)
+    assert report.forward_flops == 2 * 2 * 8 * 32 * 64 * 256 // 4
+    # The all-reduce of the output of fc2 with the ring algorithm.
+    assert report.forward_comm_bytes == 2 * 3 / 4 * act_bytes * 64
+
+
+def test_count_cost():
+    with slapo.init_empty_weights():
+        model = Model()
+    sch = slapo.create_schedule(model)
+    inp = torch.randn(8, 32, 64, device="meta")
+    # The FLOPs of fc1 and fc2 in a layer.
+    layer_flops = 2 * 2 * 8 * 32 * 64 * 256
+
+    report = count_cost(sch, inp)
+    assert report.forward_flops == 4 * layer_flops
+    assert report.modules["layers.0.fc1"].total_flops == layer_flops // 2
+    # The gradients of inputs and weights, except for the input of the model.
+    assert report.backward_flops == 2 * report.forward_flops - layer_flops // 2
+    assert report.recompute_flops == 0
+    assert report.aggregate(depth=2)["layers.1"].total_flops == layer_flops
+    assert report.aggregate()[""].total_flops == report.forward_flops
+    assert "layers.0.fc1" in report.table(top_k=2)
+
+    sch["layers.1"].checkpoint()
+    report = count_cost(sch, inp)
+    assert report.recompute_flops == layer_flops
+    assert report.hardware_flops == report.model_flops + layer_flops
+    assert count_cost(sch, inp, training=False).backward_flops == 0
+
+
+def test_count_cost_comm():
+    sch = slapo.create_schedule(Model(num_layers=1))
+    sch["layers.0.fc2"].shard("weight", axis=1)
+    sch["layers.0.fc2"].sync(mode="fwd_post", sync_op_or_fn="all_reduce")
+    report = count_cost(sch, torch.randn(8, 32, 64))
+    # The simulated all-reduce is counted without distributed.
+    assert report.modules["layers.0.fc2"].num_comms == 1
+    assert report.forward_comm_bytes == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,381 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Test the auto-tuner.
+"""
+import argparse
+import os
+import time
+
+import pytest
+import torch
+from torch import nn
+
+import slapo
+from slapo.autotune import tune as tune_module
+from slapo.autotune.cost_model import CostModel, LayerProfile
+from slapo.autotune.database import Database
+from slapo.autotune.executor import TrialExecutor, split_devices
+from slapo.autotune.monitor import TrialMonitor
+from slapo.autotune.search import EvalCache, get_search_strategy
+from slapo.autotune.tune import Space, tune, tune_space
+from slapo.autotune.worker import InProcessEvaluator
+from slapo.framework_dialect import DeepSpeedLogParser, MegatronLogParser
+
+
+def test_cost_model():
+    profile = LayerProfile(flops=1e9, comm_bytes=1e6, act_bytes=100, ckpt_act_bytes=10)
+    model = CostModel(profile, num_layers=4)
+    # Recomputation takes more time but less memory.
+    full = {"batch_size": 8, "ckpt_ratio": 1.0}
+    none = {"batch_size": 8, "ckpt_ratio": 0.0}
+    assert model.predict_time(full) > model.predict_time(none)
+    assert model.predict_memory(full) < model.predict_memory(none)
+
+    # The step time is 2x of the prediction, and 32 samples without
+    # checkpointing run out of memory.
+    records = [
+        (cfg, cfg["batch_size"] / (2 * model.predict_time(cfg)), 0)
+        for cfg in [full, none, {"batch_size": 16, "ckpt_ratio": 0.5}]
+    ]
+    records.append(({"batch_size": 32, "ckpt_ratio": 0.0}, 0, 1))
+    model.calibrate(records)
+    assert model.scale == pytest.approx(2)
+    assert model.predict_thrpt({"batch_size": 32, "ckpt_ratio": 0.0}) == 0
+    candidates = [{"batch_size": bs, "ckpt_ratio": 0.0} for bs in [8, 16, 32]]
+    assert model.rank(candidates, top_k=1) == [candidates[1]]
+
+    # Failures other than out of memory do not limit the memory.
+    model = CostModel(profile, num_layers=4)
+    model.calibrate([(none, 10.0, 0), ({"batch_size": 16, "ckpt_ratio": 0.0}, 0, 2)])
+    assert model.memory_limit is None
+    assert model.predict_thrpt({"batch_size": 32, "ckpt_ratio": 0.0}) > 0
+
+
+def test_layer_profile():
+    layer = nn.Sequential(nn.Linear(64, 256), nn.GELU(), nn.Linear(256, 64))
+    sch = slapo.create_schedule(layer)
+    profile = LayerProfile.from_schedule(sch, torch.randn(8, 64), batch_size=8)
+    assert profile.flops == 2 * 2 * 64 * 256
+    assert profile.ckpt_act_bytes == 64 * 4
+    assert profile.act_bytes == (64 + 256 + 256) * 4
+
+
+def test_tune_with_cost_model(tmp_path):
+    db = Database(str(tmp_path / "tune.db"))
+    db.commit(Space.cfg_dict_to_str({"batch_size": 4, "ckpt_ratio": 1.0}), {})
+    assert db.get_results() == [({"batch_size": 4, "ckpt_ratio": 1.0}, 0, None)]
+
+    args = argparse.Namespace(training_script_args=["slapo-megatron"])
+    evaluated = []
+
+    def eval_fn(cfg):
+        evaluated.append(cfg)
+        return cfg["batch_size"] * (2 - cfg["ckpt_ratio"])
+
+    best = tune(args, lambda _: (4, 16, 4), eval_fn, CostModel(), top_k=3)
+    assert len(evaluated) == 3
+    assert best == {"batch_size": 16, "ckpt_ratio": 0.25}
+
+
+def test_load_cost_model(tmp_path):
+    # Without the costs of the model, fall back to the binary search.
+    (tmp_path / "no_cost_cfg.py").write_text("def get_bs_range(args):\n    pass\n")
+    assert tune_module.load_cost_model(str(tmp_path / "no_cost_cfg.py"), {}) is None
+
+    (tmp_path / "cost_cfg.py").write_text(
+        "from slapo.autotune.cost_model import CostModel\n\n\n"
+        "def get_cost_model(args):\n    return CostModel(num_layers=args['layers'])\n"
+    )
+    model = tune_module.load_cost_model(str(tmp_path / "cost_cfg.py"), {"layers": 4})
+    assert model.num_layers == 4
+
+
+def test_database(tmp_path):
+    path = str(tmp_path / "tune.db")
+    db = Database(path, model="gpt2", hardware="8xA100", workload="w1")
+    for bs, thrpt in [(8, 10.0), (16, 18.0), (32, 0.0)]:
+        cfg = {"batch_size": bs, "ckpt_ratio": 1.0}
+        db.commit(
+            Space.cfg_dict_to_str(cfg),
+            {
+                "config": cfg,
+                "error_code": 0 if thrpt else 1,
+                "thrpt": thrpt,
+                "log": f"log of {bs}",
+            },
+        )
+    db.close()
+
+    # A restarted tuning sees the records of the same workload.
+    db = Database(path, model="gpt2", hardware="8xA100", workload="w1")
+    record = db.lookup("(batch_size: 16, ckpt_ratio: 1.0)")
+    assert record["thrpt"] == 18.0 and "log" not in record
+    assert db.get_log(record["id"]) == "log of 16"
+    assert len(db.get_results()) == 3
+    assert db.best(model="gpt2", min_batch_size=16)["batch_size"] == 16
+    assert db.best(model="gpt2", max_batch_size=8)["batch_size"] == 8
+    assert [r["batch_size"] for r in db.query(succeeded=False)] == [32]
+
+    # The record of a config is overridden by a later one.
+    db.commit("(batch_size: 32, ckpt_ratio: 1.0)", {"error_code": 0, "thrpt": 20.0})
+    assert db.lookup("(batch_size: 32, ckpt_ratio: 1.0)")["thrpt"] == 20.0
+    assert db.best(model="gpt2")["batch_size"] == 32
+    assert len(db) == 4
+
+    other = Database(path, hardware="8xA100", workload="w2")
+    assert other.lookup("(batch_size: 16, ckpt_ratio: 1.0)") is None
+    assert not other.get_results()
+
+    with open(tmp_path / "old.json", "w", encoding="utf-8") as f:
+        f.write('{"(batch_size: 4, ckpt_ratio: 0.5)": {"error_code": 0, "thrpt": 1}}')
+    with pytest.raises(ValueError):
+        Database(str(tmp_path / "old.json"))
+    other.import_json(str(tmp_path / "old.json"))
+    assert other.get_results() == [({"batch_size": 4, "ckpt_ratio": 0.5}, 1, 0)]
+
+
+def test_trial_executor(tmp_path):
+    slots = split_devices(list(range(4)), 2)
+    assert slots == ["0,1", "2,3"]
+    with TrialExecutor(slots, timeout=2, workdir=str(tmp_path)) as executor:
+        start = time.time()
+        futures = [
+            executor.submit("sleep 0.5; echo $CUDA_VISIBLE_DEVICES", {"idx": idx})
+            for idx in range(2)
+        ]
+        results = [future.result() for future in futures]
+        # The two trials run concurrently.
+        assert time.time() - start < 1
+        assert len({result.workdir for result in results}) == 2
+        outputs = set()
+        for result in results:
+            assert result.returncode == 0
+            with open(result.log_file, encoding="utf-8") as f:
+                outputs.add(f.read().strip())
+        assert outputs == set(slots)
+
+        # The timed out trial and its orphan process are killed.
+        result = executor.run("(sleep 30 &) ; echo $! > pid; sleep 30", {})
+        assert result.timed_out and result.elapsed < 10
+        result = executor.run("sleep 30 & echo $! > pid", {})
+        assert result.returncode == 0
+        with open(os.path.join(result.workdir, "pid"), encoding="utf-8") as f:
+            pid = int(f.read())
+        time.sleep(0.1)
+        status = f"/proc/{pid}/status"
+        if os.path.exists(status):
+            with open(status, encoding="utf-8") as f:
+                assert "zombie" in f.read()
+
+
+@pytest.mark.parametrize("num_parallel", [1, 3])
+def test_tune_parallel(num_parallel, monkeypatch):
+    monkeypatch.setattr(tune_module.time, "sleep", lambda _: None)
+    args = argparse.Namespace(training_script_args=["slapo-megatron"])
+
+    def eval_fn(cfg):
+        # Out of memory.
+        if cfg["batch_size"] > 22:
+            return 0
+        return cfg["batch_size"] * (2 - cfg["ckpt_ratio"])
+
+    # The k-ary search finds the same config as the binary search.
+    best = tune(args, lambda _: (4, 32, 4), eval_fn, num_parallel=num_parallel)
+    assert best == {"batch_size": 20, "ckpt_ratio": 0.25}
+
+
+def test_log_stream(tmp_path):
+    lines = [
+        f"iteration {idx * 5}/ 100 | elapsed time per iteration (ms): {time:.1f} | "
+        "global batch size: 16 | max allocated: 1000"
+        for idx, time in enumerate([300, 200, 201, 199, 200], 1)
+    ]
+    lines.insert(0, "parameters on (tensor, pipeline) model parallel rank (0, 0): 1000")
+    text = "\n".join(lines) + "\n"
+    log_file = tmp_path / "log.txt"
+    log_file.write_text(text)
+    stream = MegatronLogParser.create_stream()
+    # Feed the log in arbitrary chunks.
+    for idx in range(0, len(text), 7):
+        stream.feed(text[idx : idx + 7])
+    assert len(stream.windows) == 5 and stream.error_code is None
+    assert stream.estimate() == pytest.approx(
+        MegatronLogParser.parse_log(str(log_file))[1], rel=1e-3
+    )
+    assert stream.steady_thrpt(min_windows=3) == pytest.approx(80, rel=1e-2)
+    assert stream.steady_thrpt(min_windows=5) is None
+
+    text = "".join(f"SamplesPerSec={val}\n" for val in [10, 15, 16.6667])
+    log_file.write_text(text)
+    stream = DeepSpeedLogParser.create_stream()
+    stream.feed(text)
+    assert stream.windows[1:] == pytest.approx([20, 20], rel=1e-3)
+    assert stream.estimate() == pytest.approx(
+        DeepSpeedLogParser.parse_log(str(log_file))[1]
+    )
+    stream.feed("torch.cuda.OutOfMemoryError: CUDA out of memory.\n")
+    assert stream.error_code == 1
+
+
+def test_trial_monitor(tmp_path):
+    script = (
+        "for t in 300 200 200 200 200; do "
+        'echo "elapsed time per iteration (ms): $t | global batch size: 16"; '
+        "sleep 0.2; done; sleep 30"
+    )
+    with TrialExecutor(timeout=20, workdir=str(tmp_path), poll_interval=0.1) as ex:
+        # Stop the trial once it is stable and cannot beat the best.
+        monitor = TrialMonitor(MegatronLogParser.create_stream, lambda: 100.0)
+        result = ex.run(script, {}, monitor=monitor)
+        assert result.stop_reason.startswith("slow") and result.elapsed < 10
+        assert monitor.result() == (0, pytest.approx(80))
+
+        # Stop the trial as soon as it runs out of memory.
+        monitor = TrialMonitor(MegatronLogParser.create_stream)
+        result = ex.run("echo 'CUDA out of memory'; sleep 30", {}, monitor=monitor)
+        assert result.stop_reason == "oom" and result.elapsed < 10
+        assert monitor.result() == (1, 0.0)
+
+
+IN_PROCESS_CFG = """
+import os
+import torch
+import torch.distributed as dist
+
+
+def get_eval_fn(args):
+    # Record the initialization of each worker.
+    with open(args["out"], "a") as filep:
+        filep.write(os.environ["SLAPO_TEST_SLOT"] + "\\n")
+    weight = torch.ones(4)
+
+    def eval_fn(cfg):
+        if cfg["batch_size"] > 8:
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory.")
+        if cfg["batch_size"] == 0:
+            raise ValueError("Invalid batch size")
+
+        def step():
+            dist.all_reduce(weight * cfg["batch_size"])
+
+        return step, cfg["batch_size"]
+
+    return eval_fn
+"""
+
+
+def test_in_process_evaluator(tmp_path):
+    config_file = tmp_path / "in_process_cfg.py"
+    config_file.write_text(IN_PROCESS_CFG)
+    out_file = tmp_path / "workers.txt"
+    with InProcessEvaluator(
+        str(config_file),
+        {"out": str(out_file)},
+        ["0,1"],
+        num_warmup=1,
+        num_steps=2,
+        timeout=60,
+        slot_env="SLAPO_TEST_SLOT",
+    ) as evaluator:
+        for batch_size in (2, 4, 8):
+            error_code, thrpt, _ = evaluator({"batch_size": batch_size})
+            assert error_code == 0 and thrpt > 0
+        # The model is built once by the two ranks of the worker group.
+        assert evaluator.num_starts == 1
+        assert out_file.read_text().split() == ["0,1", "0,1"]
+
+        # The worker group is kept after a crash.
+        error_code, _, log = evaluator({"batch_size": 0})
+        assert error_code == 2 and "Invalid batch size" in log
+        assert evaluator({"batch_size": 4})[0] == 0
+        assert evaluator.num_starts == 1
+
+        # The worker group is recycled after OOM.
+        error_code, thrpt, log = evaluator({"batch_size": 16})
+        assert error_code == 1 and thrpt == 0 and "out of memory" in log
+        assert evaluator({"batch_size": 4})[0] == 0
+        assert evaluator.num_starts == 2
+
+
+def update_space(args, space):
+    batch_size = space.create_symbol("batch_size", [4, 8, 16, 32])
+    # Only checkpoint large batch sizes.
+    space.create_symbol("ckpt_ratio", [0.5, 1.0] if batch_size >= 16 else [0.0])
+    return space
+
+
+def eval_space(cfg):
+    if cfg["batch_size"] * (1.5 - cfg["ckpt_ratio"]) > 20:
+        return 0
+    return cfg["batch_size"] * (2 - cfg["ckpt_ratio"])
+
+
+def test_space_configs():
+    space = update_space({}, Space())
+    configs = list(space.configs({}, update_space))
+    assert configs == [
+        {"batch_size": 4, "ckpt_ratio": 0.0},
+        {"batch_size": 8, "ckpt_ratio": 0.0},
+        {"batch_size": 16, "ckpt_ratio": 0.5},
+        {"batch_size": 16, "ckpt_ratio": 1.0},
+        {"batch_size": 32, "ckpt_ratio": 0.5},
+        {"batch_size": 32, "ckpt_ratio": 1.0},
+    ]
+    # The space is not changed by the enumeration.
+    assert not space.space["batch_size"].is_fixed()
+    assert space.space["ckpt_ratio"].vals == [0.0]
+    assert space.count({}, update_space) == 6
+    assert space.count({}, update_space, lambda cfg: cfg["batch_size"] != 16) == 4
+
+    shards = [
+        list(space.configs({}, update_space, num_shards=4, shard_idx=idx))
+        for idx in range(4)
+    ]
+    assert [len(shard) for shard in shards] == [2, 2, 1, 1]
+    assert sorted(sum(shards, []), key=str) == sorted(configs, key=str)
+
+
+@pytest.mark.parametrize(
+    "strategy,kwargs",
+    [
+        ("grid", {}),
+        ("random", {"num_trials": 10, "seed": 0}),
+        ("successive_halving", {"num_configs": 6, "max_resource": 9, "seed": 0}),
+        ("hyperband", {"max_resource": 9, "seed": 0}),
+        ("evolution", {"population": 3, "generations": 3, "seed": 0}),
+    ],
+)
+def test_search_strategy(strategy, kwargs):
+    args = argparse.Namespace(training_script_args=[])
+    space = update_space({}, Space())
+    assert len(list(space.configs({}, update_space))) == 6
+
+    evaluated = []
+
+    def eval_fn(cfg):
+        evaluated.append(cfg)
+        return eval_space(cfg)
+
+    cache = EvalCache(eval_fn, num_parallel=2)
+    best = tune_space(
+        args,
+        update_space,
+        eval_fn,
+        get_search_strategy(strategy, **kwargs),
+        cache=cache,
+    )
+    best.pop("steps", None)
+    assert best == {"batch_size": 32, "ckpt_ratio": 1.0}
+    # Each config is evaluated at most once for each resource.
+    assert len(evaluated) == len(cache)
+
+    # The cache is shared by another search.
+    num_evaluated = len(evaluated)
+    tune_space(args, update_space, eval_fn, get_search_strategy("grid"), cache=cache)
+    if strategy in ("grid", "random"):
+        assert len(evaluated) == num_evaluated
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
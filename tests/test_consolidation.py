@@ -121,5 +121,41 @@ def test_consolidation(init_dist, ngpu):
     verify_weights(sch_model)
 
 
+@pytest.mark.parametrize("bucket_size", [1, 25 * 1024 * 1024])
+def test_consolidation_shard_local(init_dist, bucket_size):
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+
+    def init_fn(module, path):
+        # Deterministic initialization for each module.
+        torch.manual_seed(len(path))
+        module.reset_parameters()
+
+    def build_model(shard_local):
+        with slapo.init_empty_weights(enable=True):
+            model = Model()
+        sch = slapo.create_schedule(model)
+        sch["linear1"].shard("weight", axis=0)
+        sch["linear1"].shard("bias", axis=0)
+        sch["linear1"].sync(mode="bwd_post", sync_op_or_fn="all_reduce")
+        sch["linear2"].shard("weight", axis=1)
+        sch["linear2"].sync(mode="fwd_post", sync_op_or_fn="all_reduce")
+        sch_model, _ = slapo.build(
+            sch,
+            init_weights=init_fn,
+            shard_local=shard_local,
+            bucket_size=bucket_size,
+        )
+        return sch_model
+
+    ref_model = build_model(shard_local=False)
+    sch_model = build_model(shard_local=True)
+    for (name, param), ref_param in zip(
+        sch_model.named_parameters(), ref_model.parameters()
+    ):
+        assert param.shape == ref_param.shape, name
+        torch.testing.assert_close(param, ref_param, rtol=0, atol=0)
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
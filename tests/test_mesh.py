@@ -0,0 +1,46 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Test the device mesh and the cache of process groups.
+"""
+# pylint: disable=unused-argument
+
+import pytest
+from torch import distributed as dist
+from torch import nn
+
+import slapo
+from slapo.mesh import DeviceMesh, get_process_group
+
+
+def test_device_mesh():
+    mesh = DeviceMesh(tp_size=2, pp_size=2, world_size=8)
+    assert mesh.dp_size == 2
+    # The same layout as PipeModelDataParallelTopology in DeepSpeed.
+    assert mesh.get_axis_comm_lists("model") == [[0, 1], [2, 3], [4, 5], [6, 7]]
+    assert mesh.get_axis_comm_lists("pipe") == [[0, 4], [1, 5], [2, 6], [3, 7]]
+    assert mesh.get_axis_comm_lists("data") == [[0, 2], [1, 3], [4, 6], [5, 7]]
+    assert mesh.filter_match(pipe=0) == [0, 1, 2, 3]
+    assert mesh.get_coord(6) == {"pipe": 1, "data": 1, "model": 0}
+    assert mesh.get_rank(pipe=1, data=1, model=0) == 6
+
+    with pytest.raises(ValueError):
+        DeviceMesh(tp_size=3, world_size=8)
+
+
+def test_process_group_cache(init_dist):
+    if not dist.is_initialized():
+        assert get_process_group([0]) is None
+        return
+    world_size = dist.get_world_size()
+    mesh = DeviceMesh(tp_size=world_size)
+    assert mesh.tp_group is get_process_group(range(world_size))
+    ranks = [world_size - 1]
+    assert get_process_group(ranks) is get_process_group(ranks)
+    # The groups are shared by schedules.
+    sch = slapo.create_schedule(nn.Linear(4, 4), group=mesh.tp_group)
+    assert sch.world_size == world_size
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,100 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Test schedule recording and replaying.
+"""
+# pylint: disable=unused-argument
+
+import pytest
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+import slapo
+
+
+class Model(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear1 = nn.Linear(16, 32)
+        self.linear2 = nn.Linear(32, 16)
+
+    def forward(self, x):
+        x = self.linear1(x)
+        x = F.gelu(x)
+        return self.linear2(x)
+
+
+class Top(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = nn.ModuleList([Model() for _ in range(2)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def schedule_fn(sch):
+    def pattern(x):
+        return F.gelu(x)
+
+    for idx in range(2):
+        subsch = sch[f"layers.{idx}"]
+        subsch.trace(flatten=True)
+        subgraph = subsch.find(pattern)
+        subsch.replace(nn.ReLU(), subgraph)
+        subsch["linear1"].decompose()
+
+
+def test_record_replay(tmp_path):
+    sch = slapo.create_schedule(Top())
+    with slapo.record(sch) as log:
+        schedule_fn(sch)
+    # Nested primitives (e.g., replace in trace) are not recorded, but
+    # the trace called by find is recorded because find is not replayed.
+    assert [name for _, name, _, _ in log.entries] == [
+        "trace",
+        "trace",
+        "replace",
+        "decompose",
+    ] * 2
+
+    path = tmp_path / "schedule.pkl"
+    log.save(path)
+
+    new_sch = slapo.create_schedule(Top())
+    slapo.ScheduleLog.load(path).replay(new_sch)
+    for idx in range(2):
+        code = new_sch[f"layers.{idx}"].mod.code
+        assert "gelu" not in code
+        assert "ReLU" in code
+    assert isinstance(new_sch["layers.0.linear1"].mod, slapo.op.LinearWithSeparateBias)
+    assert slapo.recorder.schedule_fingerprint(
+        new_sch
+    ) == slapo.recorder.schedule_fingerprint(sch)
+
+    # Replaying onto a different model fails the verification.
+    class Other(Top):
+        def __init__(self):
+            super().__init__()
+            self.layers[1].linear2 = nn.Linear(32, 8)
+
+    with pytest.raises(RuntimeError):
+        slapo.ScheduleLog.load(path).replay(slapo.create_schedule(Other()))
+
+
+def test_record_unserializable(tmp_path):
+    sch = slapo.create_schedule(Top())
+    with slapo.record(sch) as log:
+        sch["layers.0"].trace(flatten=True)
+        # Local functions cannot be pickled.
+        sch["layers.0"].replace_all(nn.Linear, lambda name, mod: nn.Identity())
+    assert len(log) == 2
+    with pytest.raises(ValueError):
+        log.save(tmp_path / "schedule.pkl")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
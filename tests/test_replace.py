@@ -3,6 +3,7 @@
 """Test replace primitives."""
 # pylint: disable=comparison-with-callable, unused-argument
 
+import copy
 import math
 import operator
 import pytest
@@ -152,6 +153,98 @@ def test_replace_all_module_list():
     assert sch["seq.2"].mod.out_features == 512
 
 
+def test_path_index():
+    class SubMod(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.linear = nn.Linear(16, 16)
+            self.activation = nn.ReLU()
+
+        def forward(self, x):
+            return self.activation(self.linear(x))
+
+    class NewSubMod(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.fc = nn.Linear(16, 16)
+
+        def forward(self, x):
+            return self.fc(x)
+
+    class Model(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.layers = nn.ModuleList([SubMod() for _ in range(2)])
+
+        def forward(self, x):
+            for layer in self.layers:
+                x = layer(x)
+            return x
+
+    sch = slapo.create_schedule(Model())
+    linear_sch = sch["layers.0.linear"]
+    assert sch["layers.0.linear"] is linear_sch
+    assert sch["layers.0"]["linear"] is linear_sch
+    assert "layers.0.linear" in sch
+    other_sch = sch["layers.1.linear"]
+
+    # Replacing the layer should invalidate the index of its descendants.
+    sch["layers.0"].replace(NewSubMod())
+    assert "layers.0.linear" not in sch
+    assert "layers.0.linear" not in sch.path_index
+    # The other entries are kept.
+    assert sch.path_index["layers.1.linear"] is other_sch
+    with pytest.raises(KeyError):
+        sch["layers.0.linear"]  # pylint: disable=pointless-statement
+    assert sch["layers.0.fc"].mod is sch["layers.0"].mod.fc
+    assert sch["layers.0.fc"].path == "layers.0.fc"
+    assert sch["layers.1.linear"].mod is sch.mod.layers[1].linear
+
+    # Tracing replaces the module with a GraphModule and re-creates child schedules.
+    sch.trace()
+    assert sch["layers.1.linear"].mod is sch.mod.get_submodule("layers.1.linear")
+    assert sch["layers.1.linear"].parent is sch["layers.1"]
+
+    # Replacing the top module should keep a single index for the tree.
+    sch = slapo.create_schedule(Model())
+    sch.replace(Model())
+    linear_sch = sch["layers.0.linear"]
+    assert sch["layers.0"].path_index is sch.path_index
+    sch["layers.0"].replace(NewSubMod())
+    assert "layers.0.linear" not in sch
+    with pytest.raises(KeyError):
+        sch["layers.0.linear"]  # pylint: disable=pointless-statement
+    assert sch["layers.0.fc"] is not linear_sch
+
+
+def test_module_index():
+    class Model(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.linear = nn.Linear(16, 16)
+            self.activation = nn.ReLU()
+
+        def forward(self, x):
+            return self.activation(self.linear(x))
+
+    sch = slapo.create_schedule(Model())
+    assert sch.get_module("linear") is sch.mod.linear
+
+    # Replacing a child module should invalidate the index of its ancestors.
+    new_linear = nn.Linear(16, 16)
+    sch["linear"].replace(new_linear)
+    assert sch.get_module("linear") is new_linear
+
+    # Fusion adds a new submodule and removes the fused ones.
+    def pattern(x):
+        return F.relu(call_module("linear", x))
+
+    subgraph = sch.find(pattern)
+    sch.fuse(subgraph, compiler=None, name="LinearReLU")
+    assert "linear" not in sch.get_module_index()
+    assert sch.get_module("LinearReLU_0") is sch["LinearReLU_0"].mod
+
+
 def test_vertical_replacement():
     class Model(nn.Module):
         def __init__(self):
@@ -340,6 +433,56 @@ def test_replace_function():
     assert cnt == 1
 
 
+def test_batch_replace(monkeypatch):
+    class Model(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.linears = nn.ModuleList([nn.Linear(16, 16) for _ in range(8)])
+
+        def forward(self, x):
+            for linear in self.linears:
+                x = F.relu(linear(x))
+            return x
+
+    def tanh(x, inplace=False):
+        return torch.tanh(x)
+
+    def schedule(sch):
+        sch.trace(flatten=True)
+        nodes = sch.find_node(
+            lambda node: node.op == "call_function" and node.target == F.relu
+        )
+        for idx, node in enumerate(nodes):
+            if idx % 2 == 0:
+                sch.replace(nn.GELU(), [[node]], name="act")
+            else:
+                sch.replace(tanh, node)
+
+    model = Model()
+    ref_sch = slapo.create_schedule(copy.deepcopy(model))
+    schedule(ref_sch)
+
+    num_recompiles = []
+    recompile = torch.fx.GraphModule.recompile
+
+    def counted_recompile(self):
+        num_recompiles.append(self)
+        return recompile(self)
+
+    sch = slapo.create_schedule(model)
+    with sch.batch():
+        sch.trace(flatten=True)
+        monkeypatch.setattr(torch.fx.GraphModule, "recompile", counted_recompile)
+        schedule(sch)
+        assert not num_recompiles
+    assert len(num_recompiles) == 1
+
+    assert sch.mod.code == ref_sch.mod.code
+    assert list(sch.child.keys()) == list(ref_sch.child.keys())
+    inp = torch.randn(2, 16)
+    torch.testing.assert_close(sch.mod(inp), ref_sch.mod(inp))
+
+
 def test_insertion_point():
     class Model(nn.Module):
         def forward(self, a, b, c):
@@ -322,5 +322,49 @@ def test_diamond():
     assert subgraph[3][1].target == operator.add
 
 
+def test_find_subgraph_in():
+    class SubMod(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.fc = nn.Linear(10, 10)
+            self.relu = nn.ReLU()
+
+        def forward(self, x):
+            return self.relu(self.fc(x)) + x
+
+    class Model(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.layers = nn.ModuleList([SubMod() for _ in range(3)])
+
+        def forward(self, x):
+            for layer in self.layers:
+                x = layer(x)
+            return x
+
+    sch = slapo.create_schedule(Model())
+
+    def pattern(x):
+        return F.relu(x) + x
+
+    paths = [f"layers.{idx}" for idx in range(3)]
+    res = sch.find_subgraph_in(paths, pattern)
+    assert list(res.keys()) == paths
+    for path in paths:
+        assert len(res[path]) == 1
+        subgraph = res[path][0]
+        assert len(subgraph) == 2
+        # The parent module names are relative to the sub-module.
+        assert subgraph[0][0] == ""
+        assert subgraph[0][1].target == "relu"
+        assert subgraph[1][1].target == operator.add
+        # The results are the same as the ones of the sub-module.
+        assert [node for _, node in sch[path].find(pattern)[0]] == [
+            node for _, node in subgraph
+        ]
+        sch[path].fuse(res[path], name="ReLUAdd")
+        assert "ReLUAdd_0" in dict(sch[path].mod.named_children())
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,142 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Test stamping schedule templates onto homogeneous layers.
+"""
+# pylint: disable=unused-argument
+
+import copy
+
+import pytest
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+import slapo
+
+
+class Layer(nn.Module):
+    def __init__(self, hidden=16):
+        super().__init__()
+        self.linear1 = nn.Linear(hidden, 32)
+        self.linear2 = nn.Linear(32, hidden)
+
+    def forward(self, x):
+        x = self.linear1(x)
+        x = F.gelu(x)
+        return self.linear2(x)
+
+
+class Model(nn.Module):
+    def __init__(self, num_layers=4):
+        super().__init__()
+        self.layers = nn.ModuleList([Layer() for _ in range(num_layers)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def test_apply_template():
+    num_calls = []
+
+    def schedule_fn(sch):
+        num_calls.append(sch.path)
+
+        def pattern(x):
+            return F.gelu(x)
+
+        sch.trace(flatten=True)
+        sch.replace(nn.ReLU(), sch.find(pattern))
+        sch["linear1"].decompose()
+
+    model = Model()
+    ref_model = copy.deepcopy(model)
+    sch = slapo.create_schedule(model)
+    layers = slapo.apply_template(sch, "layers", schedule_fn)
+    # The schedule function is only applied to the first layer.
+    assert num_calls == ["layers.0"]
+    assert len(layers) == 4
+
+    # The new modules are not shared by layers.
+    relus = {id(layer.mod.ReLU_0) for layer in layers}
+    assert len(relus) == 4
+    for layer, ref_layer in zip(layers, ref_model.layers):
+        assert isinstance(layer["linear1"].mod, slapo.op.LinearWithSeparateBias)
+        # The parameters of each layer are kept.
+        torch.testing.assert_close(layer.mod.linear2.weight, ref_layer.linear2.weight)
+
+    ref_sch = slapo.create_schedule(ref_model)
+    for idx in range(4):
+        schedule_fn(ref_sch[f"layers.{idx}"])
+    inp = torch.randn(2, 16)
+    torch.testing.assert_close(sch.mod(inp), ref_sch.mod(inp))
+
+
+def test_apply_template_codegen(monkeypatch):
+    python_code = torch.fx.Graph.python_code
+    num_codegens = []
+
+    def counted_python_code(graph, *args, **kwargs):
+        num_codegens.append(1)
+        return python_code(graph, *args, **kwargs)
+
+    monkeypatch.setattr(torch.fx.Graph, "python_code", counted_python_code)
+
+    def schedule_fn(sch):
+        def pattern(x):
+            return F.gelu(x)
+
+        sch.trace(flatten=True)
+        sch.replace(nn.ReLU(), sch.find(pattern))
+
+    def apply(num_layers):
+        num_codegens.clear()
+        model = Model(num_layers)
+        ref_model = copy.deepcopy(model)
+        sch = slapo.create_schedule(model)
+        layers = slapo.apply_template(sch, "layers", schedule_fn)
+        inp = torch.randn(2, 16)
+        ref_out = inp
+        for layer in ref_model.layers:
+            ref_out = layer.linear2(F.relu(layer.linear1(ref_out)))
+        # Each layer runs its own parameters with the shared code.
+        torch.testing.assert_close(sch.mod(inp), ref_out)
+        return layers, len(num_codegens)
+
+    # Warm up the trace cache, which is shared by the models.
+    apply(1)
+    _, num_template_codegens = apply(1)
+    layers, num_stamped_codegens = apply(4)
+    # The code of the stamped layers is not generated again.
+    assert num_stamped_codegens == num_template_codegens
+    forward = type(layers[0].mod).forward
+    assert all(type(layer.mod).forward is forward for layer in layers[1:])
+
+
+def test_apply_template_heterogeneous():
+    num_calls = []
+
+    def schedule_fn(sch):
+        num_calls.append(sch.path)
+        sch.trace(flatten=True)
+
+    model = Model(num_layers=3)
+    model.layers[2] = Layer(hidden=16)
+    model.layers[2].linear1 = nn.Linear(16, 32, bias=False)
+    sch = slapo.create_schedule(model)
+    with slapo.record(sch) as log:
+        slapo.apply_template(sch, ["layers.0", "layers.1", "layers.2"], schedule_fn)
+    # The last layer is scheduled by calling the schedule function.
+    assert num_calls == ["layers.0", "layers.2"]
+    # The stamped primitives are also recorded.
+    assert [path for path, _, _, _ in log.entries] == [
+        "layers.0",
+        "layers.1",
+        "layers.2",
+    ]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
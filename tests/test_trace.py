@@ -196,6 +196,129 @@ def test_hf_tracer_gpt_attn():
     assert isinstance(subsch.mod, fx.GraphModule)
 
 
+def test_trace_cache():
+    """Test tracing structurally identical submodules only once."""
+
+    class Layer(torch.nn.Module):
+        def __init__(self, hidden_size, scale):
+            super().__init__()
+            self.linear = torch.nn.Linear(hidden_size, hidden_size)
+            self.scale = scale
+
+        def forward(self, x):
+            return self.linear(x) * self.scale
+
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.layers = torch.nn.ModuleList(
+                [Layer(16, 2), Layer(16, 2), Layer(16, 3)]
+            )
+
+        def forward(self, x):
+            for layer in self.layers:
+                x = layer(x)
+            return x
+
+    model = Model()
+    inp = torch.randn(4, 16)
+    expected = model(inp)
+    slapo.trace_cache.clear_trace_cache()
+    sch = slapo.create_schedule(model)
+    sch.trace()
+    assert isinstance(sch["layers.0"].mod, fx.GraphModule)
+    # Layers with the same structure share the traced graph but not the parameters.
+    assert sch["layers.1"].mod.code == sch["layers.0"].mod.code
+    assert sch["layers.1"].mod.graph is not sch["layers.0"].mod.graph
+    assert sch["layers.1"].mod.linear is model.layers[1].linear
+    # The different scalar attribute results in a different graph.
+    assert "3" in sch["layers.2"].mod.code
+    # The top module, the layer, and the layer with different scale.
+    assert len(slapo.trace_cache._TRACE_CACHE) == 3
+    torch.testing.assert_close(sch.mod(inp), expected)
+
+
+def test_trace_cache_dir(tmp_path, monkeypatch):
+    """Test reusing the traced graphs persisted in the cache directory."""
+
+    class Layer(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.linear = torch.nn.Linear(16, 16)
+
+        def forward(self, x):
+            return torch.relu(self.linear(x)) + x.size(0)
+
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.layers = torch.nn.ModuleList([Layer() for _ in range(2)])
+
+        def forward(self, x):
+            for layer in self.layers:
+                x = layer(x)
+            return x
+
+    slapo.trace_cache.clear_trace_cache()
+    sch = slapo.create_schedule(Model())
+    sch.trace(cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
+    code = sch["layers.0"].mod.code
+
+    # Load the traced graphs from the cache directory without tracing.
+    def fail_trace(*args, **kwargs):
+        raise RuntimeError("Should not trace")
+
+    monkeypatch.setattr(fx.Tracer, "trace", fail_trace)
+    slapo.trace_cache.clear_trace_cache()
+    model = Model()
+    sch = slapo.create_schedule(model)
+    sch.trace(cache_dir=str(tmp_path))
+    assert isinstance(sch.mod, fx.GraphModule)
+    assert sch["layers.1"].mod.code == code
+    inp = torch.randn(4, 16)
+    torch.testing.assert_close(sch.mod(inp), Model.forward(model, inp))
+
+
+def test_trace_cache_object_attr():
+    """Test dropping the cached graphs keyed by garbage collected objects."""
+    # pylint: disable=import-outside-toplevel
+    import gc
+
+    from slapo.trace_cache import (
+        CacheKey,
+        get_cache_key,
+        load_cached_graph,
+        save_cached_graph,
+    )
+
+    class Config:
+        scale = 2
+
+    class Layer(torch.nn.Module):
+        def __init__(self, config):
+            super().__init__()
+            self.config = config
+
+        def forward(self, x):
+            return x * self.config.scale
+
+    slapo.trace_cache.clear_trace_cache()
+    layer = Layer(Config())
+    cache_key = get_cache_key(layer, "pytorch", None, None, {})
+    save_cached_graph(layer, cache_key, fx.symbolic_trace(layer).graph)
+    assert load_cached_graph(layer, cache_key) is not None
+
+    # The ID of the config may be reused by another object once it is
+    # garbage collected, so the cached graph must not be hit anymore.
+    stale_key = CacheKey(cache_key.key)
+    del cache_key
+    layer.config = None
+    gc.collect()
+    assert load_cached_graph(layer, stale_key) is None
+    assert len(slapo.trace_cache._TRACE_CACHE) == 0
+
+
 def test_dynamo():
     from transformers import AutoConfig, BertLMHeadModel
 
@@ -236,3 +359,36 @@ def test_dynamo():
 
 if __name__ == "__main__":
     pytest.main([__file__])
+
+
+def test_hf_tracer_cache(monkeypatch):
+    """Test generating the dummy inputs of the HF tracer only on cache misses."""
+    from transformers import BertConfig, BertModel
+
+    generated = []
+    generate_hf_tracer_inputs = slapo.tracer.generate_hf_tracer_inputs
+
+    def counted_generate_hf_tracer_inputs(root, *args, **kwargs):
+        generated.append(type(root).__name__)
+        return generate_hf_tracer_inputs(root, *args, **kwargs)
+
+    monkeypatch.setattr(
+        slapo.tracer, "generate_hf_tracer_inputs", counted_generate_hf_tracer_inputs
+    )
+
+    config = BertConfig(
+        hidden_size=32, num_hidden_layers=3, num_attention_heads=2, intermediate_size=64
+    )
+    model = BertModel(config)
+    sch = slapo.create_schedule(model)
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    sig = inspect.signature(model.forward)
+    concrete_args = {
+        p.name: p.default for p in sig.parameters.values() if p.name not in input_names
+    }
+    slapo.trace_cache.clear_trace_cache()
+    assert sch.trace(tracer="huggingface", concrete_args=concrete_args, config=config)
+    for idx in range(3):
+        assert isinstance(sch[f"encoder.layer.{idx}"].mod, fx.GraphModule)
+    # The layers after the first one hit the cache.
+    assert generated.count("BertLayer") == 1
@@ -52,5 +52,78 @@ def test_submodule():
         assert name in subschs
 
 
+def test_lazy_schedule():
+    class SubMod(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.linear = nn.Linear(16, 16)
+            self.activation = nn.ReLU()
+
+        def forward(self, x):
+            return self.activation(self.linear(x))
+
+    class Model(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.layers = nn.ModuleList([SubMod() for _ in range(4)])
+            self.fc = nn.Linear(16, 16)
+
+        def forward(self, x):
+            for layer in self.layers:
+                x = layer(x)
+            return self.fc(x)
+
+    sch = slapo.create_schedule(Model(), lazy=True)
+    assert sch._child is None
+    subsch = sch["layers.1.linear"]
+    assert subsch.path == "layers.1.linear"
+    assert subsch.parent is sch["layers.1"]
+    assert sch["layers.1"].parent is sch
+    # Only the schedules along the path are created.
+    assert sch["layers.0"]._child is None
+    assert sch["layers.1"]._child is not None
+
+    # Lazy mode is preserved after tracing.
+    sch.trace(flatten=True)
+    assert sch.lazy and sch["layers.2"].lazy
+
+    eager_names = [name for name, _ in slapo.create_schedule(Model()).named_schedules()]
+    lazy_names = [
+        name for name, _ in slapo.create_schedule(Model(), lazy=True).named_schedules()
+    ]
+    assert eager_names == lazy_names
+
+
+def test_lazy_primitives():
+    class Model(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.fc1 = nn.Linear(1024, 1024)
+            self.fc2 = nn.Linear(1024, 1024)
+
+        def forward(self, x):
+            return self.fc2(self.fc1(x))
+
+    sch = slapo.create_schedule(Model())
+    assert not hasattr(sch, "__dict__")
+    for name in slapo.list_primitives():
+        assert callable(getattr(sch["fc1"], name))
+        assert name in dir(sch)
+    with pytest.raises(AttributeError):
+        sch["fc1"].not_a_primitive()
+
+    # Primitive metadata is only allocated when it is used.
+    assert not sch["fc1"].metadata.primitives
+    sch["fc1"].annotate("weight", "test_tag", 1)
+    assert not sch["fc1"].metadata.primitives
+    assert len(sch["fc2"].metadata.primitives["shard"]) == 0
+    assert list(sch["fc2"].metadata.primitives.keys()) == ["shard"]
+    with pytest.raises(KeyError):
+        sch["fc2"].metadata.primitives["not_a_primitive"]
+
+    # Children share the tie weights of the top schedule.
+    assert sch["fc1"].metadata.tie_weights is sch.metadata.tie_weights
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
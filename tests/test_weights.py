@@ -0,0 +1,260 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Test loading pretrained weights. Note that this test can be invoked by torchrun
+to test sharded loading. See ci/task_unit_tests.sh for an example.
+"""
+# pylint: disable=unused-argument
+
+import json
+import struct
+
+import pytest
+import torch
+from torch import nn
+
+import slapo
+from slapo.weights import (
+    CheckpointWriter,
+    get_checkpoint_rank,
+    get_local_slice,
+    load_checkpoint,
+    open_checkpoint,
+    save_checkpoint,
+    save_flat,
+)
+from slapo.weights.reshard import reshard
+
+
+class Model(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed = nn.Embedding(16, 8)
+        self.linear1 = nn.Linear(8, 16)
+        self.linear2 = nn.Linear(16, 8)
+        self.head = nn.Linear(8, 16, bias=False)
+        self.head.weight = self.embed.weight
+        self.register_buffer("scale", torch.ones(8))
+
+    def forward(self, x):
+        x = self.embed(x)
+        x = self.linear2(self.linear1(x)) * self.scale
+        return self.head(x)
+
+
+def save_safetensors(state_dict, path):
+    header, offset, data = {}, 0, []
+    for name, tensor in state_dict.items():
+        raw = tensor.contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+        header[name] = {
+            "dtype": {torch.float32: "F32"}[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + len(raw)],
+        }
+        offset += len(raw)
+        data.append(raw)
+    header = json.dumps(header).encode()
+    with open(path, "wb") as filep:
+        filep.write(struct.pack("<Q", len(header)))
+        filep.write(header)
+        for raw in data:
+            filep.write(raw)
+
+
+@pytest.mark.parametrize("fmt", ["bin", "safetensors", "flat", "index"])
+def test_load_pretrained(init_dist, tmp_path, fmt):
+    ref_model = Model()
+    state_dict = ref_model.state_dict()
+    # Tied weights are only saved once.
+    del state_dict["head.weight"]
+    if fmt == "bin":
+        path = str(tmp_path / "pytorch_model.bin")
+        torch.save(state_dict, path)
+    elif fmt == "safetensors":
+        path = str(tmp_path / "model.safetensors")
+        save_safetensors(state_dict, path)
+    elif fmt == "flat":
+        path = str(tmp_path / "weights.json")
+        save_flat(state_dict, path)
+    else:
+        names = list(state_dict.keys())
+        torch.save({name: state_dict[name] for name in names[:2]}, tmp_path / "a.bin")
+        save_safetensors(
+            {name: state_dict[name] for name in names[2:]}, tmp_path / "b.safetensors"
+        )
+        weight_map = {name: "a.bin" for name in names[:2]}
+        weight_map.update({name: "b.safetensors" for name in names[2:]})
+        with open(tmp_path / "pytorch_model.bin.index.json", "w") as filep:
+            json.dump({"weight_map": weight_map}, filep)
+        path = str(tmp_path)
+
+    with slapo.init_empty_weights():
+        model = Model()
+    sch = slapo.create_schedule(model)
+    sch["embed"].shard("weight", axis=0)
+    sch["head"].shard("weight", axis=0)
+    sch["linear1"].shard("weight", axis=0)
+    sch["linear1"].shard("bias", axis=0)
+    sch["linear2"].shard("weight", axis=1)
+    missing = slapo.load_pretrained(sch, path)
+    assert not missing
+
+    rank, world_size = sch.rank, sch.world_size
+    expected = {
+        "embed.weight": get_local_slice(ref_model.embed.weight, 0, rank, world_size),
+        "linear1.weight": get_local_slice(
+            ref_model.linear1.weight, 0, rank, world_size
+        ),
+        "linear1.bias": get_local_slice(ref_model.linear1.bias, 0, rank, world_size),
+        "linear2.weight": get_local_slice(
+            ref_model.linear2.weight, 1, rank, world_size
+        ),
+        "linear2.bias": ref_model.linear2.bias,
+        "scale": ref_model.scale,
+    }
+    for name, tensor in expected.items():
+        torch.testing.assert_close(sch.mod.state_dict()[name], tensor)
+    # The tied weights are still tied.
+    assert sch.mod.head.weight is sch.mod.embed.weight
+
+
+def test_load_pretrained_missing(init_dist, tmp_path):
+    path = str(tmp_path / "pytorch_model.bin")
+    state_dict = Model().state_dict()
+    del state_dict["linear1.bias"]
+    torch.save(state_dict, path)
+
+    with slapo.init_empty_weights():
+        model = Model()
+    sch = slapo.create_schedule(model)
+    with pytest.raises(KeyError):
+        slapo.load_pretrained(sch, path)
+    assert slapo.load_pretrained(sch, path, strict=False) == ["linear1.bias"]
+
+
+def shard_model(sch):
+    sch["embed"].shard("weight", axis=0)
+    sch["head"].shard("weight", axis=0)
+    sch["linear1"].shard("weight", axis=0)
+    sch["linear1"].shard("bias", axis=0)
+    sch["linear2"].shard("weight", axis=1)
+
+
+@pytest.mark.parametrize("use_writer", [False, True])
+def test_save_load_checkpoint(init_dist, tmp_path, use_writer):
+    path = str(tmp_path / "ckpt")
+    ref_sch = slapo.create_schedule(Model())
+    shard_model(ref_sch)
+    if use_writer:
+        with CheckpointWriter() as writer:
+            writer.save(ref_sch, path, {"step": 10})
+            # The snapshot is not affected by the following updates.
+            with torch.no_grad():
+                ref_sch.mod.linear1.weight.add_(1)
+            writer.save(ref_sch, path, {"step": 20})
+    else:
+        save_checkpoint(ref_sch, path, {"step": 20})
+
+    with slapo.init_empty_weights():
+        model = Model()
+    sch = slapo.create_schedule(model)
+    shard_model(sch)
+    assert load_checkpoint(sch, path) == {"step": 20}
+    for name, tensor in ref_sch.mod.state_dict().items():
+        torch.testing.assert_close(sch.mod.state_dict()[name], tensor)
+    assert sch.mod.head.weight is sch.mod.embed.weight
+
+    # The sharding must be the same.
+    sch = slapo.create_schedule(Model())
+    with pytest.raises(ValueError):
+        load_checkpoint(sch, path)
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_reshard(tmp_path, num_workers):
+    ref_sch = slapo.create_schedule(Model())
+    shard_model(ref_sch)
+    save_checkpoint(ref_sch, str(tmp_path / "tp1"), {"step": 1})
+    state_dict = ref_sch.mod.state_dict()
+
+    files = reshard(
+        str(tmp_path / "tp1"),
+        str(tmp_path / "tp2_pp2"),
+        tp_size=2,
+        pipeline_split=["linear2"],
+        num_workers=num_workers,
+    )
+    assert len(files) == 4
+    for rank in range(4):
+        stage, tp_rank = rank // 2, rank % 2
+        reader = open_checkpoint(files[rank])
+        assert reader.metadata["user"] == {"step": 1}
+        expected = {
+            # The buffer of the top module is saved before the submodules.
+            0: ["scale", "embed.weight", "linear1.weight", "linear1.bias"],
+            # The tied weight is also placed in the last stage.
+            1: ["linear2.weight", "linear2.bias", "head.weight"],
+        }[stage]
+        assert sorted(reader.keys()) == sorted(expected)
+        for name in expected:
+            spec = reader.metadata["tensors"][name]
+            torch.testing.assert_close(
+                reader.get_tensor(name),
+                get_local_slice(state_dict[name], spec["axis"], tp_rank, 2),
+            )
+
+    # Reshard back and load.
+    reshard(
+        str(tmp_path / "tp2_pp2"),
+        str(tmp_path / "tp1_new"),
+        tp_size=1,
+        pipeline_split=[],
+    )
+    with slapo.init_empty_weights():
+        model = Model()
+    sch = slapo.create_schedule(model)
+    shard_model(sch)
+    load_checkpoint(sch, str(tmp_path / "tp1_new"))
+    for name, tensor in state_dict.items():
+        torch.testing.assert_close(sch.mod.state_dict()[name], tensor)
+    assert sch.mod.head.weight is sch.mod.embed.weight
+
+
+def test_load_resharded_with_dp(tmp_path, monkeypatch):
+    ref_sch = slapo.create_schedule(Model())
+    save_checkpoint(ref_sch, str(tmp_path / "pp1"))
+    state_dict = ref_sch.mod.state_dict()
+    path = str(tmp_path / "pp2")
+    reshard(str(tmp_path / "pp1"), path, tp_size=1, pipeline_split=["linear2"])
+
+    # 4 ranks of PP=2 x DP=2, where the data parallel replicas share a file.
+    mesh = slapo.DeviceMesh(pp_size=2, dp_size=2, world_size=4)
+    for use_mesh in (False, True):
+        ranks = [
+            get_checkpoint_rank(path, rank, 4, mesh if use_mesh else None)
+            for rank in range(4)
+        ]
+        assert ranks == [0, 0, 1, 1]
+    with pytest.raises(ValueError):
+        get_checkpoint_rank(path, 0, 4, slapo.DeviceMesh(tp_size=2, world_size=4))
+
+    for rank, stage in ((1, 0), (3, 1)):
+        monkeypatch.setattr(
+            slapo.weights.checkpoint, "_get_global_rank", lambda rank=rank: (rank, 4)
+        )
+        with slapo.init_empty_weights():
+            model = Model()
+        sch = slapo.create_schedule(model)
+        # The model is not partitioned, so the tensors of the other stage
+        # are missing.
+        load_checkpoint(sch, path, strict=False)
+        loaded = "linear1" if stage == 0 else "linear2"
+        skipped = "linear2" if stage == 0 else "linear1"
+        torch.testing.assert_close(
+            sch.mod.get_submodule(loaded).weight, state_dict[f"{loaded}.weight"]
+        )
+        assert sch.mod.get_submodule(skipped).weight.device.type == "meta"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])